@@ -39,16 +39,35 @@ class Daemon():
     def start_action(self):
         """ runs the program as a linux daemon or windows service
         """
+        if self.ETL.config_handler.config.get('process') == "stream":
+            self.stream_action()
+            return
+
         while True:
             self.ETL.get_from_mongo()
             self.ETL.push_to_sql()
             self.ETL.send_email_update()
 
             logging.info(" <daemon> pulled from mongo")
+            if self.ETL.backlog_remaining:
+                logging.info(" <daemon> new documents remain past numDocsToPull, pulling the next chunk")
+                continue
             logging.info(" <daemon> sleeping for {} sec".format(self.run_interval_sec))
             time.sleep(self.run_interval_sec)
             
 
+    def stream_action(self):
+        """ follows the collection change stream, restarting it from the saved
+            resume token after the run interval if it stops
+        """
+        while True:
+            self.ETL.stream_to_sql()
+            self.ETL.send_email_update()
+
+            logging.warning(" <daemon> change stream stopped")
+            logging.info(" <daemon> restarting change stream in {} sec".format(self.run_interval_sec))
+            time.sleep(self.run_interval_sec)
+
     def start(self):
         """ """
         self.daemon.start()
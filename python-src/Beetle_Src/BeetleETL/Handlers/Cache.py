@@ -0,0 +1,100 @@
+"""
+Size bounded LRU cache whose entries expire after a time to live, shared by
+handlers which look up the same values across pulls.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+# default number of entries kept by a TTLCache
+MAX_SIZE = 10000
+
+# default seconds an entry is kept
+TTL_SEC = 300
+
+
+class TTLCache():
+    """ thread-safe LRU cache with a time to live per entry
+
+        Arguments:
+            max_size {int} -- most entries kept, the least recently used is evicted first
+            ttl_sec {float} -- seconds an entry is kept after it is put
+    """
+
+    def __init__(self, max_size=MAX_SIZE, ttl_sec=TTL_SEC):
+        self.max_size = max_size
+        self.ttl_sec = ttl_sec
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()    # key -> (value, expires at), least recently used first
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0      # entries dropped to stay within max_size
+        self.expirations = 0    # entries dropped after their time to live
+        self.invalidations = 0  # entries dropped by invalidate
+
+    def get_many(self, keys):
+        """ looks up keys in the cache
+
+            Returns:
+                [tuple] -- (dict of key -> value for the keys found, list of keys not found)
+        """
+        found = {}
+        missing = []
+        now = time.monotonic()
+        with self.lock:
+            for key in keys:
+                entry = self.entries.get(key)
+                if entry is not None and entry[1] <= now:
+                    del self.entries[key]
+                    self.expirations += 1
+                    entry = None
+                if entry is None:
+                    missing.append(key)
+                else:
+                    self.entries.move_to_end(key)
+                    found[key] = entry[0]
+            self.hits += len(found)
+            self.misses += len(missing)
+        return found, missing
+
+    def get(self, key, default=None):
+        """ returns the value cached for key or default """
+        found, missing = self.get_many([key])
+        return found.get(key, default)
+
+    def put_many(self, values):
+        """ caches every key -> value in values, evicting the least recently used
+            entries past max_size
+        """
+        expires = time.monotonic() + self.ttl_sec
+        with self.lock:
+            for key, value in values.items():
+                self.entries[key] = (value, expires)
+                self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def put(self, key, value):
+        self.put_many({key : value})
+
+    def invalidate(self, keys=None):
+        """ drops keys from the cache, or every entry if keys is None """
+        with self.lock:
+            if keys is None:
+                keys = list(self.entries.keys())
+            for key in keys:
+                if self.entries.pop(key, None) is not None:
+                    self.invalidations += 1
+
+    def stats(self):
+        """ returns the cache counters """
+        with self.lock:
+            return {
+                "size" : len(self.entries),
+                "hits" : self.hits,
+                "misses" : self.misses,
+                "evictions" : self.evictions,
+                "expirations" : self.expirations,
+                "invalidations" : self.invalidations
+            }
@@ -0,0 +1,243 @@
+"""
+Flattens batches of mongo documents column-wise with pandas/NumPy, producing
+the same rows as the per document walk in MappingPlan.
+"""
+import datetime
+import logging
+import time
+import numpy as np
+import pandas as pd
+from bson.int64 import Int64
+from BeetleETL.Handlers import MappingPlan
+from BeetleETL.Handlers import TypeRegistry
+
+# python types cast_to_target_type treats as numbers (isinstance int or float)
+NUMBER_TYPES = [int, float, bool, Int64]
+
+# target types with a vectorized cast, anything else (or a replaced caster) uses the column caster
+VECTOR_TARGET_TYPES = ("", "str", "int", "date")
+
+
+class ColumnarMap():
+    """ column-wise flattening plan for a single map """
+
+    def __init__(self, map_plan, prefix):
+        self.map_plan = map_plan
+        self.fan_out_getter = compile_getter(prefix) if prefix is not None else None
+        self.getters = []   # per column, (getter, is fanned out) or None for static columns
+        for col in map_plan.columns:
+            if col.is_static:
+                self.getters.append(None)
+            elif col.has_all:
+                self.getters.append((compile_getter(col.steps[len(prefix) + 1:]), True))
+            else:
+                self.getters.append((compile_getter(col.steps), False))
+
+        self.fan_out_names = [col.name for col in map_plan.columns if not col.is_static and col.has_all]
+        self.has_root = any(g is not None and not g[1] for g in self.getters)
+
+    @classmethod
+    def build(cls, map_plan):
+        """ returns a ColumnarMap for map_plan or None if the map uses options which
+            can only be flattened per document (valid_types, lookups, more than one
+            [all] list, required [all] columns, or [all] lists below an index)
+        """
+        prefix = None
+        for col in map_plan.columns:
+            if col.is_static:
+                continue
+            if not col.any_type or col.lookup is not None:
+                return None
+            if not col.has_all:
+                continue
+
+            positions = [i for i in range(len(col.steps)) if col.steps[i][0] == MappingPlan.ALL_STEP]
+            col_prefix = col.steps[:positions[0]]
+            if len(positions) > 1 or col.required or (prefix is not None and col_prefix != prefix):
+                return None
+            prefix = col_prefix
+        return cls(map_plan, prefix)
+
+    def flatten_batch(self, docs, package, add_index=False):
+        """ flattens a batch of documents into rows and adds them to package
+
+            Returns:
+                [bool] -- False if a required column had no data in a document
+        """
+        columns = self.map_plan.columns
+        doc_count = len(docs)
+
+        # explode the [all] list, documents without a list give one row holding
+        # None and documents with an empty list only give a row if the map has
+        # columns outside of the list
+        if self.fan_out_getter is not None:
+            lists = [self.fan_out_getter(doc) for doc in docs]
+            is_list = np.fromiter((isinstance(l, list) and len(l) > 0 for l in lists), dtype=bool, count=doc_count)
+            is_empty = np.fromiter((isinstance(l, list) and len(l) == 0 for l in lists), dtype=bool, count=doc_count)
+            # the elements are gathered with a list rather than Series.explode, which
+            # turns None elements into nan placeholders
+            fanned = [lists[i] if is_list[i] else [None] for i in range(doc_count)]
+            lengths = np.fromiter((len(l) for l in fanned), dtype=np.int64, count=doc_count)
+            positions = np.repeat(np.arange(doc_count), lengths)
+            elements = to_object_array([e for l in fanned for e in l])
+            element_index = np.arange(len(positions)) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+            if not self.has_root:
+                keep = ~is_empty[positions]
+                positions = positions[keep]
+                elements = elements[keep]
+                element_index = element_index[keep]
+            has_list = is_list[positions]
+        else:
+            positions = np.arange(doc_count)
+
+        row_count = len(positions)
+        if row_count == 0:
+            return True
+        rows = np.empty((row_count, len(columns)), dtype=object)
+
+        for i in range(len(columns)):
+            col = columns[i]
+            if self.getters[i] is None:
+                rows[:, i] = [col.static_val] * row_count
+                continue
+
+            getter, fanned_out = self.getters[i]
+            if fanned_out:
+                values = to_object_array([getter(e) if e is not None else None for e in elements])
+                values[~has_list] = None
+            else:
+                values = to_object_array([getter(doc) for doc in docs])
+
+            values = cast_column(values, values == None, col)
+            if col.required and (values == None).any():
+                logging.error('Found a missing required key ({}) in mongo scrapping packages'.format(col.name))
+                return False
+
+            rows[:, i] = values if fanned_out else values[positions]
+
+        # add index to ID for back tracing data location when saving from excel
+        if add_index and self.map_plan.id_index != -1:
+            suffix = np.full(row_count, "|", dtype=object)
+            if self.fan_out_getter is not None and len(self.fan_out_names) > 0:
+                index_str = element_index.astype(str).astype(object)
+                parts = ["{}::".format(name) + index_str for name in self.fan_out_names]
+                joined = parts[0]
+                for part in parts[1:]:
+                    joined = joined + "|" + part
+                suffix[has_list] = "|" + joined[has_list]
+            id_index = self.map_plan.id_index
+            rows[:, id_index] = rows[:, id_index] + suffix
+
+        package.data.extend(rows.tolist())
+        return True
+
+
+####################################
+##### --- Static Functions --- #####
+####################################
+
+def setup_columnar(mapping_plan):
+    """ marks every map of mapping_plan which can be flattened column-wise and
+        rebuilds the trie so those maps are no longer walked per document
+    """
+    for map_plan in mapping_plan.maps:
+        if map_plan.pushdown or map_plan.summary:
+            continue
+        map_plan.columnar = ColumnarMap.build(map_plan)
+        if map_plan.columnar is None:
+            logging.info("map destination {} uses per document options, flattening it by row".format(map_plan.dest))
+    mapping_plan.build_trie()
+    return mapping_plan
+
+def flatten_batch(mapping_plan, docs, package_list, add_index=False):
+    """ flattens a batch of documents for every columnar map in mapping_plan
+
+        Returns:
+            [bool] -- False if a required column had no data in a document
+    """
+    for map_plan, pkg in zip(mapping_plan.maps, package_list):
+        if map_plan.columnar is None:
+            continue
+        t1 = time.perf_counter()
+        if not map_plan.columnar.flatten_batch(docs, pkg, add_index):
+            return False
+        pkg.setup_runtime += time.perf_counter() - t1
+    return True
+
+def compile_getter(steps):
+    """ returns a function following key and index steps into a document, the
+        function returns None when any step is missing
+    """
+    def getter(obj):
+        for step_type, arg in steps:
+            if step_type == MappingPlan.KEY_STEP:
+                obj = obj.get(arg) if isinstance(obj, MappingPlan.DOCUMENT_TYPES) else None
+            elif isinstance(obj, list):
+                try:
+                    obj = obj[arg]
+                except IndexError:
+                    obj = None
+            else:
+                obj = None
+            if obj is None:
+                return None
+        return MappingPlan.materialize_value(obj)
+    return getter
+
+def to_object_array(values):
+    """ builds a 1d object array without numpy unpacking nested lists """
+    arr = np.empty(len(values), dtype=object)
+    arr[:] = values
+    return arr
+
+def cast_column(values, none_mask, col):
+    """ casts a column of mongo data with the same rules as cast_to_target_type,
+        None values are left as None
+    """
+    target_type = col.target_type
+    out = np.empty(len(values), dtype=object)
+    present = ~none_mask
+    if not present.any():
+        return out
+
+    data = pd.Series(values[present], dtype=object)
+    if target_type not in VECTOR_TARGET_TYPES or not TypeRegistry.is_default_caster(target_type):
+        out[present] = to_object_array([col.caster(v) for v in data])
+        return out
+
+    kinds = data.map(type)
+    if target_type in ("", "str"):
+        cast = data.astype(str).to_numpy(dtype=object)
+        # pandas leaves float nan as a float where str() gives "nan"
+        not_str = (pd.Series(cast, dtype=object).map(type) != str).to_numpy()
+        if not_str.any():
+            cast[not_str] = [str(v) for v in data[not_str]]
+
+    elif target_type == "int":
+        cast = np.empty(len(data), dtype=object)
+        numbers = kinds.isin(NUMBER_TYPES).to_numpy()
+        strings = (kinds == str).to_numpy()
+        cast[numbers] = data[numbers].to_numpy(dtype=object)
+        # a list keeps failed parses as None where Series.map would turn them into nan
+        cast[strings] = to_object_array([parse_float(v) for v in data[strings]])
+
+    else:
+        cast = np.empty(len(data), dtype=object)
+        dates = (kinds == datetime.datetime).to_numpy()
+        strings = (kinds == str).to_numpy()
+        numbers = kinds.isin(NUMBER_TYPES).to_numpy()
+        cast[dates] = data[dates].map(datetime.datetime.isoformat).to_numpy(dtype=object)
+        cast[strings] = data[strings].to_numpy(dtype=object)
+        # str() like cast_to_target_type, astype(str) formats nan and Int64 differently
+        cast[numbers] = to_object_array([str(v) for v in data[numbers]])
+
+    out[present] = cast
+    return out
+
+def parse_float(value):
+    """ converts a string to a float like cast_to_target_type, None if it fails """
+    try:
+        return float(value)
+    except Exception as e:
+        logging.error("Could not convert string to int: {}".format(e))
+        return None
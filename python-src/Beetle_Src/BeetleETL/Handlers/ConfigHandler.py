@@ -8,6 +8,8 @@ import getpass
 import logging
 from pydoc import locate
 from collections import OrderedDict
+from BeetleETL.Handlers import MappingPlan
+from BeetleETL.Handlers import TypeRegistry
 
 
 class ConfigHandler():
@@ -137,10 +139,24 @@ class ConfigHandler():
 
         # top level keys
         #self.check_key('useSecureAuthentication', self.config, bool)
+        if 'numDocsToPull' in self.config:
+            self.check_key('numDocsToPull', self.config, int)
+        for key in ('lookupCacheSize', 'lookupCacheTTLSec', 'pageSize', 'resultCacheSize', 'resultCacheTTLSec'):
+            if key in self.config:
+                self.check_key(key, self.config, int)
+        if 'resultCacheWatch' in self.config:
+            self.check_key('resultCacheWatch', self.config, bool)
         if "process" in self.config:
-            self.check_key('process', self.config, str, valid_values=("manual", "daemon"))
-            if  self.config['process'] != "manual":
+            self.check_key('process', self.config, str, valid_values=("manual", "daemon", "stream"))
+            if  self.config['process'] == "daemon":
                 self.check_key('TriggerFrequencyHrs', self.config, int)
+            if self.config['process'] == "stream" and 'streamBatchSize' in self.config:
+                self.check_key('streamBatchSize', self.config, int)
+            # change streams return one document at a time so there is no pipeline to unwind lists in
+            if self.config['process'] == "stream" and any(m.get('array_mode') == "pushdown"
+                for m in self.config.get('mapping', []) if isinstance(m, dict)):
+                advprint(('array_mode', 'INVALID', 'pushdown not allowed with process stream'))
+                self.valid = False
        
         # check connectionInfo keys
         if 'connectionInfo' in self.config and isinstance(self.config['connectionInfo'], dict):
@@ -223,10 +239,16 @@ class ConfigHandler():
                             self.check_key('target_type', val, str, 
                                 alt_title=parent+"/target_type", 
                                 verbose=False,
-                                valid_values=("date", "str", "int")
+                                valid_values=tuple(TypeRegistry.CASTERS)
                                 )
                         if 'required' in val:
                             self.check_key('required', val, bool, alt_title=parent+"/required")
+                        if 'aggregate' in val:
+                            self.check_key('aggregate', val, str, alt_title=parent+"/aggregate", valid_values=tuple(MappingPlan.AGGREGATES))
+                        if 'lookup' in val:
+                            self.check_key('lookup', val, dict, alt_title=parent+"/lookup")
+                        if 'date_unit' in val:
+                            self.check_key('date_unit', val, str, alt_title=parent+"/date_unit", valid_values=MappingPlan.DATE_UNITS)
                         if 'allowMongoUpdate' in val:
                             self.check_key('allowMongoUpdate', val, bool, alt_title=parent+"/allowMongoUpdate")
                             if 'mongoUpdateType' in val:
@@ -259,6 +281,21 @@ class ConfigHandler():
         if 'lastMongoIdPulled' not in self.config['data']:
             self.config['data']['lastMongoIdPulled'] = ''
 
+        # modifiedField names the "updated at" field used as a watermark
+        if 'modifiedField' in self.config['data']:
+            self.check_key('modifiedField', self.config['data'], str, alt_title="data/modifiedField")
+
+        # summary maps group every matching document so they can not be pulled incrementally
+        incremental = self.config['data']['pullOnlyNew'] or self.config['data'].get('modifiedField')
+        summary = any('aggregate' in val for m in self.config.get('mapping', [])
+            for val in m.get('sql_cols', {}).values() if isinstance(val, dict))
+        if incremental and summary:
+            advprint(('sql_cols/aggregate', 'INVALID', 'not allowed with data/pullOnlyNew or data/modifiedField'))
+            self.valid = False
+        if self.config.get('process') == "stream" and summary:
+            advprint(('sql_cols/aggregate', 'INVALID', 'not allowed with process stream'))
+            self.valid = False
+
     def save_config(self):
         """ saves the current values int self.config to its path """
         basename = os.path.basename(self.config_path)
@@ -0,0 +1,227 @@
+"""
+Process-wide registries of long-lived mongo clients and sql connections keyed
+by uri / connection string, so handlers built from any config reuse warm
+connections instead of reconnecting on every pull or push.
+"""
+import logging
+import threading
+import time
+
+# seconds an unused connection is kept before it is closed
+IDLE_SEC = 600
+
+# seconds a connection is trusted without a health check
+CHECK_SEC = 30
+
+
+class PooledConnection():
+    """ a connection held by a ConnectionRegistry """
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.last_used = time.monotonic()
+        self.last_checked = self.last_used
+        self.users = 0
+
+
+class ConnectionRegistry():
+    """ hands out pooled connections keyed by connection string
+
+        Arguments:
+            name {str} -- name used in log messages
+            ping {function} -- raises if a connection is no longer usable
+            close {function} -- closes a connection
+            shared {bool} -- if true one connection per key is handed to every caller
+                             (mongo clients are thread-safe and pool sockets themselves),
+                             otherwise each caller gets a connection of its own
+    """
+
+    def __init__(self, name, ping, close, shared=False):
+        self.name = name
+        self.ping = ping
+        self.close = close
+        self.shared = shared
+        self.lock = threading.Lock()
+        self.pools = {}     # key -> list of PooledConnection, idle ones for unshared registries
+        self.in_use = {}    # id(conn) -> (key, PooledConnection) for unshared registries
+        self.retired = {}   # id(conn) -> (key, PooledConnection) discarded while still in use, closed on the last release
+
+    def acquire(self, key, factory, idle_sec=IDLE_SEC, check_sec=CHECK_SEC):
+        """ returns a healthy connection for key, reusing a pooled one when possible
+            and otherwise creating it with factory(), idle connections are evicted first
+
+            Arguments:
+                key {str} -- uri or connection string the connection was made with
+                factory {function} -- creates a new connection
+        """
+        self.evict_idle(idle_sec)
+
+        entry = None
+        while True:
+            with self.lock:
+                entries = self.pools.get(key, [])
+                if len(entries) == 0:
+                    entry = None
+                elif self.shared:
+                    entry = entries[0]
+                    entry.users += 1
+                else:
+                    entry = entries.pop()
+            if entry is None or self.is_healthy(entry, check_sec):
+                break
+            if self.shared:
+                with self.lock:
+                    entry.users -= 1
+            self.discard(key, entry)
+
+        if entry is None:
+            entry = PooledConnection(factory())
+            entry.users = 1
+            logging.info("Opened a new pooled {} connection".format(self.name))
+            with self.lock:
+                entries = self.pools.setdefault(key, [])
+                if self.shared and len(entries) > 0:
+                    # another thread opened one first, use theirs
+                    self.close_quietly(entry.conn)
+                    entry = entries[0]
+                    entry.users += 1
+                elif self.shared:
+                    entries.append(entry)
+        else:
+            logging.info("Reusing a pooled {} connection".format(self.name))
+
+        with self.lock:
+            entry.last_used = time.monotonic()
+            if not self.shared:
+                self.in_use[id(entry.conn)] = (key, entry)
+        return entry.conn
+
+    def release(self, conn, discard=False):
+        """ hands a connection back to the registry, discarded connections are closed """
+        with self.lock:
+            found = self.find(conn)
+            if found is None:
+                key, entry = None, None
+            else:
+                key, entry = found
+                entry.users = max(entry.users - 1, 0)
+                entry.last_used = time.monotonic()
+                if not self.shared:
+                    del self.in_use[id(conn)]
+                    if not discard:
+                        self.pools.setdefault(key, []).append(entry)
+
+            # a discarded connection is closed once its last holder is done with it
+            retired = entry is not None and id(conn) in self.retired
+            if retired and entry.users == 0:
+                del self.retired[id(conn)]
+
+        if entry is None:
+            self.close_quietly(conn)
+        elif retired:
+            if entry.users == 0:
+                self.close_quietly(conn)
+        elif discard:
+            self.discard(key, entry)
+
+    def find(self, conn):
+        """ returns (key, entry) for a connection handed out by the registry or None """
+        if not self.shared:
+            return self.in_use.get(id(conn))
+        if id(conn) in self.retired:
+            return self.retired[id(conn)]
+        for key, entries in self.pools.items():
+            for entry in entries:
+                if entry.conn is conn:
+                    return key, entry
+        return None
+
+    def is_healthy(self, entry, check_sec=CHECK_SEC):
+        """ pings a connection which has not been checked for check_sec seconds """
+        now = time.monotonic()
+        if now - entry.last_checked < check_sec:
+            return True
+        try:
+            self.ping(entry.conn)
+            entry.last_checked = now
+            return True
+        except Exception as err:
+            logging.warning("Pooled {} connection failed its health check, reconnecting\n -> {}".format(self.name, err))
+            return False
+
+    def discard(self, key, entry):
+        """ removes a connection from the registry and closes it, a shared connection
+            other callers still hold is closed when the last of them releases it
+        """
+        with self.lock:
+            entries = self.pools.get(key, [])
+            if entry in entries:
+                entries.remove(entry)
+            if len(entries) == 0:
+                self.pools.pop(key, None)
+            in_use = entry.users > 0
+            if in_use:
+                self.retired[id(entry.conn)] = (key, entry)
+        if not in_use:
+            self.close_quietly(entry.conn)
+
+    def evict_idle(self, idle_sec=IDLE_SEC):
+        """ closes every connection nobody has used for idle_sec seconds """
+        now = time.monotonic()
+        evicted = []
+        with self.lock:
+            for key in list(self.pools.keys()):
+                keep = []
+                for entry in self.pools[key]:
+                    if entry.users == 0 and now - entry.last_used > idle_sec:
+                        evicted.append(entry)
+                    else:
+                        keep.append(entry)
+                if len(keep) > 0:
+                    self.pools[key] = keep
+                else:
+                    del self.pools[key]
+
+        for entry in evicted:
+            self.close_quietly(entry.conn)
+        if len(evicted) > 0:
+            logging.info("Closed {} idle pooled {} connection(s)".format(len(evicted), self.name))
+
+    def close_all(self):
+        """ closes every connection held by the registry """
+        with self.lock:
+            entries = [entry for pool in self.pools.values() for entry in pool]
+            entries += [entry for key, entry in self.in_use.values()]
+            entries += [entry for key, entry in self.retired.values()]
+            self.pools = {}
+            self.in_use = {}
+            self.retired = {}
+        for entry in entries:
+            self.close_quietly(entry.conn)
+
+    def close_quietly(self, conn):
+        try:
+            self.close(conn)
+        except Exception as err:
+            logging.warning("Could not close pooled {} connection\n -> {}".format(self.name, err))
+
+
+####################################
+##### --- Static Functions --- #####
+####################################
+
+def ping_mongo(client):
+    client.admin.command("ping")
+
+def ping_sql(connection):
+    cursor = connection.cursor()
+    cursor.execute("SELECT 1").fetchone()
+    cursor.close()
+
+def close_connection(conn):
+    conn.close()
+
+
+# registries shared by every handler in the process
+mongo_clients = ConnectionRegistry("mongo", ping_mongo, close_connection, shared=True)
+sql_connections = ConnectionRegistry("sql", ping_sql, close_connection, shared=False)
@@ -58,6 +58,10 @@ class ETLHandler():
         self.mongo_handler = None
         self.sql_handler = None
         self.package_queue = []   # packages to send to destination db 
+        self.last_pulled = {}     # watermarks in data before the queued packages were pulled
+        self.backlog_remaining = False  # more new documents remain after the queued chunk
+        self.preview_result = None      # MongoHandler.PreviewResult of the last preview
+        self.next_page_token = None     # token of the page after the queued one, None after the last page
         
         # setup handlers
         self.setup_handles()
@@ -91,14 +95,93 @@ class ETLHandler():
         if filter_dict is None and self.mongo_handler.mongo_filter:
             filter_dict = self.mongo_handler.mongo_filter
 
-        # pull documents from MongoDB into package_queue list
+        # pull documents from MongoDB into package_queue list, keeping the previous
+        # watermark so it can be restored if the chunk never reaches sql
+        data = self.config_handler.config['data']
+        self.last_pulled = {key : data.get(key) for key in MongoHandler.WATERMARK_KEYS if key in data}
         self.package_queue = self.mongo_handler.pull_collection(filter_dict, add_index)
+        self.backlog_remaining = self.mongo_handler.backlog_remaining
 
         # if nothing got returned let the user know
         if not self.package_queue or len(self.package_queue) == 0:
             logging.warning("Something may be wrong: nothing was pulled from mongo")
             return None
        
+    @logruntimeerror
+    def get_page_from_mongo(self, filter_dict=None, page_token=None, page_size=None, add_index=False):
+        """ pulls one page of the collection, lastMongoIdPulled is not updated
+
+            Arguments:
+                filter_dict {dict} -- custom mongo query to use, the same for every page
+                page_token {string} -- next_page_token of the previous page, None for the first
+
+            Return:
+                [None] -- sets self.package_queue to the packages of the page and
+                          self.next_page_token, which is None after the last page
+        """
+        if filter_dict is None and self.mongo_handler.mongo_filter:
+            filter_dict = self.mongo_handler.mongo_filter
+
+        self.next_page_token = None
+        result = self.mongo_handler.pull_page(filter_dict or {}, page_token, page_size, add_index)
+        if result is None:
+            self.package_queue = None
+            logging.warning("Something may be wrong: the page could not be pulled from mongo")
+            return None
+        self.package_queue = result.packages
+        self.next_page_token = result.next_token
+
+    @logruntimeerror
+    def preview(self, filter_dict=None, size=100, sample=True):
+        """ flattens a sample of documents through the mapping, to check a mapping
+            without pulling the whole collection, lastMongoIdPulled is never updated
+
+            Arguments:
+                filter_dict {dict} -- custom mongo query to preview, defaults to the mongoFilter
+                size {int} -- number of documents to preview
+                sample {bool} -- if true, random documents when there is no filter and
+                                 the first matching documents in natural order when
+                                 there is one (a biased sample, usually the oldest
+                                 documents), if false the newest documents
+
+            Return:
+                [None] -- sets self.preview_result to a MongoHandler.PreviewResult,
+                          or None if the preview failed
+        """
+        if filter_dict is None and self.mongo_handler.mongo_filter:
+            filter_dict = self.mongo_handler.mongo_filter
+
+        self.preview_result = self.mongo_handler.preview(filter_dict or {}, size, sample)
+        if self.preview_result is None:
+            logging.warning("Something may be wrong: nothing was previewed from mongo")
+
+    @logruntimeerror
+    def stream_to_sql(self):
+        """ follows the change stream of the collection and pushes each micro-batch
+            of flattened documents to sql, the resume token is saved to the config
+            after every batch so a restart continues where the last batch ended
+
+            Return:
+                [None] -- returns when the change stream stops or a push fails
+        """
+        config = self.config_handler.config
+        resume_token = MongoHandler.from_config_value(config['data'].get('resumeToken'))
+        batches = self.mongo_handler.watch_collection(
+            resume_token=resume_token,
+            batch_size=config.get('streamBatchSize', 500),
+            max_wait_sec=config.get('streamMaxWaitSec', 5)
+            )
+
+        for package_list, resume_token in batches:
+            self.package_queue = package_list
+            if not self.sql_handler.push_packages(self.package_queue):
+                logging.error("could not push change stream batch to sql, stopping stream")
+                batches.close()
+                return
+
+            config['data']['resumeToken'] = MongoHandler.to_config_value(resume_token)
+            self.config_handler.save_config()
+
     @logruntimeerror
     def xml_to_dataframe(self, xml_string):
         """ converts an xml string to a pandas dataframe """
@@ -140,6 +223,15 @@ class ETLHandler():
             return True
         else:
             logging.warning("got False back from SQLHandler, not saving last_pulled_mongo_id")
+            if not return_value:
+                # pull the same chunk again on the next run
+                data = self.config_handler.config['data']
+                for key in MongoHandler.WATERMARK_KEYS:
+                    if key in self.last_pulled:
+                        data[key] = self.last_pulled[key]
+                    else:
+                        data.pop(key, None)
+                self.backlog_remaining = False
             return False
     
     @logruntimeerror
@@ -0,0 +1,104 @@
+"""
+Compiles the mongoFilter section of a config into templates so filters are
+walked once per config, binding an Interject parameter only rebuilds the
+filter with the value put in place of INPUT_VALUE.
+"""
+import json
+import logging
+from bson.objectid import ObjectId
+
+# placeholder for an Interject parameter in a mongoFilter entry
+INPUT_VALUE = "INPUT_VALUE"
+
+# parameter types from interject, NONSTRINGS are substituted as json values instead of text
+STRINGS = ["VARCHAR", "VARCHARMAX", "TEXT", "NCHAR", "NTEXT",\
+            "NVARCHAR", "NVARCHARMAX", "CHAR"]
+NONSTRINGS = ["INT", "BIGINT", "SMALLINT", "SMALLMONEY", "TINYINT", "FLOAT",\
+            "MONEY", "DATETIME", "DATE", "SMALLDATETIME", "BIT", "REAL"]
+
+# placeholder kinds
+WHOLE_VALUE = 0     # the value is INPUT_VALUE and takes the cast parameter i.e. {"age" : "INPUT_VALUE"}
+IN_STRING = 1       # INPUT_VALUE is part of a string and takes the text i.e. {"$regex" : "^INPUT_VALUE"}
+
+
+class FilterTemplate():
+    """ precompiled mongoFilter entry
+
+        Arguments:
+            alias {str} -- the key in mongoFilter
+            query {dict} -- the filter with any INPUT_VALUE placeholders
+    """
+
+    def __init__(self, alias, query):
+        self.alias = alias
+        self.placeholders = []  # (path of keys / indexes, kind) of every INPUT_VALUE
+        self.build = self.compile(query, ())
+
+    @property
+    def has_input(self):
+        """ true if the filter needs an Interject parameter """
+        return len(self.placeholders) > 0
+
+    def compile(self, node, path):
+        """ returns a function building a fresh copy of node from (text, value) """
+        if isinstance(node, dict):
+            items = [(key, self.compile(val, path + (key,))) for key, val in node.items()]
+            return lambda bound: {key : build(bound) for key, build in items}
+
+        if isinstance(node, list):
+            builds = [self.compile(node[i], path + (i,)) for i in range(len(node))]
+            return lambda bound: [build(bound) for build in builds]
+
+        if node == INPUT_VALUE:
+            self.placeholders.append((path, WHOLE_VALUE))
+            return lambda bound: bound[1]
+
+        if isinstance(node, str) and INPUT_VALUE in node:
+            self.placeholders.append((path, IN_STRING))
+            return lambda bound: node.replace(INPUT_VALUE, bound[0])
+
+        return lambda bound: node
+
+    def bind(self, input_value=None, cast_to=""):
+        """ returns the filter with input_value in place of every INPUT_VALUE, the
+            value is parsed as json for NONSTRINGS parameter types and kept as text
+            otherwise, a string _id is converted to an ObjectId
+
+            Arguments:
+                input_value {str} -- the Interject parameter value
+                cast_to {str} -- the Interject parameter type i.e. VARCHAR, INT
+        """
+        text = "" if input_value is None else str(input_value)
+        value = input_value
+        if cast_to in NONSTRINGS and isinstance(input_value, str):
+            try:
+                value = json.loads(input_value)
+            except ValueError as err:
+                logging.warning("could not cast ({}) to {} for filter {}, using it as text\n -> {}".format(
+                    input_value, cast_to, self.alias, err))
+
+        query = self.build((text, value))
+
+        # if objectid is included convert id to ObjectId Type
+        if isinstance(query.get("_id"), str) and ObjectId.is_valid(query["_id"]):
+            query["_id"] = ObjectId(query["_id"])
+        return query
+
+
+####################################
+##### --- Static Functions --- #####
+####################################
+
+def compile_filters(mongo_filter):
+    """ compiles every entry of a config's mongoFilter into a FilterTemplate
+
+        Returns:
+            [dict] -- alias -> FilterTemplate
+    """
+    templates = {}
+    for alias, query in mongo_filter.items():
+        if not isinstance(query, dict):
+            logging.warning("mongoFilter ({}) is not an object, skipping it".format(alias))
+            continue
+        templates[alias] = FilterTemplate(alias, query)
+    return templates
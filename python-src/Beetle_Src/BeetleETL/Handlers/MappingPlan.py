@@ -0,0 +1,678 @@
+"""
+Compiles the mapping section of a config into reusable accessor plans so
+mongo_paths are parsed once per config instead of once per document.
+"""
+import copy
+import logging
+import time
+from bson.raw_bson import RawBSONDocument
+import bson
+from BeetleETL.Handlers import Package as PKG
+from BeetleETL.Handlers import TypeRegistry
+
+# step types for a tokenized mongo_path
+KEY_STEP = 0    # dictionary lookup i.e. address
+INDEX_STEP = 1  # list index i.e. coord[0]
+ALL_STEP = 2    # list fan-out i.e. grades[all]
+
+# documents which can be walked into, RawBSONDocument is used when pulling
+# with "useRawBSON" so only the parts of a document a path enters are decoded
+DOCUMENT_TYPES = (dict, RawBSONDocument)
+
+# field holding the array position of documents unwound by a pushdown map
+UNWIND_INDEX_FIELD = "__beetle_index"
+
+# aggregate option of sql_cols in a summary map -> $group accumulator
+AGGREGATES = {
+    "count" : "$sum",
+    "sum" : "$sum",
+    "avg" : "$avg",
+    "min" : "$min",
+    "max" : "$max"
+}
+
+# units a date group key can be truncated to with the date_unit option
+DATE_UNITS = ("year", "quarter", "month", "week", "day", "hour", "minute")
+
+# names usable in the valid_types option of sql_cols, see TypeRegistry
+VALID_TYPE_NAMES = TypeRegistry.VALID_TYPES
+
+class ColumnPlan():
+    """ precomputed accessor for a single entry in a map's sql_cols """
+
+    def __init__(self, name, col_config):
+        self.name = name
+        # columns without a mongo_path are treated as a static null column,
+        # except count aggregates which count documents
+        self.aggregate = col_config.get('aggregate')
+        self.date_unit = col_config.get('date_unit')
+        self.is_static = 'static_val' in col_config or \
+            ('mongo_path' not in col_config and self.aggregate is None)
+        self.static_val = col_config.get('static_val')
+        self.mongo_path = col_config.get('mongo_path')
+        self.target_type = col_config.get('target_type', "")
+        self.required = col_config.get('required') == True
+        self.is_id = self.mongo_path == "_id"
+        self.has_all = False
+        self.steps = ()
+
+        if not self.is_static and self.mongo_path is not None:
+            self.steps = parse_mongo_path(self.mongo_path)
+            self.has_all = any(step[0] == ALL_STEP for step in self.steps)
+
+        # resolve the valid_types option into a type set, names which are
+        # not registered types are still matched on the type name
+        self.any_type, self.none_ok, self.valid_types, self.valid_names = \
+            TypeRegistry.resolve_valid_types(col_config.get('valid_types', ["none"]))
+
+        # resolve the caster used to convert mongo data to the sql type
+        self.caster = TypeRegistry.get_caster(self.target_type)
+
+        # lookup columns keep the raw key found at mongo_path, it is replaced
+        # by the related document's value (then cast) once a batch is pulled
+        self.lookup = None
+        if 'lookup' in col_config:
+            self.lookup = parse_lookup(name, col_config['lookup'])
+            self.value_caster = self.caster
+            self.caster = keep_value
+
+    def is_valid(self, obj):
+        """ returns true if obj passes the valid_types check for the column """
+        return self.any_type or type(obj) in self.valid_types or \
+            (bool(self.valid_names) and type(obj).__name__ in self.valid_names)
+
+    def extract(self, doc):
+        """ walks a document along the column steps
+
+            Returns:
+                [tuple] -- (values, indexes) where indexes locate each value
+                           inside any [all] lists it was found in
+        """
+        out = []
+        index_list = []
+        self._walk(doc, 0, out, index_list, "")
+        return out, index_list
+
+    def _walk(self, obj, pos, out, index_list, _index):
+        """ recursive walk used by extract, mirrors get_val_from_dict """
+        if obj is None:
+            if self.none_ok:
+                out.append(None)
+                index_list.append(_index[1:])
+            return
+
+        steps = self.steps
+        if pos == len(steps):
+            obj = materialize_value(obj)
+            if self.is_valid(obj):
+                out.append(self.caster(obj))
+                index_list.append(_index[1:])
+            return
+
+        step_type, arg = steps[pos]
+        if step_type == KEY_STEP:
+            obj = obj.get(arg) if isinstance(obj, DOCUMENT_TYPES) else None
+        elif step_type == INDEX_STEP:
+            try:
+                obj = obj[arg] if isinstance(obj, list) else None
+            except IndexError:
+                obj = None
+        else:
+            if isinstance(obj, list):
+                for i in range(len(obj)):
+                    self._walk(obj[i], pos + 1, out, index_list, "{}_{}".format(_index, i))
+                return
+            obj = None
+
+        self._walk(obj, pos + 1, out, index_list, _index)
+
+
+class MapPlan():
+    """ precomputed accessors for every column of a single map """
+
+    def __init__(self, map_config):
+        self.dest = map_config["sql_dest"]
+        self.columns = [ColumnPlan(key, val) for key, val in map_config["sql_cols"].items()]
+        self.col_names = [col.name for col in self.columns]
+        self.target_types = [map_config["sql_cols"][col.name].get("target_type") for col in self.columns]
+
+        # positions of the columns filled from a related collection
+        self.lookup_columns = [i for i in range(len(self.columns)) if self.columns[i].lookup is not None]
+
+        # index of the column holding the ObjectId (used to trace rows back to mongo)
+        self.id_index = -1
+        for i in range(len(self.columns)):
+            if self.columns[i].is_id:
+                self.id_index = i
+
+        # maps using "array_mode" : "pushdown" have their [all] list unwound by
+        # the server and are walked with the [all] step removed
+        self.columnar = None    # ColumnarEngine.ColumnarMap when flattened column-wise
+        self.pushdown = False
+        self.unwind_path = None
+        self.flat_columns = None
+        self.preserve_empty = True
+
+        # maps with aggregate columns are grouped by the server into summary rows
+        self.summary = any(col.aggregate is not None for col in self.columns)
+        if self.summary:
+            self.setup_summary()
+        elif map_config.get("array_mode", "client") == "pushdown":
+            self.pushdown = self.setup_pushdown()
+
+    def setup_pushdown(self):
+        """ prepares the map to have its [all] list unwound by the server, this is
+            only possible when every [all] column fans out the same list once
+
+            Returns:
+                [bool] -- True if the map can use pushdown
+        """
+        fan_out = [col for col in self.columns if not col.is_static and col.has_all]
+        prefix = None
+        for col in fan_out:
+            positions = [i for i in range(len(col.steps)) if col.steps[i][0] == ALL_STEP]
+            col_prefix = col.steps[:positions[0]]
+            if len(positions) > 1 or col.required or len(col_prefix) == 0 or \
+                any(step[0] != KEY_STEP for step in col_prefix) or \
+                (prefix is not None and col_prefix != prefix):
+                prefix = None
+                break
+            prefix = col_prefix
+
+        if prefix is None:
+            logging.warning("map destination {} can not use array_mode pushdown (requires one shared "
+                "[all] list which is not required), using client".format(self.dest))
+            return False
+
+        self.unwind_path = ".".join(step[1] for step in prefix)
+        self.flat_columns = []
+        for col in self.columns:
+            if col in fan_out:
+                flat_col = copy.copy(col)
+                flat_col.steps = prefix + col.steps[len(prefix) + 1:]
+                self.flat_columns.append(flat_col)
+            else:
+                self.flat_columns.append(col)
+
+        # when every column is in the list, documents with an empty list produce no rows
+        self.preserve_empty = any(not col.is_static and not col.has_all for col in self.columns)
+        return True
+
+    def build_pipeline(self, query_filter=None, projection=None):
+        """ returns the aggregation pipeline which unwinds the map's [all] list """
+        pipeline = []
+        if query_filter:
+            pipeline.append({"$match" : query_filter})
+        pipeline.append({"$sort" : {"_id" : 1}})
+        if projection is not None:
+            pipeline.append({"$project" : projection})
+        pipeline.append({"$unwind" : {
+            "path" : "$" + self.unwind_path,
+            "includeArrayIndex" : UNWIND_INDEX_FIELD,
+            "preserveNullAndEmptyArrays" : self.preserve_empty
+            }})
+        return pipeline
+
+    def setup_summary(self):
+        """ prepares a map with aggregate columns to be grouped by the server, the
+            columns with a mongo_path and no aggregate are the group keys, and at
+            most one [all] list (shared by every column using it) is unwound first
+        """
+        for col in self.columns:
+            if col.aggregate is not None and col.aggregate not in AGGREGATES:
+                raise ValueError("invalid aggregate ({}) for column ({}), use one of {}".format(
+                    col.aggregate, col.name, ", ".join(AGGREGATES)))
+            if col.aggregate != "count" and col.aggregate is not None and col.mongo_path is None:
+                raise ValueError("aggregate column ({}) needs a mongo_path".format(col.name))
+            if col.date_unit is not None and (col.date_unit not in DATE_UNITS or col.aggregate is not None):
+                raise ValueError("invalid date_unit ({}) for column ({}), group keys use one of {}".format(
+                    col.date_unit, col.name, ", ".join(DATE_UNITS)))
+            if col.lookup is not None:
+                raise ValueError("summary column ({}) can not use a lookup".format(col.name))
+            if col.is_static or len(col.steps) == 0:
+                continue
+
+            if any(step[0] == INDEX_STEP for step in col.steps):
+                raise ValueError("summary column ({}) can not index a list ({})".format(col.name, col.mongo_path))
+            positions = [i for i in range(len(col.steps)) if col.steps[i][0] == ALL_STEP]
+            if len(positions) == 0:
+                continue
+            unwind_path = ".".join(step[1] for step in col.steps[:positions[0]])
+            if len(positions) > 1 or positions[0] == 0 or \
+                (self.unwind_path is not None and unwind_path != self.unwind_path):
+                raise ValueError("summary map destination {} can only group one shared [all] list".format(self.dest))
+            self.unwind_path = unwind_path
+
+    def build_summary_pipeline(self, query_filter=None):
+        """ returns the aggregation pipeline grouping the map into summary rows,
+            output fields are named c<column position>
+        """
+        keys = {}
+        group = {"_id" : None}
+        for i in range(len(self.columns)):
+            col = self.columns[i]
+            if col.is_static:
+                continue
+            field = "c{}".format(i)
+            path = "$" + ".".join(arg for step_type, arg in col.steps if step_type == KEY_STEP) \
+                if col.mongo_path is not None else None
+
+            if col.aggregate is None:
+                if col.date_unit is not None:
+                    path = {"$dateTrunc" : {"date" : path, "unit" : col.date_unit}}
+                keys[field] = path
+            elif col.aggregate == "count" and path is None:
+                group[field] = {"$sum" : 1}
+            elif col.aggregate == "count":
+                # only documents holding a value are counted
+                group[field] = {"$sum" : {"$cond" : [{"$eq" : [{"$ifNull" : [path, None]}, None]}, 0, 1]}}
+            else:
+                group[field] = {AGGREGATES[col.aggregate] : path}
+
+        pipeline = []
+        if query_filter:
+            pipeline.append({"$match" : query_filter})
+        if self.unwind_path is not None:
+            pipeline.append({"$unwind" : {"path" : "$" + self.unwind_path, "preserveNullAndEmptyArrays" : False}})
+        if len(keys) > 0:
+            group["_id"] = keys
+
+        project = {"_id" : 0}
+        for field in keys:
+            project[field] = "$_id." + field
+        for field in group:
+            if field != "_id":
+                project[field] = 1
+        pipeline.append({"$group" : group})
+        pipeline.append({"$project" : project})
+        if len(keys) > 0:
+            pipeline.append({"$sort" : {field : 1 for field in keys}})
+        return pipeline
+
+    def flatten_summary(self, doc, package):
+        """ inserts a row returned by the summary pipeline into package
+
+            Returns:
+                [bool] -- False if a required column had no data in the row
+        """
+        row = []
+        for i in range(len(self.columns)):
+            col = self.columns[i]
+            if col.is_static:
+                row.append(col.static_val)
+                continue
+            value = doc.get("c{}".format(i))
+            if value is None and col.required:
+                logging.error('Found a missing required key ({}) in mongo summary rows'.format(col.name))
+                return False
+            row.append(col.caster(value) if value is not None else None)
+        package.insert_data(row)
+        return True
+
+    def flatten_unwound(self, doc, package, add_index=False):
+        """ flattens a document returned by the pushdown pipeline into rows
+
+            Returns:
+                [bool] -- False if a required column had no data in the document
+        """
+        index = doc.get(UNWIND_INDEX_FIELD)
+        index = "" if index is None else str(index)
+
+        values = []
+        indexes = []
+        for col in self.flat_columns:
+            if col.is_static:
+                values.append(None)
+                indexes.append(None)
+            else:
+                res, index_res = col.extract(doc)
+                values.append(res)
+                indexes.append([index for i in res] if col.has_all else index_res)
+        return self.insert_values(values, indexes, package, add_index)
+
+    def is_client_side(self):
+        """ true if the map is walked per document by the trie """
+        return not self.pushdown and not self.summary and self.columnar is None
+
+    def build_package(self):
+        """ returns an empty package for the map """
+        new_pkg = PKG.Package(self.dest, list(self.col_names), list(self.target_types))
+        new_pkg.set_cardinality()
+        return new_pkg
+
+    def flatten(self, doc, package, add_index=False):
+        """ flattens a document into rows and inserts them into package
+
+            Returns:
+                [bool] -- False if a required column had no data in the document
+        """
+        values = []
+        indexes = []
+        for col in self.columns:
+            if col.is_static:
+                values.append(None)
+                indexes.append(None)
+            else:
+                res, index_res = col.extract(doc)
+                values.append(res)
+                indexes.append(index_res)
+        return self.insert_values(values, indexes, package, add_index)
+
+    def insert_values(self, values, indexes, package, add_index=False):
+        """ translates the values found for each column into rows and inserts
+            them into package
+
+            Arguments:
+                values {list of lists} -- values found for each column (ignored for static columns)
+                indexes {list of lists} -- list locations of each value, only used with add_index
+
+            Returns:
+                [bool] -- False if a required column had no data in the document
+        """
+        pulled = []
+        pulled_indexes = []
+        longest = 0
+
+        for col, res, index_res in zip(self.columns, values, indexes):
+
+            # first check if the column should be a static value or data
+            # from a mongo document
+            if col.is_static:
+                pulled.append([col.static_val])
+                continue
+
+            # only build index res if the mongo_path is a list
+            if add_index and col.has_all:
+                pulled_indexes.append(["{}::{}".format(col.name, i) for i in index_res])
+
+            # if this field has the required option and none is the only data point
+            # returned, then stop entire mapping
+            if col.required and res == [None for i in res]:
+                logging.error('Found a missing required key ({}) in mongo scrapping packages'.format(col.name))
+                return False
+
+            if len(res) > longest:
+                longest = len(res)
+            pulled.append(res)
+
+        insert_rows(package, pulled, pulled_indexes, longest, self.id_index, add_index)
+        return True
+
+
+class PathNode():
+    """ node in the trie of mongo_paths shared by all maps, each document is
+        walked once and values are routed to every column ending at a node
+    """
+
+    def __init__(self):
+        self.children = []      # list of ((step type, argument), PathNode)
+        self.terminals = []     # list of (slot, ColumnPlan) ending at this node
+        self.none_slots = []    # slots of every column below this node accepting None
+
+    def child(self, step):
+        """ returns the child node for step, creating it if needed """
+        for child_step, node in self.children:
+            if child_step == step:
+                return node
+        node = PathNode()
+        self.children.append((step, node))
+        return node
+
+    def walk(self, obj, values, indexes, _index, track_index):
+        """ routes the data at obj to every column in this subtree """
+        if obj is None:
+            for slot in self.none_slots:
+                values[slot].append(None)
+                if track_index:
+                    indexes[slot].append(_index[1:])
+            return
+
+        if self.terminals:
+            obj = materialize_value(obj)
+
+        for slot, col in self.terminals:
+            if col.is_valid(obj):
+                values[slot].append(col.caster(obj))
+                if track_index:
+                    indexes[slot].append(_index[1:])
+
+        for (step_type, arg), node in self.children:
+            if step_type == KEY_STEP:
+                node.walk(obj.get(arg) if isinstance(obj, DOCUMENT_TYPES) else None,
+                    values, indexes, _index, track_index)
+
+            elif step_type == INDEX_STEP:
+                try:
+                    child_obj = obj[arg] if isinstance(obj, list) else None
+                except IndexError:
+                    child_obj = None
+                node.walk(child_obj, values, indexes, _index, track_index)
+
+            elif isinstance(obj, list):
+                for i in range(len(obj)):
+                    new_index = "{}_{}".format(_index, i) if track_index else _index
+                    node.walk(obj[i], values, indexes, new_index, track_index)
+            else:
+                node.walk(None, values, indexes, _index, track_index)
+
+
+class MappingPlan():
+    """ compiled form of config["mapping"] """
+
+    def __init__(self, mapping):
+        self.maps = [MapPlan(m) for m in mapping]
+        self.walk_runtime = 0   # time spent walking documents through the trie
+        self.build_trie()
+
+    def build_trie(self):
+        """ gives every non static column of every map walked per document a
+            slot in the value buffers and adds its steps to the shared trie
+        """
+        self.root = PathNode()
+        self.slots = []     # per map, the slot of each column (None for static columns)
+        self.slot_count = 0
+        for map_plan in self.maps:
+            if not map_plan.is_client_side():
+                self.slots.append(None)
+                continue
+            map_slots = []
+            for col in map_plan.columns:
+                if col.is_static:
+                    map_slots.append(None)
+                    continue
+                slot = self.slot_count
+                self.slot_count += 1
+                map_slots.append(slot)
+
+                node = self.root
+                if col.none_ok:
+                    node.none_slots.append(slot)
+                for step in col.steps:
+                    node = node.child(step)
+                    if col.none_ok:
+                        node.none_slots.append(slot)
+                node.terminals.append((slot, col))
+            self.slots.append(map_slots)
+
+    def build_packages(self):
+        """ returns an empty package for each map """
+        return [m.build_package() for m in self.maps]
+
+    def needs_documents(self):
+        """ true if any map reads the documents on the client, maps using
+            pushdown or summaries are run by the server
+        """
+        return any(not m.pushdown and not m.summary for m in self.maps)
+
+    def build_projection(self, maps=None):
+        """ builds a mongodb projection covering every mongo_path in maps (defaults
+            to every map walked client side)
+
+            Paths made only of keys project the leaf field, paths which index into
+            a list project the field holding the list, since projecting through a
+            list would drop non document elements and change the rows produced.
+
+            Returns:
+                [dict] -- projection to pass to find
+                [None] -- if a path can not be safely projected
+        """
+        if maps is None:
+            maps = [m for m in self.maps if not m.pushdown and not m.summary]
+
+        fields = set(["_id"])
+        for map_plan in maps:
+            for col in map_plan.columns:
+                if col.is_static:
+                    continue
+                keys = []
+                for step_type, arg in col.steps:
+                    if step_type != KEY_STEP:
+                        break
+                    keys.append(arg)
+
+                # the whole document is needed if a key can not be used in a projection
+                if len(keys) == 0 or any(k == "" or k.startswith("$") for k in keys):
+                    return None
+                fields.add(".".join(keys))
+
+        # drop any field already covered by a parent field (mongo rejects path collisions)
+        projection = {}
+        for field in sorted(fields):
+            if not any(field.startswith(parent + ".") for parent in projection):
+                projection[field] = 1
+        return projection
+
+    def flatten(self, doc, package_list, add_index=False):
+        """ walks a document once through the shared trie and inserts the
+            resulting rows into the package of every map
+
+            Arguments:
+                doc {dict} -- mongo document to flatten
+                package_list {list of Packages} -- one package per map, in mapping order
+                add_index {bool} -- if true, adds list locations to the id column
+
+            Returns:
+                [bool] -- False if a required column had no data in the document
+        """
+        t1 = time.perf_counter()
+        values = [[] for i in range(self.slot_count)]
+        indexes = [[] for i in range(self.slot_count)] if add_index else values
+        self.root.walk(doc, values, indexes, "", add_index)
+        t2 = time.perf_counter()
+        self.walk_runtime += t2 - t1
+
+        for map_plan, map_slots, pkg in zip(self.maps, self.slots, package_list):
+            if map_slots is None:
+                continue
+            map_values = [values[slot] if slot is not None else None for slot in map_slots]
+            map_indexes = [indexes[slot] if slot is not None else None for slot in map_slots]
+            if not map_plan.insert_values(map_values, map_indexes, pkg, add_index):
+                return False
+            t3 = time.perf_counter()
+            pkg.setup_runtime += t3 - t2
+            t2 = t3
+        return True
+
+
+####################################
+##### --- Static Functions --- #####
+####################################
+
+def parse_mongo_path(mongo_path):
+    """ tokenizes a mongo_path into a tuple of (step type, argument) steps
+
+        Example:
+        grades[all].date  ->  ((KEY_STEP, "grades"), (ALL_STEP, None), (KEY_STEP, "date"))
+    """
+    steps = []
+    for field_name in mongo_path.split("."):
+        if "[" in field_name:
+            path_idx_split = field_name.replace("]", "").split("[")
+            if path_idx_split[0] != "":
+                steps.append((KEY_STEP, path_idx_split[0]))
+            for idx in path_idx_split[1:]:
+                if idx == "all":
+                    steps.append((ALL_STEP, None))
+                else:
+                    try:
+                        steps.append((INDEX_STEP, int(idx)))
+                    except ValueError:
+                        raise ValueError("invalid list index ({}) in mongo_path ({})".format(idx, mongo_path))
+        else:
+            steps.append((KEY_STEP, field_name))
+    return tuple(steps)
+
+def parse_lookup(name, lookup):
+    """ validates the lookup option of a column
+
+        Returns:
+            [tuple] -- (collection, key_path, value_path), key_path defaults to _id
+    """
+    if not isinstance(lookup, dict) or not lookup.get("collection") or not lookup.get("value_path"):
+        raise ValueError("lookup for column ({}) needs a collection and a value_path".format(name))
+    return (lookup["collection"], lookup.get("key_path", "_id"), lookup["value_path"])
+
+def keep_value(mongodata):
+    """ caster for lookup keys, which are matched before being cast """
+    return mongodata
+
+def materialize(raw_doc):
+    """ fully decodes a RawBSONDocument (and any documents inside it) into a dict """
+    return bson.BSON(raw_doc.raw).decode()
+
+def materialize_value(obj):
+    """ decodes the RawBSONDocuments in a value, including the ones inside lists
+        and dicts, values without any are returned unchanged
+    """
+    if type(obj) is RawBSONDocument:
+        return materialize(obj)
+    if isinstance(obj, list):
+        items = [materialize_value(v) for v in obj]
+        return items if any(a is not b for a, b in zip(items, obj)) else obj
+    if isinstance(obj, dict):
+        items = {k : materialize_value(v) for k, v in obj.items()}
+        return items if any(items[k] is not v for k, v in obj.items()) else obj
+    return obj
+
+def insert_rows(package, pulled, pulled_indexes, longest, id_index=-1, add_index=False):
+    """ pads the column lists in pulled to the same length then translates them
+        into rows which are inserted into package
+
+        i.e. pulled = [[0,1,2], ['id'], []] -> [[0,1,2], ['id','id','id'], [None,None,None]]
+    """
+    for r in range(len(pulled)):
+        pull_len = len(pulled[r])
+        if pull_len == longest:
+            continue
+        elif pull_len == 1:
+            pulled[r] = [pulled[r][0] for i in range(longest)]
+        elif 1 < pull_len < longest:
+            pulled[r] += [None for i in range(pull_len, longest)]
+
+        # catch the case where an array has no content
+        else:
+            pulled[r] = [None for i in range(longest)]
+
+    for idx in range(longest):
+        tup = [rec[idx] for rec in pulled]
+
+        # add index to ID for back tracing data location when saving from excel
+        if add_index and id_index != -1:
+            index_tup = []
+            for rec in pulled_indexes:
+                try:
+                    if rec[0][-1] != ":":
+                        index_tup.append(rec[idx])
+                except IndexError:
+                    pass
+            tup[id_index] += "|"+"|".join(index_tup)
+        package.insert_data(tup)
+
+def cast_to_target_type(mongodata, target_type=""):
+    """ takes any point of single element data and attempts
+    to convert it to the proper type to be inserted into sql.
+    """
+    try:
+        return TypeRegistry.get_caster(target_type)(mongodata)
+    except Exception:
+        return None
@@ -2,23 +2,261 @@
 Manages all mongodb connection and query operations
 """
 import time
-import datetime
+import multiprocessing
+import threading
 import xml.etree.ElementTree as etree
-from pymongo import MongoClient, errors
-from pymongo.collection import ReturnDocument
+from pymongo import MongoClient, UpdateOne, errors
 import pymongo
 from BeetleETL.Handlers import Package as PKG
+from BeetleETL.Handlers import Cache
+from BeetleETL.Handlers import ConnectionPool
+from BeetleETL.Handlers import MappingPlan
+from BeetleETL.Handlers import ColumnarEngine
+from BeetleETL.Handlers import FilterTemplate
+from BeetleETL.Handlers import TypeRegistry
+# re-exported, the sql type lists were defined here before moving to FilterTemplate
+from BeetleETL.Handlers.FilterTemplate import STRINGS, NONSTRINGS
+from BeetleETL.Handlers.MappingPlan import cast_to_target_type
 from collections import OrderedDict
 from bson.objectid import ObjectId
+from bson import json_util
+from bson.codec_options import CodecOptions
+from bson.raw_bson import RawBSONDocument
 import logging
 import json
+import base64
+import copy
+import hashlib
+import numpy as np
 import pandas as pd
 
-# parameter types from interject
-STRINGS = ["VARCHAR", "VARCHARMAX", "TEXT", "NCHAR", "NTEXT",\
-            "NVARCHAR", "NVARCHARMAX", "CHAR"]
-NONSTRINGS = ["INT", "BIGINT", "SMALLINT", "SMALLMONEY", "TINYINT", "FLOAT",\
-            "MONEY", "DATETIME", "DATE", "SMALLDATETIME", "BIT", "REAL"]
+# characters or bytes of interject xml parsed at a time
+XML_CHUNK_SIZE = 1 << 20
+
+# python types saved interject values are cast to, by mongoUpdateType
+UPDATE_TYPES = {"str" : str, "int" : int, "float" : float}
+
+# most keys sent in one $in query when resolving lookup columns
+LOOKUP_BATCH_SIZE = 1000
+
+# documents flattened per page by pull_page when "pageSize" is not set
+PAGE_SIZE = 1000
+
+# most pull results kept per collection when "resultCacheTTLSec" is set
+RESULT_CACHE_SIZE = 100
+
+# seconds before a pull watches a collection again after its change stream failed
+RESULT_CACHE_WATCH_RETRY_SEC = 300
+
+# data keys holding where the last pull stopped
+WATERMARK_KEYS = ("lastMongoIdPulled", "lastModifiedPulled", "lastModifiedIdPulled")
+
+
+class PullResult():
+    """ outcome of a single MongoHandler.pull, kept off the handler so one
+        handler can serve concurrent pulls
+    """
+
+    def __init__(self, packages, docs_pulled=0, watermarks=None, backlog_remaining=False):
+        self.packages = packages                    # list of Packages, one per map
+        self.docs_pulled = docs_pulled              # number of documents flattened
+        self.watermarks = watermarks or {}          # config["data"] values to save once the packages are committed
+        self.backlog_remaining = backlog_remaining  # stopped at numDocsToPull with more documents left
+
+    def copy(self):
+        """ returns a copy whose packages and rows can be changed without changing this result """
+        packages = []
+        for pkg in self.packages:
+            pkg_copy = copy.copy(pkg)
+            pkg_copy.data = [list(row) for row in pkg.data]
+            packages.append(pkg_copy)
+        return PullResult(packages, self.docs_pulled, dict(self.watermarks), self.backlog_remaining)
+
+
+class PageResult():
+    """ outcome of MongoHandler.pull_page """
+
+    def __init__(self, packages, docs_pulled=0, next_token=None):
+        self.packages = packages            # list of Packages with the rows of the page
+        self.docs_pulled = docs_pulled      # number of documents flattened
+        self.next_token = next_token        # token of the following page, None after the last page
+
+
+class PreviewResult():
+    """ outcome of MongoHandler.preview, rows of a few sampled documents and
+        stats on every column of every map
+    """
+
+    def __init__(self, packages, docs_sampled=0, stats=None):
+        self.packages = packages            # list of Packages, one per map
+        self.docs_sampled = docs_sampled    # number of documents flattened
+        self.stats = stats or []            # per map, column name -> count, nulls, distinct and types
+
+    def to_dataframes(self):
+        """ returns a DataFrame of rows for each map """
+        return [pd.DataFrame(pkg.data, columns=pkg.col_names) for pkg in self.packages]
+
+
+class LookupResolver():
+    """ fills the lookup columns of rows added to packages with values from related
+        collections, keys are resolved through per lookup TTLCaches and the rest
+        are fetched with one $in query per lookup for each batch
+
+        Arguments:
+            db {Database} -- database holding the related collections
+            mapping_plan {MappingPlan} -- compiled mapping with lookup columns
+            caches {dict} -- (collection, key_path, value_path) -> TTLCache
+    """
+
+    def __init__(self, db, mapping_plan, caches):
+        self.db = db
+        self.caches = caches
+        self.columns = []   # (map index, column index, ColumnPlan) of every lookup column
+        self.stats = {}     # lookup -> [cache hits, misses, queries] since the resolver was made
+        for map_idx in range(len(mapping_plan.maps)):
+            map_plan = mapping_plan.maps[map_idx]
+            for col_idx in map_plan.lookup_columns:
+                col = map_plan.columns[col_idx]
+                self.columns.append((map_idx, col_idx, col))
+                self.stats[col.lookup] = [0, 0, 0]
+
+    def enrich(self, package_list, row_starts):
+        """ replaces the keys in the lookup columns of every row added since row_starts
+
+            Returns:
+                [bool] -- False if a related collection could not be queried
+        """
+        # gather the keys of every column sharing a lookup so it is queried once
+        pending = {}
+        for map_idx, col_idx, col in self.columns:
+            keys = pending.setdefault(col.lookup, set())
+            for row in package_list[map_idx].data[row_starts[map_idx]:]:
+                try:
+                    if row[col_idx] is not None:
+                        keys.add(row[col_idx])
+                except TypeError:
+                    pass    # lists and documents can not be looked up
+
+        resolved = {}
+        for lookup, keys in pending.items():
+            resolved[lookup] = self.resolve(lookup, keys)
+            if resolved[lookup] is None:
+                return False
+
+        for map_idx, col_idx, col in self.columns:
+            values = resolved[col.lookup]
+            rows = package_list[map_idx].data
+            for r in range(row_starts[map_idx], len(rows)):
+                try:
+                    value = values.get(rows[r][col_idx])
+                except TypeError:
+                    value = None
+                rows[r][col_idx] = col.value_caster(value) if value is not None else None
+        return True
+
+    def resolve(self, lookup, keys):
+        """ returns key -> value for keys, from the cache or the related collection
+
+            Returns:
+                [dict] -- value of each key, None for keys with no related document
+                [None] -- if the related collection could not be queried
+        """
+        collection_name, key_path, value_path = lookup
+        stats = self.stats[lookup]
+        found, missing = self.caches[lookup].get_many(keys)
+        stats[0] += len(found)
+        stats[1] += len(missing)
+        if len(missing) == 0:
+            return found
+
+        fetched = {}
+        projection = add_projection_field({key_path : 1}, value_path)
+        try:
+            for start in range(0, len(missing), LOOKUP_BATCH_SIZE):
+                stats[2] += 1
+                cur = self.db[collection_name].find({key_path : {"$in" : missing[start:start + LOOKUP_BATCH_SIZE]}}, projection)
+                for doc in cur:
+                    key = get_field(doc, key_path)
+                    try:
+                        fetched.setdefault(key, get_field(doc, value_path))
+                    except TypeError:
+                        pass
+        except errors.PyMongoError as err:
+            logging.error("could not look up {} in {}\n -> {}".format(value_path, collection_name, err))
+            return None
+
+        # keys without a related document are cached as None so they are not queried again
+        values = {key : fetched.get(key) for key in missing}
+        self.caches[lookup].put_many(values)
+        found.update(values)
+        return found
+
+    def log_stats(self):
+        for (collection_name, key_path, value_path), (hits, misses, queries) in self.stats.items():
+            logging.info("  -> lookup {}.{} by {}: {} cache hits, {} misses, {} queries".format(
+                collection_name, value_path, key_path, hits, misses, queries))
+
+
+class XMLColumnBuffer():
+    """ xml parser target collecting interject rows into per column lists
+
+        headers are the "c" elements under the root and rows the "r" elements,
+        the first cell of a row is its Row id and the rest are data columns
+    """
+
+    def __init__(self):
+        self.column_names = []  # column names for data, Row first
+        self.columns = []       # buffered values of each data column
+        self.row_ids = []       # Row value of every row, for save messages
+        self.depth = 0
+        self.cell = 0           # position of the current cell in its row, -1 outside of rows
+        self.text = None        # text parts of the current cell while it is being read
+
+    def start(self, tag, attrib):
+        self.depth += 1
+        if self.depth == 2:
+            self.cell = -1
+            if tag == "r":
+                self.cell = 0
+            elif tag == "c":
+                self.column_names.append(attrib['Column'])
+        elif self.depth == 3 and self.cell >= 0:
+            self.text = []
+        elif self.depth == 4 and self.text is not None:
+            # like Element.text only the text ahead of a nested element is kept
+            self.add_cell()
+
+    def data(self, data):
+        if self.text is not None:
+            self.text.append(data)
+
+    def end(self, tag):
+        if self.depth == 3 and self.text is not None:
+            self.add_cell()
+        elif self.depth == 2 and self.cell >= 0:
+            # pad columns the row had no cell for
+            if self.cell == 0:
+                self.row_ids.append(None)
+            for i in range(max(self.cell - 1, 0), len(self.columns)):
+                self.columns[i].append(None)
+            self.cell = -1
+        self.depth -= 1
+
+    def add_cell(self):
+        value = "".join(self.text) if len(self.text) > 0 else None
+        self.text = None
+        if self.cell == 0:
+            self.row_ids.append(value)
+        else:
+            i = self.cell - 1
+            if i == len(self.columns):
+                self.columns.append([None] * (len(self.row_ids) - 1))
+            self.columns[i].append(value)
+        self.cell += 1
+
+    def close(self):
+        return self
+
 
 class MongoHandler():
     """ class to handle all interactions with a mongo database, these include
@@ -31,59 +269,86 @@ class MongoHandler():
         self.client = None
         self.mongo_filter = {}
         self.last_id_pulled = None
-
-        # setup mongo filter if it exists in the config file
-        if "mongoFilter" in self.config:
-            filter_dict = {}
-            for filter_alias in self.config['mongoFilter']:
-                
-                # get mongo search query from mongotsql config
-                new_query = self.get_mongo_search_query(
-                    alias=filter_alias, 
-                    input_value=None,
-                    cast_to=None
-                    )
-
+        self.mapping_plan = None        # compiled accessors for config["mapping"]
+        self._mapping_plan_key = None   # serialized mapping the plan was compiled from
+        self._mapping_plan_lock = threading.Lock()
+        self.backlog_remaining = False  # last pull stopped at numDocsToPull with more new documents left
+        self.lookup_caches = {}         # (collection, key_path, value_path) -> Cache.TTLCache shared by pulls
+        self._lookup_caches_lock = threading.Lock()
+
+        # compile mongo filter templates once, filters without an INPUT_VALUE make up
+        # the default filter and the rest are bound per Interject request
+        self.filter_templates = FilterTemplate.compile_filters(self.config.get("mongoFilter", {})) \
+            if isinstance(self.config, dict) else {}
+        filter_dict = {}
+        for template in self.filter_templates.values():
+            if not template.has_input:
                 # use a deepmerge method to combine the filter dictionary with incoming filter
                 # changes (NOTE: this is needed for mongo data embedded in the same object)
-                deepmerge_dicts(filter_dict, new_query)
-
-            self.mongo_filter = filter_dict
+                deepmerge_dicts(filter_dict, template.bind())
+        self.mongo_filter = filter_dict
 
     def setup_connection(self):
-        """ Sets up a new connection to a mongo database
+        """ Sets up a connection to a mongo database on the handler (see get_client)
         """
-        
-        uri = ""
+        self.client = self.get_client()
+        return self.client is not None
 
-        if 'customMongoURI' in self.config['connectionInfo'] and self.config['connectionInfo']['customMongoURI'] != "":
-            uri =  self.config['connectionInfo']['customMongoURI']
-            logging.info("using custom mongo uri")
+    def close_connection(self):
+        """ closes the mongodb client connection set up on the handler
+        """
+        if self.client is not None:
+            self.release_client(self.client)
+            self.client = None
+            return True
         else:
-            uri = self._build_uri()
-            logging.info("using assembled mongo uri")
-        
+            logging.warning("Cannot close mongo client: client is None")
+            return False
+
+    def get_client(self):
+        """ returns a mongo client for the configured uri, reusing the process-wide
+            pooled client unless "poolConnections" is false, the client is not kept
+            on the handler so concurrent calls can each hold their own
+
+            Returns:
+                [MongoClient] -- client to hand back with release_client
+                [None] -- if the client could not be set up
+        """
+        uri = self.get_uri()
         logging.info('Attempting to establish connection to Mongo database')
         try:
-            self.client = MongoClient(uri)
+            if self.config.get("poolConnections", True):
+                client = ConnectionPool.mongo_clients.acquire(uri, lambda: MongoClient(uri),
+                    idle_sec=self.config.get("connectionIdleSec", ConnectionPool.IDLE_SEC))
+            else:
+                client = MongoClient(uri)
             logging.info('Successfully setup client cursor')
-            return True
+            return client
         except errors.InvalidURI as err:
             logging.error('Could not setup mongo client: invalid mongo uri (you may not be using pymongo 3.6, found pymongo {})\n -> {}'.format(pymongo.__version__, err))
-            return False
+            return None
         except Exception as err:
             logging.error('Could not setup mongo client\n -> {}'.format(err))
-            return False
+            return None
 
-    def close_connection(self):
-        """ closes a mongodb client connection
+    def release_client(self, client):
+        """ hands a client from get_client back to the pool, or closes it when
+            connections are not pooled
         """
-        if self.client is not None:
-            self.client.close()
-            return True
+        if self.config.get("poolConnections", True):
+            ConnectionPool.mongo_clients.release(client)
         else:
-            logging.warning("Cannot close mongo client: client is None")
-            return False
+            client.close()
+
+    def get_uri(self):
+        """ returns the customMongoURI if one is set, otherwise the uri assembled
+            from the connectionInfo
+        """
+        if 'customMongoURI' in self.config['connectionInfo'] and self.config['connectionInfo']['customMongoURI'] != "":
+            logging.info("using custom mongo uri")
+            return self.config['connectionInfo']['customMongoURI']
+        logging.info("using assembled mongo uri")
+        return self._build_uri()
 
     def _build_uri(self):
         """ builds a valid mongodb uri which can be used to setup a client connection
@@ -118,192 +383,632 @@ class MongoHandler():
         """ gets the number of documents in a collection based on the mongo system info """
 
         # setup connection
-        if self.setup_connection() == False:
+        client = self.get_client()
+        if client is None:
             logging.error("Invalid MonoClient login, returning")
             return []
         
         # setup cursor
         _db = self.config["connectionInfo"]["mongoDatabase"]
-        db = self.client[_db]
+        db = client[_db]
         collection = db[self.config["connectionInfo"]["mongoCollection"]]
-        
-        return collection.count()
+        try:
+            return collection.count()
+        finally:
+            self.release_client(client)
 
 
     def pull_collection(self, query_filter={}, add_index=False):
-        """ pulls data from a collection then assembles packages for the pull
+        """ pulls data from a collection then assembles packages for the pull,
+            the watermarks in config["data"] are moved past the documents pulled
             
             Arguments:
                 filter {dict} -- the query to use when pulling from mongo
                 add_index {bool} -- if true, adds the index of the row in 
                                     the package data, to the row
         """
-
-        # setup connection to mongodb and get collection
-        if self.setup_connection() == False:
-            logging.error("Invalid MonoClient login, returning")
+        self.backlog_remaining = False
+        result = self.pull(query_filter, add_index)
+        if result is None:
             return []
 
-        logging.info('Pulling data from Mongo')
+        # update last pulled document id from mongo
+        # if no documents were pulled return an empty list so sqlhandler will not insert any
+        self.config['data'].update(result.watermarks)
+        self.backlog_remaining = result.backlog_remaining
+        return result.packages
 
-        _db = self.config["connectionInfo"]["mongoDatabase"]
-        db = self.client[_db]
-        collection = db[self.config["connectionInfo"]["mongoCollection"]]
+    def pull(self, query_filter={}, add_index=False, data=None):
+        """ pulls data from a collection then assembles packages for the pull
+            without changing the handler or its config, so one handler can serve
+            concurrent pulls from many threads
 
-        # setup a cursor object with the specified options to:
-        #   -> find all docs and sort by most recently added docs
-        # NOTE: this ensures only the most recently added docs are pulled
-        cur = collection.find(query_filter).sort("$natural", -1)
+            Arguments:
+                filter {dict} -- the query to use when pulling from mongo
+                add_index {bool} -- if true, adds the index of the row in 
+                                    the package data, to the row
+                data {dict} -- watermarks to pull after, defaults to config["data"]
 
-        # get the most recently added document from the mongo database 
-        try:
-            newest_pulled_id = str(cur[0]["_id"])
-        except Exception as err:
-            logging.error("bad connection to mongo\n -> " + str(err))
-            return []
+            Returns:
+                [PullResult] -- packages and the watermarks to save once they are committed
+                [None] -- if the pull failed
+        """
+        if data is None:
+            data = self.config['data']
+
+        # repeated pulls with the same config, filter and watermarks are served from
+        # the result cache while "resultCacheTTLSec" is set
+        cache = self.get_result_cache()
+        if cache is not None:
+            key = self.result_cache_key(query_filter, add_index, data)
+            cached = cache.get(key)
+            if cached is not None:
+                logging.info("Using cached pull of {} documents from Mongo".format(cached.docs_pulled))
+                return cached.copy()
 
-        # setup packages to insert data into
-        package_list = self.build_packages(self.config)
+        # setup connection to mongodb and get collection
+        client = self.get_client()
+        if client is None:
+            logging.error("Invalid MonoClient login, returning")
+            return None
 
-        # for each document pulled add to packages
-        docs_pulled = 0
-        
-        for doc in cur:
+        try:
+            result = self._pull(client, query_filter, add_index, data)
+        finally:
+            self.release_client(client)
 
-            # check current document id with the last pulled id
-            # break when they are the same
-            if 'pullOnlyNew' in self.config['data'] and self.config['data']['pullOnlyNew']:
-                if str(doc["_id"]) == self.config['data']['lastMongoIdPulled']:
-                    break
+        if cache is not None and result is not None:
+            cache.put(key, result.copy())
+        return result
 
-            docs_pulled += 1
-            # iterate over maps 
-            map_i = 0
-            for maps in self.config["mapping"]:
-                
-                t1 = time.clock()
-                # iterate over sql_cols in maps
-                pulled = []
-                pulled_indexes = []
-                longest = 0
-                id_index = -1
-                sql_cols_index = 0
-                for key, val in maps["sql_cols"].items():
-                    
-                    # first check if the column should be a static value or data
-                    # from a mongo document
-                    if 'static_val' in val:
-                        pulled.append( [val['static_val']] )
-
-                    elif 'mongo_path' in val:
-                        # check for objectid as a valid field
-                        if '_id' == val['mongo_path']:
-                            id_index = sql_cols_index
-
-                        # first get the values from mongo
-                        spl = val["mongo_path"].split(".")
-                        
-                        # if target type exists, parse it out
-                        target_type = ""
-                        if "target_type" in val:
-                            target_type = val['target_type']
+    def _pull(self, client, query_filter, add_index, data):
+        """ runs a pull for MongoHandler.pull with a client it has set up """
+        logging.info('Pulling data from Mongo')
 
-                        if "valid_types" in dict(val):
-                            valid_types = val['valid_types']
-                        else:
-                            valid_types = ["none"]
-
-                        # recurse through mongo doc to find data and track the index of data
-                        # if it exists in a list
-                        res = []
-                        index_res = []
-                        self.get_val_from_dict(doc, spl, res, valid_types, target_type, index_res)
-
-                        # Optimization: only build index res if the mongo_path is a list
-                        if '[all]' in val["mongo_path"]:    
-                            index_res = ["{}::{}".format(key, i) for i in index_res]
-                            pulled_indexes.append(index_res)
-
-                        # if this field has the required option and none is the only data point
-                        # returned, then stop entire mapping
-                        if 'required' in val and val['required'] == True:
-                            if res == [None for i in res]:
-                                logging.error( 'Found a missing required key ({}) in mongo scrapping packages'.format(key) )
-                                return []
-
-                        res_ln = len(res)
-                        if res_ln > longest:
-                            longest = res_ln
-
-                        # then add values to temp data
-                        pulled.append(res)
-
-                    sql_cols_index += 1
-       
-                # ensure each list in pulled have the same length
-                # i.e. pulled = [[0,1,2], ['id'], []] -> translate -> [[0,1,2], ['id','id','id'], [None,None,None]]
-                for r in range(len(pulled)):
-                    pull_len = len(pulled[r])
-                    if pull_len == longest:
-                        continue
-                    elif pull_len == 1:
-                        pulled[r] = [pulled[r][0] for i in range(longest)]
-                    elif 1 < pull_len < longest:
-                        pulled[r] += [None for i in range(pull_len, longest)]
-
-                    # catch the case where an array has no content
-                    else:
-                        pulled[r] = [None for i in range(longest)]
-
-                # insert data into package
-                # translate the data matrix
-                # TODO catch return from insert data
-                try:
-                    for idx in range(longest):
-                        tup = [rec[idx] for rec in pulled]
-   
-                        # add index to ID for back tracing data location when saving from excel
-                        if add_index and id_index != -1:
-                            # build return path for data
-                            index_tup = []
-                            
-                            for rec in pulled_indexes:
-                                try:
-                                    
-                                    if rec[0][-1] != ":":
-                                        index_tup.append(rec[idx])
-                                except:
-                                    pass
-                            tup[id_index] += "|"+"|".join(index_tup)
-                        package_list[map_i].insert_data(tup)
-                        t2 = time.clock()
-                        package_list[map_i].setup_runtime += (t2-t1)
-                except Exception as err:
-                    logging.error('longest = {},\npulled = {}\n\n -> {}'.format(longest, pulled, err))
-                    return []
-                map_i += 1
-
-        # close mongo query cursor
-        cur.close()
+        collection = self.get_pull_collection(client)
+
+        # compile (or reuse) the accessor plans for each map in the mapping
+        try:
+            mapping_plan = self.get_mapping_plan()
+        except Exception as err:
+            logging.error("Could not compile mapping\n -> {}".format(err))
+            return None
+
+        # only request the fields the mapping reads from the server
+        projection = self.get_projection(mapping_plan)
+
+        # when pulling modified documents, read them in (modifiedField, _id) order
+        # starting after the last one pulled so updated documents are picked up
+        modified_field = data.get('modifiedField', '')
+        sort_fields = ("_id",)
+        if modified_field:
+            sort_fields = (modified_field, "_id")
+            projection = add_projection_field(projection, modified_field)
+            last_modified = from_config_value(data.get('lastModifiedPulled'))
+            last_modified_id = from_config_value(data.get('lastModifiedIdPulled'))
+            if last_modified is not None and last_modified_id is not None:
+                query_filter = and_filters(query_filter, keyset_filter(sort_fields, (last_modified, last_modified_id)))
+            elif last_modified is not None:
+                query_filter = and_filters(query_filter, {modified_field : {"$gt" : last_modified}})
+            logging.info("Pulling documents with {} after {}".format(modified_field, last_modified))
+
+        # when only pulling new documents, start after the last pulled id so
+        # the _id index is used and only new documents are scanned
+        pull_only_new = 'pullOnlyNew' in data and data['pullOnlyNew']
+
+        # a summary of only the new documents would replace the totals with partial ones
+        if (pull_only_new or modified_field) and any(map_plan.summary for map_plan in mapping_plan.maps):
+            logging.error("Summary maps (aggregate) can not be pulled with pullOnlyNew or modifiedField, "
+                "they would only group the new documents")
+            return None
+
+        last_pulled = from_id_watermark(data.get('lastMongoIdPulled', ''))
+        if not modified_field and pull_only_new and last_pulled is not None:
+            query_filter = and_filters(query_filter, {"_id" : {"$gt" : last_pulled}})
+            logging.info("Pulling documents with _id greater than {}".format(last_pulled))
+
+        # cap the run at numDocsToPull documents, the rest of the backlog is
+        # pulled by the following runs once this chunk's watermark is saved, a
+        # full refresh has no watermark to move past the chunk so it is not capped
+        limit = self.config.get("numDocsToPull", 0) or 0
+        if limit > 0 and not (pull_only_new or modified_field):
+            logging.info("numDocsToPull is ignored without pullOnlyNew or modifiedField, pulling every matching document")
+            limit = 0
+
+        # setup packages to insert data into, the plan is shared with other pulls
+        # so only the walk time added during this pull is logged
+        package_list = mapping_plan.build_packages()
+        walk_start = mapping_plan.walk_runtime
+        lookups = self.get_lookup_resolver(collection, mapping_plan)
+
+        workers = self.config.get("parallelWorkers", 1)
+        if modified_field and workers is not None and workers > 1:
+            logging.info("parallelWorkers is ignored when pulling by {}, _id partitions do not follow its order".format(modified_field))
+            workers = 1
+        if workers is not None and workers > 1 and not TypeRegistry.is_picklable():
+            logging.info("parallelWorkers is ignored, the registered casters or valid types can not be pickled "
+                "for the worker processes (register module level functions to pull in parallel)")
+            workers = 1
+        if not mapping_plan.needs_documents():
+            # every map is run by the server so only the count and last key are read
+            result = pull_last_key(collection, query_filter, sort_fields, limit)
+            if result is not None and result[1] is not None and not pull_pushdown_maps(collection,
+                    mapping_plan, query_filter, package_list, add_index,
+                    keyset_filter(sort_fields, result[1], "$lte"), projection is not None, lookups):
+                result = None
+        elif workers is not None and workers > 1:
+            # split the collection into _id ranges flattened by separate processes,
+            # bounding the ranges at the last _id of the capped run
+            if limit > 0:
+                query_filter = limit_filter(collection, query_filter, limit)
+            result = self.pull_partitions(collection, query_filter, projection, add_index, workers, package_list)
+            if result is not None:
+                result = (result[0], (result[1],) if result[1] is not None else None)
+        else:
+            # read the documents in sort_fields order so the last document pulled is
+            # always the newest and a failed cursor can be reopened after it
+            result = pull_query(collection, query_filter, projection, mapping_plan,
+                package_list, add_index, limit, self.config, sort_fields, lookups)
+
+            # let the server unwind the lists of maps using array_mode pushdown
+            if result is not None and result[1] is not None and not pull_pushdown_maps(collection,
+                    mapping_plan, query_filter, package_list, add_index,
+                    keyset_filter(sort_fields, result[1], "$lte"), projection is not None, lookups):
+                result = None
+
+        # group summary maps on the server over the same documents
+        if result is not None and result[1] is not None and not pull_summary_maps(collection,
+                mapping_plan, query_filter, package_list, keyset_filter(sort_fields, result[1], "$lte")):
+            result = None
+
+        if result is None:
+            return None
+        docs_pulled, last_key = result
 
         # log stats on data pulled and packages made
-        db = self.config["connectionInfo"]["mongoDatabase"]
-        collection = self.config["connectionInfo"]["mongoCollection"]
         logging.info('Successfully pulled {} documents from Mongo:'.format(docs_pulled))
+        logging.info('  -> walking documents took {} sec'.format(round(mapping_plan.walk_runtime - walk_start, 3)))
         for pkg in package_list:
             logging.info('  -> {} records took {} sec for map destination: {} '.format(\
                 len(pkg.data), \
                 round(pkg.setup_runtime,3), \
                 pkg.dest))
+        if lookups is not None:
+            lookups.log_stats()
 
-        # update last pulled document id from mongo and close connection to mongodb
-        # if no documents were pulled return an empty list so sqlhandler will not insert any
-        self.close_connection()
-        if docs_pulled > 0:
-            self.config['data']['lastMongoIdPulled'] = newest_pulled_id
-            return package_list          
+        watermarks = {}
+        if docs_pulled > 0 and modified_field:
+            watermarks = get_modified_watermarks(modified_field, last_key)
+        elif docs_pulled > 0:
+            watermarks = {'lastMongoIdPulled' : to_config_value(last_key[-1])}
+
+        backlog_remaining = limit > 0 and docs_pulled >= limit
+        if backlog_remaining:
+            logging.info("Pulled the numDocsToPull limit of {} documents, more new documents remain".format(limit))
+        return PullResult(package_list, docs_pulled, watermarks, backlog_remaining)
+
+    def pull_page(self, query_filter={}, page_token=None, page_size=None, add_index=False, sort_fields=("_id",)):
+        """ flattens one page of the documents matching query_filter, read in
+            sort_fields order after the document a page token was made from, so
+            a large pull can be returned in pages without holding every row
+
+            Arguments:
+                query_filter {dict} -- the query to use, the same for every page
+                page_token {string} -- next_token of the previous page or a token from
+                                       plan_pages, None for the first page
+                page_size {int} -- most documents in the page, defaults to "pageSize"
+                sort_fields {tuple} -- fields the pages are ordered by, ending with _id
+
+            Returns:
+                [PageResult] -- packages of the page and the token of the next page
+                [None] -- if the token is invalid or the pull failed
+        """
+        if page_size is None:
+            page_size = self.config.get("pageSize", PAGE_SIZE)
+        try:
+            last_key = decode_page_token(page_token, sort_fields)
+        except ValueError as err:
+            logging.error("invalid page token ({})\n -> {}".format(page_token, err))
+            return None
+
+        client = self.get_client()
+        if client is None:
+            logging.error("Invalid MonoClient login, returning")
+            return None
+
+        try:
+            collection = self.get_pull_collection(client)
+            try:
+                mapping_plan = self.get_mapping_plan()
+            except Exception as err:
+                logging.error("Could not compile mapping\n -> {}".format(err))
+                return None
+
+            projection = self.get_projection(mapping_plan)
+            for field in sort_fields:
+                projection = add_projection_field(projection, field)
+            if last_key is not None:
+                query_filter = and_filters(query_filter, keyset_filter(sort_fields, last_key))
+            package_list = mapping_plan.build_packages()
+            lookups = self.get_lookup_resolver(collection, mapping_plan)
+
+            if not mapping_plan.needs_documents():
+                result = pull_last_key(collection, query_filter, sort_fields, page_size)
+            else:
+                result = pull_query(collection, query_filter, projection, mapping_plan,
+                    package_list, add_index, page_size, self.config, sort_fields, lookups)
+
+            # server side maps cover the documents of this page only
+            if result is not None and result[1] is not None:
+                upper_bound = keyset_filter(sort_fields, result[1], "$lte")
+                if not pull_pushdown_maps(collection, mapping_plan, query_filter, package_list,
+                        add_index, upper_bound, projection is not None, lookups) or \
+                    not pull_summary_maps(collection, mapping_plan, query_filter, package_list, upper_bound):
+                    result = None
+        finally:
+            self.release_client(client)
+
+        if result is None:
+            return None
+        docs_pulled, last_key = result
+
+        # a full page may be followed by more documents
+        next_token = None
+        if docs_pulled >= page_size and last_key is not None:
+            next_token = encode_page_token(sort_fields, last_key)
+        logging.info("Pulled a page of {} documents from Mongo, {}".format(
+            docs_pulled, "more pages remain" if next_token else "this is the last page"))
+        return PageResult(package_list, docs_pulled, next_token)
+
+    def plan_pages(self, query_filter={}, page_size=None):
+        """ reads the _id of every document matching query_filter from the _id
+            index and returns a page token for the start of every page, so the
+            pages can be fetched in parallel with pull_page
+
+            Returns:
+                [list] -- page tokens in _id order, the first is None
+                [None] -- if the _ids could not be read
+        """
+        if page_size is None:
+            page_size = self.config.get("pageSize", PAGE_SIZE)
+
+        client = self.get_client()
+        if client is None:
+            logging.error("Invalid MonoClient login, returning")
+            return None
+
+        tokens = [None]
+        docs = 0
+        try:
+            collection = self.get_pull_collection(client)
+            cur = collection.find(query_filter, {"_id" : 1}).sort("_id", pymongo.ASCENDING)
+            for doc in cur:
+                docs += 1
+                if docs % page_size == 0:
+                    tokens.append(encode_page_token(("_id",), (doc["_id"],)))
+        except errors.PyMongoError as err:
+            logging.error("could not plan pages\n -> {}".format(err))
+            return None
+        finally:
+            self.release_client(client)
+
+        # the token after the last document would start an empty page
+        if docs > 0 and docs % page_size == 0:
+            tokens.pop()
+        logging.info("Planned {} page(s) of {} documents".format(len(tokens), page_size))
+        return tokens
+
+    def preview(self, query_filter={}, size=100, sample=True):
+        """ flattens a few documents through the mapping to check it, the config
+            and its watermarks are never changed
+
+            Arguments:
+                query_filter {dict} -- the query documents are previewed from
+                size {int} -- number of documents to preview
+                sample {bool} -- if true, picks random documents with $sample when there
+                                 is no query_filter, otherwise the first matching documents
+                                 in natural order, which is not random and is biased
+                                 towards the oldest documents, if false the newest
+                                 documents are read from the _id index
+
+            Returns:
+                [PreviewResult] -- packages and per column stats
+                [None] -- if the preview failed
+        """
+        client = self.get_client()
+        if client is None:
+            logging.error("Invalid MonoClient login, returning")
+            return None
+
+        t1 = time.perf_counter()
+        try:
+            collection = self.get_pull_collection(client)
+            try:
+                mapping_plan = self.get_mapping_plan()
+            except Exception as err:
+                logging.error("Could not compile mapping\n -> {}".format(err))
+                return None
+            projection = mapping_plan.build_projection() if self.config.get("useProjection", True) else None
+            package_list = mapping_plan.build_packages()
+            lookups = self.get_lookup_resolver(collection, mapping_plan)
+
+            # only a $sample stage at the start of a pipeline reads random documents
+            # without scanning the collection, a $match in front of it makes the
+            # server sort every matching document, so filtered previews stop at
+            # the first documents found instead
+            if sample and not query_filter:
+                pipeline = [{"$sample" : {"size" : size}}]
+                if projection is not None:
+                    pipeline.append({"$project" : projection})
+                docs = list(collection.aggregate(pipeline, allowDiskUse=True))
+            elif sample:
+                docs = list(collection.find(query_filter, projection).limit(size))
+            else:
+                docs = list(collection.find(query_filter, projection).sort("_id", pymongo.DESCENDING).limit(size))
+
+            result = flatten_cursor(docs, mapping_plan, package_list, False, max(size, 1), lookups)
+            ids_filter = {"_id" : {"$in" : [doc["_id"] for doc in docs]}}
+            if result is None or \
+                not pull_pushdown_maps(collection, mapping_plan, query_filter, package_list,
+                    False, ids_filter, projection is not None, lookups) or \
+                not pull_summary_maps(collection, mapping_plan, query_filter, package_list, ids_filter):
+                return None
+        except errors.PyMongoError as err:
+            logging.error("could not preview documents\n -> {}".format(err))
+            return None
+        finally:
+            self.release_client(client)
+
+        stats = [column_stats(pkg) for pkg in package_list]
+        logging.info("Previewed {} document(s) in {} sec".format(len(docs), round(time.perf_counter() - t1, 3)))
+        for pkg, pkg_stats in zip(package_list, stats):
+            logging.info("  -> {} preview rows for map destination: {}".format(len(pkg.data), pkg.dest))
+            for name, col_stats in pkg_stats.items():
+                logging.info("    -> {}: {} values, {} nulls, {} distinct, types {}".format(
+                    name, col_stats["count"], col_stats["nulls"], col_stats["distinct"], col_stats["types"]))
+        return PreviewResult(package_list, len(docs), stats)
+
+    def pull_partitions(self, collection, query_filter, projection, add_index, workers, package_list):
+        """ splits the documents matching query_filter into _id ranges and
+            flattens each range in a separate process with its own client,
+            the packages from each range are merged into package_list
+
+            Returns:
+                [tuple] -- (number of documents pulled, last _id pulled)
+                [None] -- if any partition failed
+        """
+        bounds = get_partition_bounds(collection, query_filter, workers)
+        logging.info("Pulling {} partition(s) with {} worker process(es)".format(len(bounds), workers))
+
+        # spawned workers only have the default casters so the registered ones are sent along
+        registry = TypeRegistry.snapshot()
+        tasks = [(self.config, and_filters(query_filter, bound), projection, add_index, registry) for bound in bounds]
+        context = multiprocessing.get_context("spawn")
+        with context.Pool(min(workers, len(tasks))) as pool:
+            results = pool.map(pull_partition, tasks)
+        return merge_partitions(results, package_list)
+
+    def watch_collection(self, resume_token=None, batch_size=500, max_wait_sec=5):
+        """ subscribes to a change stream on the collection and flattens inserted,
+            updated and replaced documents into micro-batches of packages
+
+            Arguments:
+                resume_token {dict} -- token to resume the change stream after
+                batch_size {int} -- number of documents to flatten before yielding a batch
+                max_wait_sec {float} -- yield a partial batch once its oldest document is this old
+
+            Yields:
+                [tuple] -- (list of Packages, resume token after the last change in the batch)
+        """
+        mapping_plan = self.get_mapping_plan()
+        if any(map_plan.pushdown for map_plan in mapping_plan.maps):
+            logging.error("maps using array_mode pushdown can not be streamed, use array_mode client")
+            return
+        # a batch of changed documents would replace the totals with partial ones
+        if any(map_plan.summary for map_plan in mapping_plan.maps):
+            logging.error("Summary maps (aggregate) can not be streamed, they would only group the changed documents")
+            return
+
+        client = self.get_client()
+        if client is None:
+            logging.error("Invalid MonoClient login, returning")
+            return
+
+        _db = self.config["connectionInfo"]["mongoDatabase"]
+        collection = client[_db][self.config["connectionInfo"]["mongoCollection"]]
+        lookups = self.get_lookup_resolver(collection, mapping_plan)
+
+        # only watch writes which leave a document behind and apply the
+        # default mongo filter to the document after the change
+        match = and_filters(
+            {"operationType" : {"$in" : ["insert", "update", "replace"]}},
+            prefix_filter(self.mongo_filter, "fullDocument.")
+            )
+        max_await_ms = int(min(max_wait_sec, 1) * 1000)
+
+        logging.info("Watching {}.{} for changes (resume token: {})".format(
+            _db, self.config["connectionInfo"]["mongoCollection"], resume_token))
+        try:
+            with collection.watch([{"$match" : match}], full_document="updateLookup",
+                    resume_after=resume_token, max_await_time_ms=max_await_ms) as stream:
+
+                batch = []
+                batch_start = time.perf_counter()
+
+                while stream.alive:
+                    change = stream.try_next()
+                    if change is not None and change.get("fullDocument") is not None:
+                        if len(batch) == 0:
+                            batch_start = time.perf_counter()
+                        batch.append(change["fullDocument"])
+
+                    if len(batch) > 0 and (len(batch) >= batch_size or \
+                        time.perf_counter() - batch_start >= max_wait_sec):
+                        result = flatten_changes(mapping_plan, batch, lookups)
+                        if result is None:
+                            return
+                        package_list, docs_pulled = result
+                        batch = []
+                        if docs_pulled == 0:
+                            continue
+                        logging.info("Flattened {} changed document(s) from the change stream".format(docs_pulled))
+                        yield package_list, stream.resume_token
+        except errors.PyMongoError as err:
+            logging.error("change stream stopped\n -> {}".format(err))
+        finally:
+            self.release_client(client)
+
+    def get_mapping_plan(self):
+        """ returns the compiled MappingPlan for config["mapping"], the plan is
+            cached on the handler and only recompiled when the mapping changes
+        """
+        engine = self.config.get("flattenEngine", "row")
+        key = json.dumps([self.config["mapping"], engine], sort_keys=True, default=str)
+        with self._mapping_plan_lock:
+            if self.mapping_plan is None or key != self._mapping_plan_key:
+                mapping_plan = MappingPlan.MappingPlan(self.config["mapping"])
+                if engine == "columnar":
+                    ColumnarEngine.setup_columnar(mapping_plan)
+                self.mapping_plan = mapping_plan
+                self._mapping_plan_key = key
+                logging.info("Compiled mapping plan for {} map(s) using the {} engine".format(len(mapping_plan.maps), engine))
+            return self.mapping_plan
+
+    def get_lookup_resolver(self, collection, mapping_plan):
+        """ returns a LookupResolver for the lookup columns of mapping_plan or None
+            if it has none, the caches are kept on the handler so values are reused
+            across pulls for "lookupCacheTTLSec" seconds
+        """
+        lookups = set(map_plan.columns[i].lookup for map_plan in mapping_plan.maps for i in map_plan.lookup_columns)
+        if len(lookups) == 0:
+            return None
+
+        with self._lookup_caches_lock:
+            for lookup in lookups:
+                if lookup not in self.lookup_caches:
+                    self.lookup_caches[lookup] = Cache.TTLCache(
+                        self.config.get("lookupCacheSize", Cache.MAX_SIZE),
+                        self.config.get("lookupCacheTTLSec", Cache.TTL_SEC)
+                        )
+            caches = {lookup : self.lookup_caches[lookup] for lookup in lookups}
+        return LookupResolver(collection.database, mapping_plan, caches)
+
+    def get_result_cache(self):
+        """ returns the process-wide cache of pull results for the configured
+            collection, or None if "resultCacheTTLSec" is not set, with
+            "resultCacheWatch" a change stream drops its entries on any write
+        """
+        ttl_sec = self.config.get("resultCacheTTLSec", 0) or 0
+        if ttl_sec <= 0:
+            return None
+
+        # the same database and collection on another server is another cache
+        namespace = "{}.{}".format(self.config["connectionInfo"]["mongoDatabase"],
+            self.config["connectionInfo"]["mongoCollection"])
+        cache_key = (self.get_uri(), namespace)
+        max_size = self.config.get("resultCacheSize", RESULT_CACHE_SIZE)
+        with result_caches_lock:
+            cache = result_caches.get(cache_key)
+            if cache is None:
+                cache = result_caches[cache_key] = Cache.TTLCache(max_size, ttl_sec)
+            else:
+                # the latest config sets the bounds of entries put from now on
+                cache.max_size = max_size
+                cache.ttl_sec = ttl_sec
+            watch = self.config.get("resultCacheWatch", False) and cache_key not in result_cache_watchers \
+                and time.monotonic() >= result_cache_retry_after.get(cache_key, 0)
+            if watch:
+                result_cache_watchers.add(cache_key)
+
+        if watch:
+            threading.Thread(target=self.invalidate_on_change, args=(cache_key, cache),
+                name="result-cache-{}".format(namespace), daemon=True).start()
+        return cache
+
+    def result_cache_key(self, query_filter, add_index, data):
+        """ returns the result cache key for a pull, made from everything in the
+            config which changes the packages pulled and the bound filter
+        """
+        config_key = json_util.dumps([
+            self.config["connectionInfo"],
+            self.config["mapping"],
+            self.config.get("flattenEngine", "row"),
+            self.config.get("useProjection", True),
+            self.config.get("numDocsToPull", 0),
+            {key : data.get(key) for key in ("pullOnlyNew", "modifiedField") + WATERMARK_KEYS}
+            ], sort_keys=True)
+        # key order in a filter can change what it matches so it is not sorted
+        filter_key = json_util.dumps([query_filter, add_index])
+        return hashlib.sha256((config_key + filter_key).encode("utf-8")).hexdigest()
+
+    def result_cache_stats(self):
+        """ returns the hit, miss and eviction counters of the result cache or None """
+        cache = self.get_result_cache()
+        return cache.stats() if cache is not None else None
+
+    def invalidate_on_change(self, cache_key, cache):
+        """ follows the change stream of the collection and drops every cached
+            pull result when a document is written, runs on a daemon thread
+            started by get_result_cache
+        """
+        namespace = cache_key[1]
+        watching = False
+        try:
+            client = self.get_client()
+            if client is None:
+                logging.warning("Could not watch {} for result cache invalidation".format(namespace))
+                return
+
+            collection = client[self.config["connectionInfo"]["mongoDatabase"]][self.config["connectionInfo"]["mongoCollection"]]
+            logging.info("Watching {} to invalidate cached pull results".format(namespace))
+            try:
+                with collection.watch(max_await_time_ms=1000) as stream:
+                    watching = True
+                    for change in stream:
+                        cache.invalidate()
+            except errors.PyMongoError as err:
+                logging.warning("stopped watching {} for result cache invalidation\n -> {}".format(namespace, err))
+            finally:
+                self.release_client(client)
+        finally:
+            with result_caches_lock:
+                result_cache_watchers.discard(cache_key)
+                if not watching:
+                    # a collection which can not be watched (i.e. a standalone server) is not
+                    # watched again on every pull, its results only expire after their ttl
+                    logging.warning("Not watching {} again for {} sec".format(namespace, RESULT_CACHE_WATCH_RETRY_SEC))
+                    result_cache_retry_after[cache_key] = time.monotonic() + RESULT_CACHE_WATCH_RETRY_SEC
+            if watching:
+                # writes are no longer seen, so drop what may be stale and let the
+                # next pull start a new watcher
+                cache.invalidate()
+
+    def get_pull_collection(self, client):
+        """ returns the configured collection for pulling documents, when
+            "useRawBSON" is true documents are returned as RawBSONDocuments which
+            are only decoded as far as the mapping walks into them
+        """
+        _db = self.config["connectionInfo"]["mongoDatabase"]
+        collection = client[_db][self.config["connectionInfo"]["mongoCollection"]]
+        if self.config.get("useRawBSON", False):
+            logging.info("Pulling documents as raw bson")
+            collection = collection.with_options(codec_options=CodecOptions(document_class=RawBSONDocument))
+        return collection
+
+    def get_projection(self, mapping_plan):
+        """ returns the projection built from the mapping or None if projections
+            are turned off with "useProjection" : false in the config
+        """
+        if not self.config.get("useProjection", True):
+            logging.info("Not using a projection (useProjection is false)")
+            return None
+
+        projection = mapping_plan.build_projection()
+        if projection is None:
+            logging.info("Not using a projection: a mongo_path can not be projected")
         else:
-            return package_list
+            logging.info("Using projection: {}".format(json.dumps(projection)))
+        return projection
 
     @classmethod
     def get_val_from_dict(self, obj, mongo_path_split, out=[], 
@@ -462,87 +1167,62 @@ class MongoHandler():
 
             Arguments:
                 alias {string} -- the key in mongoFilter to look for
-            
+                input_value {string} -- value from interject to put in place of INPUT_VALUE
+                cast_to {string} -- interject parameter type of input_value
+
             Returns:
-                [dict] -- search term to add to mongo filter                       
+                [dict] -- search term to add to mongo filter
         """
-        
-        try:
-            if 'mongoFilter' not in self.config:
-                query = {alias : input_value}
-            else:
-                # open mongoFilter dictionary from config file and parse to string
-                dictionary = json.loads(json.dumps(self.config['mongoFilter'][alias]))
-                query_str = str( dictionary )
-                query_str = query_str.replace("'", '"')
-
-                # if a filter requires user input then replace the value to be input
-                if "INPUT_VALUE" in query_str:
-                    if cast_to in STRINGS:
-                        query_str = query_str.replace('INPUT_VALUE', input_value)
-                    elif cast_to in NONSTRINGS:
-                        query_str = query_str.replace('"INPUT_VALUE"', input_value)
-                    else:
-                        query_str = query_str.replace('INPUT_VALUE', input_value)
-            
-                    query = json.loads(query_str)
-                else:
-                    query = dictionary
-
-        except Exception as err:
-            logging.warning("found no interject filter for key ({}) --> {}".format(alias,err))
-            query = {alias : input_value}
-        finally:
-            # if objectid is included convert id to ObjectId Type
-            if "_id" in query:
-                query['_id'] = ObjectId(query['_id'])
+        if alias in self.filter_templates:
+            return self.filter_templates[alias].bind(input_value, cast_to)
 
-            return query
+        if 'mongoFilter' in self.config:
+            logging.warning("found no interject filter for key ({})".format(alias))
+        query = {alias : input_value}
+        if alias == "_id":
+            query["_id"] = parse_object_id(input_value)
+        return query
 
     def save_collection(self, update_dict, save_msg=None):
         """ attempts to update a single query (update_info[query]) 
-            in mongo with a object (update_info[data])
+            in mongo with a object (update_info[data]), the documents are
+            fetched in batches of "saveBatchSize" with one $in query so updates
+            which change nothing are skipped, the rest are sent with one
+            unordered bulk_write per batch
 
             Arguments:
                 update_dict {dict} -- dictionary with each element
+                save_msg {DataFrame} -- MessageToUser is set for each update
         """ 
 
         # setup connection to mongodb and get collection
-        if self.setup_connection() == False:
+        client = self.get_client()
+        if client is None:
             logging.error("Invalid MonoClient login, returning")
             return []
 
-        logging.info('Pulling data from Mongo')
+        logging.info('Saving data to Mongo')
 
         _db = self.config["connectionInfo"]["mongoDatabase"]
-        db = self.client[_db]
+        db = client[_db]
         collection = db[self.config["connectionInfo"]["mongoCollection"]]
-        result = None
-        i = 0
-        
-        for update_info in update_dict.values():
-            
-            if update_info['data']['$set'] != None and update_info['data']['$set'] != {}:
-
-                # verify is saveable
-                result = collection.find_one_and_update(
-                    filter=update_info['query'], 
-                    update=update_info['data'], 
-                    array_filters=update_info['options']['arrayFilters'],
-                    return_document=ReturnDocument.BEFORE,
-                    upsert=True
-                    )
-                
-                # check if document was changed                
-                doc = collection.find_one(update_info['query'])
-                if doc != result:
-                    print("===> Change Made({},{})\n *R* {}\n *O* {}".format(i,'MsgToUser',result, doc))
-                    save_msg.at[i,'MessageToUser'] = "document updated"
-                else:
-                    save_msg.at[i,'MessageToUser'] = "no change"
+        batch_size = self.config.get("saveBatchSize", 1000)
 
-                i += 1
-        self.close_connection()
+        # only updates setting a value are saved, the message rows follow their order
+        updates = [update_info for update_info in update_dict.values() \
+            if update_info['data']['$set'] != None and update_info['data']['$set'] != {}]
+        messages = []
+        try:
+            for start in range(0, len(updates), batch_size):
+                messages += save_batch(collection, updates[start:start + batch_size])
+        finally:
+            self.release_client(client)
+
+        logging.info("Saved {} update(s) to Mongo: {} document(s) updated, {} unchanged".format(
+            len(messages), messages.count("document updated"), messages.count("no change")))
+        if save_msg is not None:
+            for i in range(len(messages)):
+                save_msg.at[i,'MessageToUser'] = messages[i]
         return [save_msg]
        
     @classmethod
@@ -552,31 +1232,28 @@ class MongoHandler():
         
         NOTE: Row is parsed out in order to associate data from excel and data saved
         to allow for save messages to be sent back to Interject.
-        """
 
-        root = etree.fromstring(xml)
-        column_names = []   # column names for data
-        row_list = []
-        row_data = []
-        save_message_rows = []
-
-        for row in root:
-            
-            # assemble data from xml into row list
-            if row.tag == "r":
-                row_data = []
-                save_message_rows.append([row[0].text,""])
-
-                for col in row[1:]:
-                    row_data.append(col.text)
-                row_list.append(row_data)
-
-            # parse out column headers
-            elif row.tag == "c":
-                column_names.append(row.attrib['Column'])
-        
-        df_data = pd.DataFrame(row_list, columns=column_names[1:])
-        df_save = pd.DataFrame(save_message_rows, columns=["Row","MessageToUser"])
+        The xml is parsed as a stream straight into column buffers, no element
+        tree is built. xml can be a string, bytes or a file-like / mmap object with read().
+        """
+        buffer = XMLColumnBuffer()
+        parser = etree.XMLParser(target=buffer)
+        for chunk in iter_xml_chunks(xml):
+            parser.feed(chunk)
+        parser.close()
+
+        column_names = buffer.column_names
+        columns = buffer.columns
+        row_ids = buffer.row_ids
+
+        if len(columns) > len(column_names[1:]):
+            raise ValueError("{} columns passed, passed data had {} columns".format(len(column_names[1:]), len(columns)))
+        while len(columns) < len(column_names[1:]):
+            columns.append([None] * len(row_ids))
+
+        df_data = pd.DataFrame(dict(enumerate(columns)), index=pd.RangeIndex(len(row_ids)))
+        df_data.columns = column_names[1:]
+        df_save = pd.DataFrame({"Row" : row_ids, "MessageToUser" : [""] * len(row_ids)})
         
         return [df_data, df_save]
 
@@ -584,101 +1261,84 @@ class MongoHandler():
         """ a custom method to parse the interject xml returned from a save into a dict object
             which can be upserted back into mongodb
 
+            Column positions, mongo paths and casters are resolved once per call and
+            every updatable column is cast as a whole, rows without an _id are skipped
+
             Argument:
-                xml {string} -- xml string to parse
+                dataframe {DataFrame} -- saved data from xml_to_dataframe
                 package_index {int} -- mapping index for which map to pull mongo_paths from
 
             Returns:
-            TODO: FIX COMMENTS
-                [dict]['query'] -- the query, object id to update
-                [dict]['data']  -- the update, information to replace/add existing with 
+                [OrderedDict] -- keyed by document id, each value holding
+                    ['options'] -- update options (arrayFilters)
+                    ['query']   -- the query, object id to update
+                    ['data']    -- the update, information to replace/add existing with
         """
 
         return_dict = OrderedDict()  # output object with new json objects to update mongo with
 
         column_names = dataframe.columns.tolist()   # column names for data
+        if "_id" not in column_names:
+            logging.error("saved data has no _id column, nothing to update")
+            return return_dict
+
+        updatable_keys = self.get_mongo_update_keys()[package_index]   # valid columns to update mongo with
+        sql_cols_obj = self.config['mapping'][package_index]['sql_cols']
+
+        # route every updatable column to its mongo path with its values already cast
+        routes = []
+        for col_idx in range(len(column_names)):
+            name = column_names[col_idx]
+            if name not in updatable_keys:
+                continue
+            values = dataframe.iloc[:, col_idx].to_numpy(dtype=object)
+            update_type = sql_cols_obj[name].get('mongoUpdateType')
+            if update_type is not None:
+                if update_type in UPDATE_TYPES:
+                    values = cast_update_column(values, UPDATE_TYPES[update_type])
+                else:
+                    logging.warning("no python type for mongoUpdateType {} ({}), saving values as they are".format(update_type, name))
+            routes.append((name, sql_cols_obj[name]['mongo_path'], values.tolist()))
 
-        updatable_keys = self.get_mongo_update_keys()   # valid columns to update mongo with
-         
-        sql_cols_obj = self.config['mapping'][package_index]['sql_cols'] 
-        
-        for row in dataframe.values.tolist():
-        
-            # assemble data from xml into row list
-            update_data = {"$set" : {}}
-            update_query = {}
-            update_id = ""
-            traceback_mongo_paths = {}
-
-            # attempt to find object_id for index info later
-            for col_idx in range(len(row)):
-                
-                # use objectid for query
-                if column_names[col_idx] == "_id":
-                    
-                    # Make sure that the id to update is a valid id to update
-                    if row[col_idx] == '' or row[col_idx] == None:
-                        update_id = ''
-                        logging.warn("found empty id")
-                    else:
-                        try:
-                            update_id, traceback_mongo_paths, update_options = self.reassemble_paths(row[col_idx], package_index)
-                        except Exception as e:
-                            print("{}  --  {}".format(update_id, e))
-                        update_query = {"_id" : ObjectId(update_id)}
-
-            if update_id != '' or update_id != None:
-                # setup object for options
-                if update_id not in return_dict: 
-                    return_dict[update_id] = {}
-
-                    # remove arrayfilter options
-                    return_dict[update_id]['options'] = {}
-                    return_dict[update_id]['options']['arrayFilters'] = []
-                    return_dict[update_id]['query'] = {}
-                    return_dict[update_id]['data'] = {}
-
-                # convert list into dict
-                for col_idx in range(len(row)):
-                    # replace keys with the locations for data and the data values
-                    if column_names[col_idx] in updatable_keys[package_index]:
-                        if column_names[col_idx] in traceback_mongo_paths:
-                            mongo_path = traceback_mongo_paths[column_names[col_idx]]
-                        else:
-                            mongo_path = sql_cols_obj[column_names[col_idx]]['mongo_path']
-                        
-                        # determine what type the data should be cast to (defaults to string if nothing is specified)
-                        path_data = None
-                        if 'mongoUpdateType' in sql_cols_obj[column_names[col_idx]]:
-
-                            # get builtin python type from string
-                            var_type = __builtins__[sql_cols_obj[column_names[col_idx]]['mongoUpdateType']]
-                            try:
-                                path_data = var_type( row[col_idx] )
-                            except:
-                                path_data = None
-                        else:
-                            path_data = row[col_idx]
+        id_idx = len(column_names) - 1 - column_names[::-1].index("_id")
+        ids = dataframe.iloc[:, id_idx].to_numpy(dtype=object).tolist()
+        traceback_cache = {}    # traceback pattern after the id -> mongo paths of [all] columns
 
-                        if path_data is not None:
-                            update_data["$set"][mongo_path] = path_data
+        for row in range(len(ids)):
+            info = ids[row]
+
+            # Make sure that the id to update is a valid id to update
+            if info is None or info == '' or (isinstance(info, float) and pd.isna(info)):
+                logging.warning("found empty id, skipping row {}".format(row))
+                continue
+
+            update_id, sep, pattern = info.partition("|")
+            if pattern not in traceback_cache:
+                traceback_cache[pattern] = self.reassemble_paths(info, package_index)[1]
+            traceback_mongo_paths = traceback_cache[pattern]
+
+            if update_id not in return_dict:
+                try:
+                    object_id = ObjectId(update_id)
+                except Exception as e:
+                    logging.error("could not save row {}, ({}) is not a valid ObjectId\n -> {}".format(row, update_id, e))
+                    continue
+
+                # remove arrayfilter options
+                return_dict[update_id] = {
+                    'options' : {'arrayFilters' : []},
+                    'query' : {"_id" : object_id},
+                    'data' : {"$set" : {}}
+                    }
+
+            # replace keys with the locations for data and the data values, when
+            # several rows save the same path the first row's value is kept
+            update_set = return_dict[update_id]['data']["$set"]
+            for name, mongo_path, values in routes:
+                value = values[row]
+                if value is not None:
+                    update_set.setdefault(traceback_mongo_paths.get(name, mongo_path), value)
 
-                # set the query and data to use in a mongdb update call
-                deepmerge_dicts(return_dict[update_id]['query'], update_query)
-                deepmerge_dicts(return_dict[update_id]['data'], update_data)
-                
-                # add new filters to arrayFilters
-                # DEPRECATE
-                """
-                for item in update_options:
-                    add = True
-                    for existing_item in return_dict[update_id]['options']['arrayFilters']: 
-                        if existing_item.keys() == item.keys():
-                            add = False
-                            break
-                    if add:
-                        return_dict[update_id]['options']['arrayFilters'].append( item )
-                """
         return return_dict
 
     def reassemble_paths(self, info, package_index=0):
@@ -740,36 +1400,703 @@ class MongoHandler():
         return map_keys
 
     def remove_from_mongo(self, doc_id_list):
-        """ """
+        """ deletes the documents with the ids in doc_id_list using one delete_many
+            per batch of "deleteBatchSize" ids
+
+            Returns:
+                [int] -- number of documents deleted
+        """
 
         # setup connection to mongodb and get collection
-        if self.setup_connection() == False:
+        client = self.get_client()
+        if client is None:
             logging.error("Invalid MonoClient login, returning")
             return []
 
-        logging.info('Pulling data from Mongo')
+        logging.info('Removing documents from Mongo')
 
         _db = self.config["connectionInfo"]["mongoDatabase"]
-        db = self.client[_db]
+        db = client[_db]
         collection = db[self.config["connectionInfo"]["mongoCollection"]]
-        result = None
+        batch_size = self.config.get("deleteBatchSize", 1000)
+        ids = to_object_ids(doc_id_list)
+        deleted = 0
 
-        for _id in doc_id_list:
-            try:
-                collection.delete_one({'_id': ObjectId(_id)})
-            except Exception as err:
-                logging.error("could not delete doc ({})".format(err))
-            
-            logging.info("document ({}) successfully removed".format(_id))
-
-        self.close_connection()
+        try:
+            for start in range(0, len(ids), batch_size):
+                batch = ids[start:start + batch_size]
+                try:
+                    result = collection.delete_many({'_id' : {'$in' : batch}})
+                except errors.PyMongoError as err:
+                    logging.error("could not delete batch of {} document(s)\n -> {}".format(len(batch), err))
+                    continue
+                deleted += result.deleted_count
+                logging.info("removed {} of {} document(s) in batch".format(result.deleted_count, len(batch)))
+        finally:
+            self.release_client(client)
 
-        
+        logging.info("removed {} of {} document(s) from Mongo".format(deleted, len(doc_id_list)))
+        return deleted
 
 ####################################
 ##### --- Static Functions --- #####
 ####################################
 
+def flatten_cursor(cur, mapping_plan, package_list, add_index=False, batch_size=5000, lookups=None):
+    """ flattens every document from a cursor into package_list, maps using the
+        columnar engine are flattened and lookup columns (LookupResolver) are
+        filled in batches of batch_size documents
+
+        Returns:
+            [tuple] -- (number of documents pulled, last document pulled, cursor error or None),
+                       on a cursor error the documents up to the last document are flattened
+            [None] -- if a document could not be flattened
+    """
+    docs_pulled = 0
+    last_doc = None
+    columnar = any(m.columnar is not None for m in mapping_plan.maps)
+    batching = columnar or lookups is not None
+    batch = []
+    row_starts = [len(pkg.data) for pkg in package_list]
+    cursor_error = None
+    try:
+        for doc in cur:
+            docs_pulled += 1
+            last_doc = doc
+
+            # walk the document once for all maps and add the rows to each package
+            try:
+                if not mapping_plan.flatten(doc, package_list, add_index):
+                    return None
+            except Exception as err:
+                logging.error('could not flatten document ({})\n -> {}'.format(doc.get("_id"), err))
+                return None
+
+            if batching:
+                batch.append(doc)
+                if len(batch) >= batch_size:
+                    if not finish_batch(mapping_plan, batch, package_list, add_index, columnar, lookups, row_starts):
+                        return None
+                    batch = []
+                    row_starts = [len(pkg.data) for pkg in package_list]
+    except errors.PyMongoError as err:
+        logging.error("bad connection to mongo\n -> " + str(err))
+        cursor_error = err
+
+    if len(batch) > 0 and not finish_batch(mapping_plan, batch, package_list, add_index, columnar, lookups, row_starts):
+        return None
+    return docs_pulled, last_doc, cursor_error
+
+def finish_batch(mapping_plan, batch, package_list, add_index, columnar, lookups, row_starts):
+    """ flattens a batch for the columnar maps then fills the lookup columns of
+        the rows added since row_starts
+
+        Returns:
+            [bool] -- False if the batch could not be flattened or looked up
+    """
+    if columnar and not flatten_columnar_batch(mapping_plan, batch, package_list, add_index):
+        return False
+    return lookups is None or lookups.enrich(package_list, row_starts)
+
+def flatten_changes(mapping_plan, docs, lookups=None):
+    """ flattens a micro-batch of changed documents from a change stream, maps using
+        the columnar engine are flattened for the whole batch and lookup columns are
+        filled, a document missing required data is skipped instead of failing the batch
+
+        Returns:
+            [tuple] -- (list of Packages, number of documents flattened)
+            [None] -- if the lookup columns could not be filled
+    """
+    columnar = any(m.columnar is not None for m in mapping_plan.maps)
+
+    def flatten(docs, one_by_one):
+        package_list = mapping_plan.build_packages()
+        flattened = []
+        for doc in docs:
+            # remove the rows a skipped document already added to earlier maps
+            sizes = [len(pkg.data) for pkg in package_list]
+            try:
+                ok = mapping_plan.flatten(doc, package_list)
+            except Exception as err:
+                logging.error('could not flatten document ({})\n -> {}'.format(doc.get("_id"), err))
+                ok = False
+            if ok and one_by_one:
+                ok = flatten_columnar_batch(mapping_plan, [doc], package_list)
+            if ok:
+                flattened.append(doc)
+            else:
+                for pkg, size in zip(package_list, sizes):
+                    del pkg.data[size:]
+        return package_list, flattened
+
+    package_list, flattened = flatten(docs, False)
+    if columnar and len(flattened) > 0 and not flatten_columnar_batch(mapping_plan, flattened, package_list):
+        # a document is missing required data for a columnar map, flatten the
+        # batch again one document at a time to skip only that document
+        logging.warning("columnar batch of {} changed document(s) failed, flattening them one at a time".format(len(flattened)))
+        package_list, flattened = flatten(flattened, True)
+
+    if lookups is not None and not lookups.enrich(package_list, [0] * len(package_list)):
+        return None
+    return package_list, len(flattened)
+
+def pull_query(collection, query_filter, projection, mapping_plan, package_list,
+    add_index=False, limit=0, config={}, sort_fields=("_id",), lookups=None):
+    """ flattens the documents matching query_filter in sort_fields order, when the
+        cursor fails it is reopened after the last processed document, retrying up
+        to "cursorRetries" times in a row with an exponential backoff
+
+        Arguments:
+            limit {int} -- most documents to pull, 0 for no limit
+            sort_fields {tuple} -- fields to read the documents in, ending with _id
+                                   so every document has a unique position
+
+        Returns:
+            [tuple] -- (number of documents pulled, sort_fields values of the last document pulled)
+            [None] -- if a document could not be flattened or the retries ran out
+    """
+    retries = config.get("cursorRetries", 3)
+    backoff_sec = config.get("cursorRetryBackoffSec", 1)
+    docs_pulled = 0
+    last_key = None
+    attempt = 0
+    while True:
+        resume_filter = query_filter
+        if last_key is not None:
+            resume_filter = and_filters(query_filter, keyset_filter(sort_fields, last_key))
+
+        cur = collection.find(resume_filter, projection).sort([(f, pymongo.ASCENDING) for f in sort_fields])
+        if limit > 0:
+            cur = cur.limit(limit - docs_pulled).batch_size(limit)
+        result = flatten_cursor(cur, mapping_plan, package_list, add_index,
+            config.get("columnarBatchSize", 5000), lookups)
+        try:
+            cur.close()
+        except errors.PyMongoError:
+            pass
+
+        if result is None:
+            return None
+        count, last_doc, cursor_error = result
+        docs_pulled += count
+        if last_doc is not None:
+            last_key = tuple(get_field(last_doc, f) for f in sort_fields)
+            attempt = 0
+        if cursor_error is None or (limit > 0 and docs_pulled >= limit):
+            return docs_pulled, last_key
+
+        attempt += 1
+        if attempt > retries:
+            logging.error("cursor failed {} time(s) in a row, giving up after {} documents".format(attempt, docs_pulled))
+            return None
+        wait_sec = backoff_sec * 2 ** (attempt - 1)
+        logging.warning("cursor failed after {} documents, retry {} of {} resumes after _id {} in {} sec".format(
+            docs_pulled, attempt, retries, last_key, wait_sec))
+        time.sleep(wait_sec)
+
+def flatten_columnar_batch(mapping_plan, batch, package_list, add_index=False):
+    """ flattens a batch of documents for the maps using the columnar engine
+
+        Returns:
+            [bool] -- False if the batch could not be flattened
+    """
+    try:
+        return ColumnarEngine.flatten_batch(mapping_plan, batch, package_list, add_index)
+    except Exception as err:
+        logging.error('could not flatten batch of {} documents column-wise\n -> {}'.format(len(batch), err))
+        return False
+
+def pull_pushdown_maps(collection, mapping_plan, query_filter, package_list,
+    add_index=False, upper_bound=None, use_projection=True, lookups=None):
+    """ runs an aggregation for each map using "array_mode" : "pushdown" so the
+        server unwinds its [all] list and returns one flat document per row
+
+        Arguments:
+            upper_bound {dict} -- filter matching the documents up to the last one pulled by
+                                  the find cursor, so every map covers the same documents
+
+        Returns:
+            [bool] -- False if a required column was missing or the aggregation failed
+    """
+    for map_plan, pkg in zip(mapping_plan.maps, package_list):
+        if not map_plan.pushdown:
+            continue
+
+        # nothing was found by the find cursor so there is nothing to unwind
+        if upper_bound is None:
+            continue
+
+        t1 = time.perf_counter()
+        projection = mapping_plan.build_projection([map_plan]) if use_projection else None
+        pipeline = map_plan.build_pipeline(
+            and_filters(query_filter, upper_bound),
+            projection
+            )
+        row_starts = [len(p.data) for p in package_list]
+        try:
+            for doc in collection.aggregate(pipeline, allowDiskUse=True):
+                if not map_plan.flatten_unwound(doc, pkg, add_index):
+                    return False
+        except errors.PyMongoError as err:
+            logging.error("could not unwind {} for map destination {}\n -> {}".format(
+                map_plan.unwind_path, pkg.dest, err))
+            return False
+        if lookups is not None and not lookups.enrich(package_list, row_starts):
+            return False
+        pkg.setup_runtime += time.perf_counter() - t1
+        logging.info("  -> unwound {} on the server for map destination: {}".format(map_plan.unwind_path, pkg.dest))
+    return True
+
+def column_stats(package):
+    """ returns column name -> count of values, nulls, distinct values and the
+        type names found, for the rows of a package
+    """
+    stats = {}
+    for i in range(len(package.col_names)):
+        values = [row[i] for row in package.data if row[i] is not None]
+        try:
+            distinct = len(set(values))
+        except TypeError:
+            distinct = len(set(repr(v) for v in values))
+        stats[package.col_names[i]] = {
+            "count" : len(values),
+            "nulls" : len(package.data) - len(values),
+            "distinct" : distinct,
+            "types" : sorted(set(type(v).__name__ for v in values))
+        }
+    return stats
+
+def pull_summary_maps(collection, mapping_plan, query_filter, package_list, upper_bound=None):
+    """ runs a $group aggregation for each summary map so only the summary rows
+        are returned by the server
+
+        Arguments:
+            upper_bound {dict} -- filter matching the documents up to the last one pulled,
+                                  so summaries cover the same documents as the other maps
+
+        Returns:
+            [bool] -- False if a required column was missing or the aggregation failed
+    """
+    for map_plan, pkg in zip(mapping_plan.maps, package_list):
+        if not map_plan.summary or upper_bound is None:
+            continue
+
+        t1 = time.perf_counter()
+        pipeline = map_plan.build_summary_pipeline(and_filters(query_filter, upper_bound))
+        try:
+            for doc in collection.aggregate(pipeline, allowDiskUse=True):
+                if not map_plan.flatten_summary(doc, pkg):
+                    return False
+        except errors.PyMongoError as err:
+            logging.error("could not group summary rows for map destination {}\n -> {}".format(pkg.dest, err))
+            return False
+        pkg.setup_runtime += time.perf_counter() - t1
+        logging.info("  -> grouped {} summary rows on the server for map destination: {}".format(len(pkg.data), pkg.dest))
+    return True
+
+def pull_last_key(collection, query_filter, sort_fields=("_id",), limit=0):
+    """ counts the documents matching query_filter on the server and finds the
+        sort_fields values of the last one, used when no map reads documents
+
+        Returns:
+            [tuple] -- (number of documents, sort_fields values of the last document or None)
+            [None] -- if the aggregation failed
+    """
+    pipeline = []
+    if query_filter:
+        pipeline.append({"$match" : query_filter})
+    pipeline.append({"$sort" : {f : pymongo.ASCENDING for f in sort_fields}})
+    if limit > 0:
+        pipeline.append({"$limit" : limit})
+    pipeline.append({"$group" : {
+        "_id" : None,
+        "docs" : {"$sum" : 1},
+        "last" : {"$last" : {"k{}".format(i) : "$" + sort_fields[i] for i in range(len(sort_fields))}}
+        }})
+    try:
+        found = list(collection.aggregate(pipeline, allowDiskUse=True))
+    except errors.PyMongoError as err:
+        logging.error("could not count the documents to pull\n -> {}".format(err))
+        return None
+
+    if len(found) == 0:
+        return 0, None
+    last = found[0]["last"]
+    return found[0]["docs"], tuple(last.get("k{}".format(i)) for i in range(len(sort_fields)))
+
+def limit_filter(collection, query_filter, limit):
+    """ bounds query_filter to the first limit documents in _id order using the
+        _id of the last one, the filter is unchanged if fewer documents match
+    """
+    cur = collection.find(query_filter, {"_id" : 1}).sort("_id", pymongo.ASCENDING).skip(limit - 1).limit(1)
+    last = [doc["_id"] for doc in cur]
+    if len(last) == 0:
+        return query_filter
+    return and_filters(query_filter, {"_id" : {"$lte" : last[0]}})
+
+def get_partition_bounds(collection, query_filter, partitions):
+    """ splits the documents matching query_filter into _id ranges using the
+        timestamps of the first and last ObjectId
+
+        Returns:
+            [list of dicts] -- _id range filters, a single empty filter if the
+                               _ids are not ObjectIds or the range can not be split
+    """
+    first = collection.find_one(query_filter, {"_id" : 1}, sort=[("_id", pymongo.ASCENDING)])
+    last = collection.find_one(query_filter, {"_id" : 1}, sort=[("_id", pymongo.DESCENDING)])
+    if first is None or last is None or \
+        not isinstance(first["_id"], ObjectId) or not isinstance(last["_id"], ObjectId):
+        return [{}]
+
+    start = first["_id"].generation_time
+    span = (last["_id"].generation_time - start) / partitions
+    if span.total_seconds() < 1:
+        return [{}]
+
+    # inner boundaries are ObjectIds for the start of each time slice
+    edges = [ObjectId.from_datetime(start + span * i) for i in range(1, partitions)]
+    bounds = []
+    lower = None
+    for edge in edges + [None]:
+        bound = {}
+        if lower is not None:
+            bound["$gte"] = lower
+        if edge is not None:
+            bound["$lt"] = edge
+        bounds.append({"_id" : bound} if bound else {})
+        lower = edge
+    return bounds
+
+def pull_partition(task):
+    """ flattens one _id range in a worker process (see MongoHandler.pull_partitions)
+
+        Arguments:
+            task {tuple} -- (config, query filter, projection, add_index, TypeRegistry snapshot)
+
+        Returns:
+            [tuple] -- (packages or None on failure, documents pulled, last _id, runtime sec)
+    """
+    config, query_filter, projection, add_index, registry = task
+    t1 = time.perf_counter()
+    TypeRegistry.restore(registry)
+    handler = MongoHandler(config)
+    client = handler.get_client()
+    if client is None:
+        return None, 0, None, 0
+
+    try:
+        mapping_plan = handler.get_mapping_plan()
+        package_list = mapping_plan.build_packages()
+        collection = handler.get_pull_collection(client)
+        lookups = handler.get_lookup_resolver(collection, mapping_plan)
+        result = pull_query(collection, query_filter, projection, mapping_plan,
+            package_list, add_index, 0, config, lookups=lookups)
+        if result is not None and result[1] is not None and not pull_pushdown_maps(collection,
+                mapping_plan, query_filter, package_list, add_index,
+                keyset_filter(("_id",), result[1], "$lte"), projection is not None, lookups):
+            result = None
+        if lookups is not None:
+            lookups.log_stats()
+    except Exception as err:
+        logging.error("could not pull partition ({})\n -> {}".format(query_filter, err))
+        result = None
+    finally:
+        handler.release_client(client)
+
+    if result is None:
+        return None, 0, None, time.perf_counter() - t1
+    last_id = result[1][-1] if result[1] is not None else None
+    return package_list, result[0], last_id, time.perf_counter() - t1
+
+def merge_partitions(results, package_list):
+    """ merges the packages returned by pull_partition for each _id range, in
+        _id order, into package_list
+
+        Returns:
+            [tuple] -- (number of documents pulled, last _id pulled)
+            [None] -- if any partition failed
+    """
+    # check every partition first so package_list is left empty when one failed
+    for i, result in enumerate(results):
+        if result[0] is None:
+            logging.error("partition {} failed, returning".format(i))
+            return None
+
+    docs_pulled = 0
+    last_id = None
+    for i, (part_packages, part_docs, part_last_id, runtime) in enumerate(results):
+        logging.info("  -> partition {}: {} documents in {} sec".format(i, part_docs, round(runtime, 3)))
+
+        # results are in _id order so the last non empty partition holds the newest id
+        for pkg, part_pkg in zip(package_list, part_packages):
+            pkg.data.extend(part_pkg.data)
+            pkg.setup_runtime += part_pkg.setup_runtime
+        docs_pulled += part_docs
+        if part_docs > 0:
+            last_id = part_last_id
+    return docs_pulled, last_id
+
+def get_modified_watermarks(modified_field, last_key):
+    """ returns the config["data"] values saving the modifiedField value and _id of
+        the last document pulled so the next pull starts after it
+    """
+    if last_key[0] is None:
+        logging.warning("last document pulled has no {}, keeping the previous watermark".format(modified_field))
+        return {}
+    return {
+        'lastModifiedPulled' : to_config_value(last_key[0]),
+        'lastModifiedIdPulled' : to_config_value(last_key[1])
+        }
+
+def save_batch(collection, updates):
+    """ saves a batch of updates built by dataframe_to_dict, the documents they
+        target are fetched with one $in query and compared locally so only
+        updates which change a document are sent in an unordered bulk_write
+
+        Returns:
+            [list of str] -- MessageToUser for each update
+    """
+    ids = [u['query']['_id'] for u in updates if is_id_query(u['query'])]
+    current = {}
+    if len(ids) > 0:
+        fields = {path.split(".")[0] : 1 for u in updates for path in u['data'].get('$set', {})}
+        for doc in collection.find({"_id" : {"$in" : ids}}, fields):
+            current[doc["_id"]] = doc
+
+    messages = ["no change"] * len(updates)
+    operations = []
+    rows = []   # update row of each operation
+    for row in range(len(updates)):
+        update_info = updates[row]
+        doc = current.get(update_info['query']['_id']) if is_id_query(update_info['query']) else None
+        if doc is not None and not has_changes(doc, update_info['data']):
+            continue
+        operations.append(UpdateOne(
+            update_info['query'],
+            update_info['data'],
+            upsert=True,
+            array_filters=update_info['options']['arrayFilters'] or None
+            ))
+        rows.append(row)
+
+    if len(operations) == 0:
+        return messages
+
+    failed = {}     # operation index -> error message
+    try:
+        collection.bulk_write(operations, ordered=False)
+    except errors.BulkWriteError as err:
+        for write_error in err.details.get("writeErrors", []):
+            failed[write_error["index"]] = write_error.get("errmsg", "")
+    except errors.PyMongoError as err:
+        logging.error("could not save batch of {} update(s)\n -> {}".format(len(operations), err))
+        failed = {i : str(err) for i in range(len(operations))}
+
+    for i in range(len(rows)):
+        if i in failed:
+            logging.error("could not update document ({})\n -> {}".format(updates[rows[i]]['query'], failed[i]))
+            messages[rows[i]] = "could not update: {}".format(failed[i])
+        else:
+            messages[rows[i]] = "document updated"
+    return messages
+
+def iter_xml_chunks(xml, chunk_size=XML_CHUNK_SIZE):
+    """ yields an xml payload in chunks from a string, bytes or a file-like / mmap object """
+    if hasattr(xml, "read"):
+        while True:
+            chunk = xml.read(chunk_size)
+            if not chunk:
+                return
+            yield chunk
+    else:
+        view = memoryview(xml) if isinstance(xml, (bytes, bytearray)) else xml
+        for start in range(0, len(xml), chunk_size):
+            yield view[start:start + chunk_size]
+
+def to_object_ids(doc_id_list):
+    """ converts ids to ObjectIds, ids which are not valid are logged and dropped """
+    ids = []
+    for _id in doc_id_list:
+        try:
+            ids.append(ObjectId(_id))
+        except Exception as err:
+            logging.error("could not delete doc ({}), not a valid ObjectId\n -> {}".format(_id, err))
+    return ids
+
+def cast_update_column(values, caster):
+    """ casts a column of saved values, each distinct value is cast once and
+        values which can not be cast become None
+    """
+    codes, uniques = pd.factorize(values)
+    cast = np.empty(len(uniques), dtype=object)
+    for i in range(len(uniques)):
+        cast[i] = try_cast(caster, uniques[i])
+    out = np.empty(len(values), dtype=object)
+    out[codes != -1] = cast[codes[codes != -1]]
+
+    # None and nan share a code so missing values are cast one by one
+    missing = codes == -1
+    if missing.any():
+        out[missing] = [try_cast(caster, v) for v in values[missing]]
+    return out
+
+def try_cast(caster, value):
+    try:
+        return caster(value)
+    except Exception:
+        return None
+
+def is_id_query(query):
+    """ true if a query only matches a document by its _id """
+    return isinstance(query, dict) and list(query.keys()) == ["_id"] and not isinstance(query["_id"], dict)
+
+def has_changes(doc, update):
+    """ true if applying a $set update to doc would change it """
+    for operator, fields in update.items():
+        if operator != "$set":
+            return True
+        for path, value in fields.items():
+            found, current = get_path_value(doc, path)
+            if not found or current != value:
+                return True
+    return False
+
+def get_path_value(doc, path):
+    """ follows a dotted update path through documents and lists
+
+        Returns:
+            [tuple] -- (True if the path exists, value at the path)
+    """
+    obj = doc
+    for key in path.split("."):
+        if isinstance(obj, dict) and key in obj:
+            obj = obj[key]
+        elif isinstance(obj, list) and key.isdigit() and int(key) < len(obj):
+            obj = obj[int(key)]
+        else:
+            return False, None
+    return True, obj
+
+def keyset_filter(sort_fields, last_key, op="$gt"):
+    """ builds a filter for the documents after ("$gt") or up to ("$lte") the
+        document with the sort_fields values last_key, ties on a field are
+        decided by the fields after it
+    """
+    strict_op = "$gt" if op in ("$gt", "$gte") else "$lt"
+    clauses = []
+    for i in range(len(sort_fields)):
+        clause = {sort_fields[j] : last_key[j] for j in range(i)}
+        clause[sort_fields[i]] = {op if i == len(sort_fields) - 1 else strict_op : last_key[i]}
+        clauses.append(clause)
+    if len(clauses) == 1:
+        return clauses[0]
+    return {"$or" : clauses}
+
+def encode_page_token(sort_fields, last_key):
+    """ encodes the sort_fields values of the last document of a page into an
+        opaque url safe page token
+    """
+    value = json_util.dumps({"sort" : list(sort_fields), "key" : list(last_key)})
+    return base64.urlsafe_b64encode(value.encode("utf-8")).decode("ascii")
+
+def decode_page_token(page_token, sort_fields):
+    """ returns the last key encoded in a page token or None for no token
+
+        Raises:
+            ValueError -- if the token is malformed or was made for other sort_fields
+    """
+    if page_token is None or page_token == "":
+        return None
+    try:
+        value = json_util.loads(base64.urlsafe_b64decode(page_token.encode("ascii")).decode("utf-8"))
+        sort, key = value["sort"], value["key"]
+    except (ValueError, TypeError, KeyError, AttributeError) as err:
+        raise ValueError("malformed page token: {}".format(err))
+    if sort != list(sort_fields) or len(key) != len(sort):
+        raise ValueError("page token is for sort fields {}, not {}".format(sort, list(sort_fields)))
+    return tuple(key)
+
+def get_field(doc, field):
+    """ returns the value of a dotted field name in a document or None """
+    for key in field.split("."):
+        if not isinstance(doc, MappingPlan.DOCUMENT_TYPES):
+            return None
+        doc = doc.get(key)
+    return doc
+
+def add_projection_field(projection, field):
+    """ adds a dotted field to a projection without creating a path collision
+        with the fields already in it
+    """
+    if projection is None:
+        return None
+    for key in list(projection.keys()):
+        if field == key or field.startswith(key + "."):
+            return projection
+        if key.startswith(field + "."):
+            del projection[key]
+    projection[field] = 1
+    return projection
+
+def prefix_filter(query_filter, prefix):
+    """ prefixes every field name in a query filter, used to apply a filter
+        to a nested document such as the fullDocument of a change event
+    """
+    if isinstance(query_filter, list):
+        return [prefix_filter(f, prefix) for f in query_filter]
+    if not isinstance(query_filter, dict):
+        return query_filter
+
+    prefixed = {}
+    for key, val in query_filter.items():
+        if key in ("$and", "$or", "$nor"):
+            prefixed[key] = prefix_filter(val, prefix)
+        elif key.startswith("$"):
+            prefixed[key] = val
+        else:
+            prefixed[prefix + key] = val
+    return prefixed
+
+def to_config_value(value):
+    """ converts a bson value (ObjectId, datetime, resume token) into a json
+        serializable value which can be saved in the config
+    """
+    return json.loads(json_util.dumps(value))
+
+def from_config_value(value):
+    """ converts a value saved with to_config_value back into bson types """
+    if value is None or value == "":
+        return None
+    return json_util.loads(json.dumps(value))
+
+def from_id_watermark(value):
+    """ converts the lastMongoIdPulled value back into an _id, plain strings are
+        read as ObjectIds when they are valid ones (configs saved before the
+        watermark kept its bson type hold the ObjectId as a string)
+    """
+    if isinstance(value, str):
+        return parse_object_id(value) if value != "" else None
+    return from_config_value(value)
+
+def and_filters(*filters):
+    """ combines mongo query filters so a document must match all of them,
+        empty filters are ignored
+    """
+    filters = [f for f in filters if f]
+    if len(filters) == 0:
+        return {}
+    elif len(filters) == 1:
+        return filters[0]
+    return {"$and" : filters}
+
+def parse_object_id(value):
+    """ converts a string id saved in the config back into an ObjectId
+        when it is a valid ObjectId, otherwise returns it unchanged
+    """
+    if isinstance(value, str) and ObjectId.is_valid(value):
+        return ObjectId(value)
+    return value
+
 def deepmerge_dicts(dict_to_add_to, dict_to_add):
     """ takes two dictionaries and merges them at the deepest level where a difference occurs 
 
@@ -782,42 +2109,9 @@ def deepmerge_dicts(dict_to_add_to, dict_to_add):
         elif key not in dict_to_add_to:
             dict_to_add_to[key] = val
 
-def cast_to_target_type(mongodata, target_type=""):
-    """ takes any point of single element data and attempts
-    to convert it to the proper type to be inserted into sql.
-    """
-    try:
-        if target_type == "str":
-            if isinstance(mongodata, str):
-                return mongodata
-            else:
-                return str(mongodata)
-
-        elif target_type == "int":
-            if isinstance(mongodata, int) or isinstance(mongodata, float):
-                return mongodata
-            elif isinstance(mongodata, str):
-                try:
-                    return float(mongodata)
-                except Exception as e:
-                    logging.error("Could not convert string to int: {}".format(e))
-                    
-        elif target_type == "date":
-            if isinstance(mongodata, datetime.datetime):
-                return mongodata.isoformat()
-            elif isinstance(mongodata, str):
-                return mongodata
-            elif isinstance(mongodata, int) or isinstance(mongodata, float):
-                return str(mongodata)
-
-        elif target_type == "":
-            if isinstance(mongodata, datetime.datetime) or \
-               type(mongodata).__name__ == "ObjectId":
-                return str(mongodata)
-            else:
-                return str(mongodata)
-    except:
-        return None
-        
-        
 
+# pull result caches shared by every handler in the process, by (uri, "database.collection")
+result_caches = {}
+result_cache_watchers = set()   # collections watched by invalidate_on_change
+result_cache_retry_after = {}   # monotonic time a failed watch may be started again, by cache key
+result_caches_lock = threading.Lock()
@@ -4,6 +4,7 @@ Manages all sql server connection and query operations
 import pyodbc
 import logging
 import time
+from BeetleETL.Handlers import ConnectionPool
 class SQLHandler():
     """
     """
@@ -31,7 +32,7 @@ class SQLHandler():
         #based on the config file (without using credentials)
         if self.config['connectionInfo']['useWindowsAuth']:
             try:
-                self.connection = pyodbc.connect('Driver={'+self.config['connectionInfo']['sqlServerDriver']+'};\
+                self.connection = self.connect('Driver={'+self.config['connectionInfo']['sqlServerDriver']+'};\
                                             Server='+self.config['connectionInfo']['sqlServerHost']+\
                                             ';Database='+self.config['connectionInfo']['sqlServerDatabase']+\
                                             ';Trusted_Connection=yes;')
@@ -42,7 +43,7 @@ class SQLHandler():
         #If windows authentication is disabled use credentials
         else:
             try:
-                self.connection = pyodbc.connect('DRIVER={'+self.config['connectionInfo']['sqlServerDriver']+'};\
+                self.connection = self.connect('DRIVER={'+self.config['connectionInfo']['sqlServerDriver']+'};\
                                                 SERVER='+str(self.config['connectionInfo']['sqlServerHost'])+';\
                                                 DATABASE='+str(self.config['connectionInfo']['sqlServerDatabase'])+';\
                                                 UID='+str(self.config['connectionInfo']['sqlServerUser'])+';\
@@ -53,6 +54,17 @@ class SQLHandler():
                 return None
         logging.info("Connection to SQL database established")
 
+    def connect(self, connection_string):
+        """ returns a connection for connection_string, reusing an idle connection
+            from the process-wide pool unless "poolConnections" is false
+        """
+        if not self.config.get("poolConnections", True):
+            return pyodbc.connect(connection_string)
+        return ConnectionPool.sql_connections.acquire(
+            connection_string,
+            lambda: pyodbc.connect(connection_string),
+            idle_sec=self.config.get("connectionIdleSec", ConnectionPool.IDLE_SEC)
+            )
     
 
     def push_package(self, pkg):
@@ -187,7 +199,7 @@ class SQLHandler():
         if pushStatus == None:                                      #If one of the packages failed to insert
             logging.error(" -> Rolling back all insertions")        #close the cursor without commiting
             self.cursor.close()
-            self.cleanup
+            self.cleanup(rollback=True)
             return False
         else:    
             self.connection.commit()                                #Else if the all packages inserted successfully commit
@@ -196,7 +208,25 @@ class SQLHandler():
             self.cleanup()
             return True
     
-    def cleanup(self):
-        """ closes connections created by the sqlHandler
+    def cleanup(self, rollback=False):
+        """ closes connections created by the sqlHandler, pooled connections are
+            handed back to the pool and stay open
+
+            Arguments:
+                rollback {bool} -- roll back uncommitted statements first
         """
-        self.connection.close()
\ No newline at end of file
+        if self.connection is None:
+            return
+        discard = False
+        if rollback:
+            try:
+                self.connection.rollback()
+            except Exception as err:
+                logging.error("Could not roll back SQL connection: {}".format(err))
+                discard = True
+
+        if self.config.get("poolConnections", True):
+            ConnectionPool.sql_connections.release(self.connection, discard=discard)
+        else:
+            self.connection.close()
+        self.connection = None
\ No newline at end of file
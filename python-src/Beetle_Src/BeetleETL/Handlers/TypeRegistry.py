@@ -0,0 +1,148 @@
+"""
+Registry of the casters used for the target_type option of sql_cols and the
+python types used for the valid_types option. Both are resolved once per
+column when a mapping is compiled, new casters or types can be registered
+before a config is loaded.
+"""
+import datetime
+import logging
+import pickle
+import uuid
+from bson.decimal128 import Decimal128
+from bson.int64 import Int64
+from bson.objectid import ObjectId
+
+
+class GuardedCaster():
+    """ registered caster returning None for values it raises on, a class so
+        casters defined at module level can be pickled for worker processes
+    """
+    def __init__(self, target_type, caster):
+        self.target_type = target_type
+        self.caster = caster
+
+    def __call__(self, mongodata):
+        try:
+            return self.caster(mongodata)
+        except Exception as e:
+            logging.error("Could not cast ({}) to {}: {}".format(mongodata, self.target_type, e))
+            return None
+
+
+####################################
+##### --- Static Functions --- #####
+####################################
+
+def cast_str(mongodata):
+    return mongodata if isinstance(mongodata, str) else str(mongodata)
+
+def cast_int(mongodata):
+    # numbers are passed through, sql does the conversion
+    if isinstance(mongodata, (int, float)):
+        return mongodata
+    elif isinstance(mongodata, str):
+        try:
+            return float(mongodata)
+        except ValueError as e:
+            logging.error("Could not convert string to int: {}".format(e))
+    return None
+
+def cast_date(mongodata):
+    if isinstance(mongodata, datetime.datetime):
+        return mongodata.isoformat()
+    elif isinstance(mongodata, str):
+        return mongodata
+    elif isinstance(mongodata, (int, float)):
+        return str(mongodata)
+    return None
+
+def cast_default(mongodata):
+    return str(mongodata)
+
+def cast_none(mongodata):
+    """ caster for target types nothing is registered for """
+    return None
+
+def get_caster(target_type=""):
+    """ returns the single argument function casting mongo data to target_type """
+    return CASTERS.get(target_type, cast_none)
+
+def is_default_caster(target_type):
+    """ true if target_type still uses the caster beetle ships with it """
+    return target_type in DEFAULT_CASTERS and CASTERS.get(target_type) is DEFAULT_CASTERS[target_type]
+
+def register_caster(target_type, caster):
+    """ adds or replaces the caster for a target_type, values the caster raises
+        on are inserted as None
+
+        i.e. register_caster("decimal", lambda v: v.to_decimal() if isinstance(v, Decimal128) else v)
+    """
+    CASTERS[target_type] = GuardedCaster(target_type, caster)
+
+def register_valid_type(name, py_type):
+    """ adds or replaces the python type matched by a valid_types name """
+    VALID_TYPES[name] = py_type
+
+def snapshot():
+    """ returns the casters and valid types in use so they can be sent to worker
+        processes, which start with only the ones beetle ships with (see restore)
+    """
+    return dict(CASTERS), dict(VALID_TYPES)
+
+def restore(registry):
+    """ replaces the casters and valid types in use with a snapshot """
+    casters, valid_types = registry
+    CASTERS.clear()
+    CASTERS.update(casters)
+    VALID_TYPES.clear()
+    VALID_TYPES.update(valid_types)
+
+def is_picklable():
+    """ true if the casters and valid types in use can be sent to worker processes,
+        lambdas and functions defined inside other functions can not be pickled
+    """
+    try:
+        pickle.dumps(snapshot())
+    except Exception:
+        return False
+    return True
+
+def resolve_valid_types(valid_types):
+    """ resolves a valid_types option, names which are not registered are still
+        matched on the type name
+
+        Returns:
+            [tuple] -- (any_type, none_ok, frozenset of types, frozenset of type names)
+    """
+    any_type = list(valid_types) == ["none"]
+    none_ok = "none" in valid_types
+    types = frozenset(VALID_TYPES[t] for t in valid_types if t in VALID_TYPES)
+    names = frozenset(t for t in valid_types if t not in VALID_TYPES and t != "none")
+    return any_type, none_ok, types, names
+
+
+# casters beetle ships with, by target_type
+DEFAULT_CASTERS = {
+    "" : cast_default,
+    "str" : cast_str,
+    "int" : cast_int,
+    "date" : cast_date
+}
+
+# casters in use, by target_type
+CASTERS = dict(DEFAULT_CASTERS)
+
+# names usable in the valid_types option of sql_cols
+VALID_TYPES = {
+    "str" : str,
+    "int" : int,
+    "float" : float,
+    "bool" : bool,
+    "dict" : dict,
+    "list" : list,
+    "datetime" : datetime.datetime,
+    "ObjectId" : ObjectId,
+    "Int64" : Int64,
+    "Decimal128" : Decimal128,
+    "UUID" : uuid.UUID
+}
@@ -0,0 +1,44 @@
+"""
+Contains all tests related to the Cache
+
+NOTE: all tests must be functions with names defined using
+    the following format:
+
+    def test_XXXXX():
+
+"""
+
+from BeetleETL.Handlers import Cache
+import pytest
+
+
+@pytest.mark.unittest
+def test_ttl_cache_evicts_least_recently_used():
+    """ verify the cache stays within max_size by dropping the least recently used entry """
+    cache = Cache.TTLCache(max_size=2, ttl_sec=60)
+    cache.put_many({"a" : 1, "b" : 2})
+    assert cache.get("a") == 1
+
+    # b is now the least recently used
+    cache.put("c", 3)
+    found, missing = cache.get_many(["a", "b", "c"])
+
+    assert found == {"a" : 1, "c" : 3}
+    assert missing == ["b"]
+    assert cache.stats() == {"size" : 2, "hits" : 3, "misses" : 1, "evictions" : 1, "expirations" : 0, "invalidations" : 0}
+
+@pytest.mark.unittest
+def test_ttl_cache_expires_entries():
+    """ verify entries are dropped once their time to live has passed """
+    cache = Cache.TTLCache(max_size=10, ttl_sec=0)
+    cache.put("a", None)
+    assert cache.get_many(["a"]) == ({}, ["a"])
+    assert cache.stats()["expirations"] == 1
+
+    cache = Cache.TTLCache(max_size=10, ttl_sec=60)
+    cache.put_many({"a" : 1, "b" : 2})
+    cache.invalidate(["a"])
+    assert cache.get_many(["a", "b"]) == ({"b" : 2}, ["a"])
+    cache.invalidate()
+    assert cache.stats()["size"] == 0
+    assert cache.stats()["invalidations"] == 2
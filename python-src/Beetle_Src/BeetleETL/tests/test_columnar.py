@@ -0,0 +1,105 @@
+"""
+Contains all tests related to the ColumnarEngine
+
+NOTE: all tests must be functions with names defined using
+    the following format:
+
+    def test_XXXXX():
+
+"""
+
+import datetime
+from bson.int64 import Int64
+from bson.objectid import ObjectId
+from BeetleETL.Handlers import ColumnarEngine
+from BeetleETL.Handlers import MappingPlan
+from BeetleETL.tests.test_mapping import TEST_DOC, TEST_MAPPING
+import pytest
+
+
+COLUMNAR_DOCS = [
+    TEST_DOC,
+    {
+        "_id" : ObjectId("5b1f1a2b3c4d5e6f7a8b9c0e"),
+        "address" : {"building" : 12, "coord" : ["40.1", "north"]},
+        "grades" : [
+            {"date" : datetime.datetime(2014, 3, 3), "score" : "7"},
+            {"date" : 20140303, "score" : "bad"},
+            None,
+            {"score" : float("nan")}
+        ]
+    },
+    {"_id" : "empty", "grades" : []},
+    {"_id" : "not_list", "address" : [1, 2], "grades" : {"score" : 1}},
+    {"_id" : "missing"}
+]
+
+
+def flatten_both(mapping, docs, add_index=False):
+    """ flattens docs with the row and the columnar engine """
+    row_plan = MappingPlan.MappingPlan(mapping)
+    row_packages = row_plan.build_packages()
+    for doc in docs:
+        assert row_plan.flatten(doc, row_packages, add_index) is True
+
+    columnar_plan = ColumnarEngine.setup_columnar(MappingPlan.MappingPlan(mapping))
+    columnar_packages = columnar_plan.build_packages()
+    for doc in docs:
+        assert columnar_plan.flatten(doc, columnar_packages, add_index) is True
+    assert ColumnarEngine.flatten_batch(columnar_plan, docs, columnar_packages, add_index) is True
+    return row_packages, columnar_packages
+
+@pytest.mark.unittest
+def test_columnar_matches_row_engine():
+    """ verify the columnar engine gives the same rows as the row engine """
+    mapping = TEST_MAPPING + [{
+        "sql_dest" : {"schema" : "dbo", "db" : "test", "table" : "grade_values"},
+        "sql_cols" : {
+            "_id" : {"mongo_path" : "_id", "target_type" : "str"},
+            "grade" : {"mongo_path" : "grades[all]"},
+            "unknown" : {"mongo_path" : "grades[all].score", "target_type" : "string"}
+        }
+    }]
+
+    for add_index in (False, True):
+        row_packages, columnar_packages = flatten_both(mapping, COLUMNAR_DOCS, add_index)
+        for row_pkg, columnar_pkg in zip(row_packages, columnar_packages):
+            assert str(columnar_pkg.data) == str(row_pkg.data)
+
+    # None elements of an [all] list stay None and nan dates are cast like other numbers
+    mapping = [{
+        "sql_dest" : {"schema" : "dbo", "db" : "test", "table" : "tags"},
+        "sql_cols" : {
+            "_id" : {"mongo_path" : "_id"},
+            "tag" : {"mongo_path" : "tags[all]"},
+            "when" : {"mongo_path" : "when", "target_type" : "date"}
+        }
+    }]
+    docs = [
+        {"_id" : 1, "tags" : ["a", None, float("nan")], "when" : float("nan")},
+        {"_id" : 2, "tags" : [None], "when" : Int64(5)},
+        {"_id" : 3, "when" : 1e20}
+    ]
+    row_packages, columnar_packages = flatten_both(mapping, docs)
+    assert str(columnar_packages[0].data) == str(row_packages[0].data)
+    assert columnar_packages[0].data[1] == ["1", None, "nan"]
+
+@pytest.mark.unittest
+def test_columnar_falls_back_to_row():
+    """ verify maps using per document options stay on the row engine """
+    mapping = [{
+        "sql_dest" : {"schema" : "dbo", "db" : "test", "table" : "address"},
+        "sql_cols" : {
+            "_id" : {"mongo_path" : "_id"},
+            "building" : {"mongo_path" : "address.building", "valid_types" : ["str"]}
+        }
+    }] + TEST_MAPPING
+    plan = ColumnarEngine.setup_columnar(MappingPlan.MappingPlan(mapping))
+
+    assert plan.maps[0].columnar is None
+    assert plan.slots[0] is not None
+    assert plan.maps[2].columnar is not None
+    assert plan.slots[2] is None
+
+    row_packages, columnar_packages = flatten_both(mapping, COLUMNAR_DOCS)
+    assert str(columnar_packages[0].data) == str(row_packages[0].data)
@@ -0,0 +1,102 @@
+"""
+Contains all tests related to the ConnectionPool
+
+NOTE: all tests must be functions with names defined using
+    the following format:
+
+    def test_XXXXX():
+
+"""
+
+from BeetleETL.Handlers import ConnectionPool
+import pytest
+
+
+class FakeConnection():
+    """ connection which records when it is closed and can be made unhealthy """
+    def __init__(self):
+        self.closed = False
+        self.healthy = True
+
+    def ping(self):
+        if not self.healthy:
+            raise Exception("connection lost")
+
+def make_registry(shared):
+    return ConnectionPool.ConnectionRegistry("fake", FakeConnection.ping,
+        lambda conn: setattr(conn, "closed", True), shared=shared)
+
+@pytest.mark.unittest
+def test_shared_registry_reuses_connection():
+    """ verify a shared registry hands every caller the same connection per key """
+    registry = make_registry(shared=True)
+
+    first = registry.acquire("uri1", FakeConnection)
+    second = registry.acquire("uri1", FakeConnection)
+    other = registry.acquire("uri2", FakeConnection)
+    assert first is second
+    assert first is not other
+
+    registry.release(first)
+    registry.release(second)
+    assert first.closed is False
+    assert registry.acquire("uri1", FakeConnection) is first
+
+@pytest.mark.unittest
+def test_unshared_registry_checks_out_connections():
+    """ verify an unshared registry only reuses released connections """
+    registry = make_registry(shared=False)
+
+    first = registry.acquire("conn", FakeConnection)
+    second = registry.acquire("conn", FakeConnection)
+    assert first is not second
+
+    registry.release(first)
+    assert registry.acquire("conn", FakeConnection) is first
+
+    # discarded connections are closed instead of pooled
+    registry.release(second, discard=True)
+    assert second.closed is True
+    assert registry.acquire("conn", FakeConnection) is not second
+
+@pytest.mark.unittest
+def test_registry_health_check_and_idle_eviction():
+    """ verify unhealthy connections are replaced and idle ones are closed """
+    registry = make_registry(shared=True)
+
+    conn = registry.acquire("uri", FakeConnection)
+    registry.release(conn)
+    conn.healthy = False
+    replacement = registry.acquire("uri", FakeConnection, check_sec=0)
+    assert replacement is not conn
+    assert conn.closed is True
+
+    registry.release(replacement)
+    registry.evict_idle(idle_sec=-1)
+    assert replacement.closed is True
+    assert registry.pools == {}
+
+@pytest.mark.unittest
+def test_shared_registry_closes_discarded_connection_after_last_holder():
+    """ verify a failed health check does not close a shared connection other callers still hold """
+    registry = make_registry(shared=True)
+
+    first = registry.acquire("uri", FakeConnection)
+    second = registry.acquire("uri", FakeConnection)
+    assert first is second
+
+    # a third caller finds the connection unhealthy and gets a new one
+    first.healthy = False
+    replacement = registry.acquire("uri", FakeConnection, check_sec=0)
+    assert replacement is not first
+    assert first.closed is False
+
+    registry.release(first)
+    assert first.closed is False
+    registry.release(second)
+    assert first.closed is True
+
+    # the replacement is pooled and handed to later callers
+    assert registry.acquire("uri", FakeConnection) is replacement
+    assert replacement.closed is False
+    assert registry.retired == {}
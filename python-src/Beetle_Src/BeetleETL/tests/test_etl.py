@@ -119,3 +119,49 @@ def test_push_to_sql(config_path, config_name):
 
     assert push_return == True
     
+
+
+@pytest.mark.unittest
+def test_stream_to_sql(fake_collection):
+    """ verifies the resume token is saved after each pushed batch and the stream
+        stops when a push fails
+    """
+    from BeetleETL.Handlers import MongoHandler
+
+    config = {
+        "connectionInfo" : {"mongoDatabase" : "db", "mongoCollection" : "coll"},
+        "data" : {"resumeToken" : MongoHandler.to_config_value({"token" : 0})},
+        "streamBatchSize" : 1,
+        "mapping" : [{
+            "sql_dest" : {"schema" : "dbo", "db" : "test", "table" : "docs"},
+            "sql_cols" : {"_id" : {"mongo_path" : "_id"}}
+        }]
+    }
+    changes = [{"_id" : {"token" : i}, "operationType" : "insert", "fullDocument" : {"_id" : i}} for i in range(1, 4)]
+    collection = fake_collection(changes=changes)
+    pushed = []
+    saved = []
+
+    class FakeSQLHandler():
+        def push_packages(self, packages):
+            pushed.append(packages[0].data)
+            # the second batch fails
+            return len(pushed) < 2
+
+    class FakeConfigHandler():
+        def __init__(self):
+            self.config = config
+
+        def save_config(self):
+            saved.append(MongoHandler.from_config_value(config["data"]["resumeToken"]))
+
+    ETL = ETLHandler.ETLHandler.__new__(ETLHandler.ETLHandler)
+    ETL.config_handler = FakeConfigHandler()
+    ETL.mongo_handler = collection.attach(MongoHandler.MongoHandler(config))
+    ETL.sql_handler = FakeSQLHandler()
+    ETL.stream_to_sql()
+
+    assert collection.watches[0][1]["resume_after"] == {"token" : 0}
+    assert pushed == [[["1"]], [["2"]]]
+    assert saved == [{"token" : 1}]
+    assert MongoHandler.from_config_value(config["data"]["resumeToken"]) == {"token" : 1}
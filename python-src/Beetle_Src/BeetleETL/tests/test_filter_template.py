@@ -0,0 +1,66 @@
+"""
+Contains all tests related to the FilterTemplate
+
+NOTE: all tests must be functions with names defined using
+    the following format:
+
+    def test_XXXXX():
+
+"""
+
+from BeetleETL.Handlers import FilterTemplate
+from BeetleETL.Handlers import MongoHandler
+from bson.objectid import ObjectId
+import pytest
+
+
+MONGO_FILTER = {
+    "name" : {"name" : {"$regex" : "^INPUT_VALUE"}},
+    "score" : {"grades.score" : {"$gte" : "INPUT_VALUE"}},
+    "borough" : {"borough" : {"$in" : ["Bronx", "INPUT_VALUE"]}},
+    "id" : {"_id" : "INPUT_VALUE"},
+    "active" : {"address.building" : {"$exists" : True}}
+}
+
+
+@pytest.mark.unittest
+def test_compile_records_placeholders():
+    """ verify every INPUT_VALUE is found with the kind of substitution it takes """
+    templates = FilterTemplate.compile_filters(MONGO_FILTER)
+
+    assert templates["name"].placeholders == [(("name", "$regex"), FilterTemplate.IN_STRING)]
+    assert templates["score"].placeholders == [(("grades.score", "$gte"), FilterTemplate.WHOLE_VALUE)]
+    assert templates["borough"].placeholders == [(("borough", "$in", 1), FilterTemplate.WHOLE_VALUE)]
+    assert templates["active"].has_input is False
+
+@pytest.mark.unittest
+def test_bind_casts_by_parameter_type():
+    """ verify values are bound as text or json by their interject type, quotes included """
+    templates = FilterTemplate.compile_filters(MONGO_FILTER)
+
+    assert templates["score"].bind("10", "INT") == {"grades.score" : {"$gte" : 10}}
+    assert templates["score"].bind("10", "VARCHAR") == {"grades.score" : {"$gte" : "10"}}
+    assert templates["name"].bind('Joe\'s "Diner"', "VARCHAR") == {"name" : {"$regex" : '^Joe\'s "Diner"'}}
+    assert templates["borough"].bind("Queens", "VARCHAR") == {"borough" : {"$in" : ["Bronx", "Queens"]}}
+
+    _id = ObjectId()
+    assert templates["id"].bind(str(_id), "VARCHAR") == {"_id" : _id}
+
+@pytest.mark.unittest
+def test_bind_returns_fresh_filters():
+    """ verify bound filters can be changed without changing the template """
+    template = FilterTemplate.FilterTemplate("borough", MONGO_FILTER["borough"])
+
+    first = template.bind("Queens", "VARCHAR")
+    first["borough"]["$in"].append("Brooklyn")
+    assert template.bind("Queens", "VARCHAR") == {"borough" : {"$in" : ["Bronx", "Queens"]}}
+    assert MONGO_FILTER["borough"] == {"borough" : {"$in" : ["Bronx", "INPUT_VALUE"]}}
+
+@pytest.mark.unittest
+def test_handler_default_filter():
+    """ verify only filters without an INPUT_VALUE make up the handler's default filter """
+    handler = MongoHandler.MongoHandler({"mongoFilter" : MONGO_FILTER})
+
+    assert handler.mongo_filter == {"address.building" : {"$exists" : True}}
+    assert handler.get_mongo_search_query("name", "Jo", "VARCHAR") == {"name" : {"$regex" : "^Jo"}}
+    assert handler.get_mongo_search_query("missing", "x", "VARCHAR") == {"missing" : "x"}
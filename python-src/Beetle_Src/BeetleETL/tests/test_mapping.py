@@ -0,0 +1,338 @@
+"""
+Contains all tests related to the MappingPlan
+
+NOTE: all tests must be functions with names defined using
+    the following format:
+
+    def test_XXXXX():
+
+"""
+
+from BeetleETL.Handlers import MappingPlan
+from BeetleETL.Handlers import ColumnarEngine
+from BeetleETL.Handlers import MongoHandler
+import pytest
+
+
+TEST_DOC = {
+    "_id" : "5b1f1a2b3c4d5e6f7a8b9c0d",
+    "address" : {"building" : "1007", "coord" : [-73.8, 40.8], "street" : "Morris Park Ave"},
+    "borough" : "Bronx",
+    "grades" : [
+        {"date" : "2014-03-03", "grade" : "A", "score" : 2},
+        {"date" : "2013-09-11", "grade" : "A", "score" : 6},
+        {"date" : "2013-01-24", "grade" : "B"}
+    ]
+}
+
+TEST_MAPPING = [
+    {
+        "sql_dest" : {"schema" : "dbo", "db" : "test", "table" : "address"},
+        "sql_cols" : {
+            "_id" : {"mongo_path" : "_id"},
+            "building" : {"mongo_path" : "address.building", "target_type" : "str"},
+            "coord_x" : {"mongo_path" : "address.coord[0]", "target_type" : "int"},
+            "zipcode" : {"mongo_path" : "address.zipcode"}
+        }
+    },
+    {
+        "sql_dest" : {"schema" : "dbo", "db" : "test", "table" : "grades"},
+        "sql_cols" : {
+            "_id" : {"mongo_path" : "_id"},
+            "source" : {"static_val" : "beetle"},
+            "date" : {"mongo_path" : "grades[all].date", "target_type" : "date"},
+            "score" : {"mongo_path" : "grades[all].score", "target_type" : "int"}
+        }
+    }
+]
+
+
+@pytest.mark.unittest
+def test_parse_mongo_path():
+    """ verify mongo paths are tokenized into key, index and all steps """
+    assert MappingPlan.parse_mongo_path("grades[all].date") == (
+        (MappingPlan.KEY_STEP, "grades"),
+        (MappingPlan.ALL_STEP, None),
+        (MappingPlan.KEY_STEP, "date")
+        )
+    assert MappingPlan.parse_mongo_path("level1[all][1]") == (
+        (MappingPlan.KEY_STEP, "level1"),
+        (MappingPlan.ALL_STEP, None),
+        (MappingPlan.INDEX_STEP, 1)
+        )
+
+    # a non numeric index is a config error
+    with pytest.raises(ValueError):
+        MappingPlan.parse_mongo_path("address.coord[x]")
+
+@pytest.mark.unittest
+def test_column_extract_matches_get_val_from_dict():
+    """ verify a compiled column finds the same values as get_val_from_dict """
+    test_dict = {"level1":[[{"ne":"v1"},1], [{"ne":"v2"},4], [{"ne":"v3"},7]]}
+    cases = [
+        ("level1[all][all].ne", {}),
+        ("level1[all][all].ne", {"valid_types" : ["str"]}),
+        ("level1[all][0]", {"valid_types" : ["dict"], "target_type" : "str"}),
+        ("level1[1][1]", {"target_type" : "int"}),
+        ("missing.path", {})
+    ]
+
+    for path, options in cases:
+        response = []
+        index_response = []
+        MongoHandler.MongoHandler().get_val_from_dict(
+            test_dict,
+            path.split("."),
+            out=response,
+            valid_types=options.get("valid_types", ["none"]),
+            target_type=options.get("target_type", ""),
+            index_list=index_response
+        )
+
+        col_config = dict(options)
+        col_config["mongo_path"] = path
+        values, indexes = MappingPlan.ColumnPlan("col", col_config).extract(test_dict)
+        assert values == response
+        assert indexes == index_response
+
+@pytest.mark.unittest
+def test_map_flatten_rows():
+    """ verify a map flattens [all] lists into rows and pads the other columns """
+    plan = MappingPlan.MappingPlan(TEST_MAPPING)
+    packages = plan.build_packages()
+
+    for map_plan, pkg in zip(plan.maps, packages):
+        assert map_plan.flatten(TEST_DOC, pkg) is True
+
+    assert packages[0].data == [[TEST_DOC["_id"], "1007", -73.8, None]]
+    assert packages[1].data == [
+        [TEST_DOC["_id"], "beetle", "2014-03-03", 2],
+        [TEST_DOC["_id"], "beetle", "2013-09-11", 6],
+        [TEST_DOC["_id"], "beetle", "2013-01-24", None]
+        ]
+
+@pytest.mark.unittest
+def test_map_flatten_add_index():
+    """ verify add_index appends the list location of each row to the id """
+    plan = MappingPlan.MappingPlan(TEST_MAPPING)
+    pkg = plan.maps[1].build_package()
+    plan.maps[1].flatten(TEST_DOC, pkg, add_index=True)
+
+    assert pkg.data[1][0] == TEST_DOC["_id"] + "|date::1|score::1"
+
+@pytest.mark.unittest
+def test_map_flatten_required_missing():
+    """ verify a missing required column stops the map """
+    mapping = [{
+        "sql_dest" : {"schema" : "dbo", "db" : "test", "table" : "address"},
+        "sql_cols" : {
+            "_id" : {"mongo_path" : "_id"},
+            "zipcode" : {"mongo_path" : "address.zipcode", "required" : True}
+        }
+    }]
+    plan = MappingPlan.MappingPlan(mapping)
+    pkg = plan.maps[0].build_package()
+
+    assert plan.maps[0].flatten(TEST_DOC, pkg) is False
+    assert pkg.data == []
+
+@pytest.mark.unittest
+def test_mapping_flatten_matches_map_flatten():
+    """ verify walking the shared trie gives the same rows as flattening each map alone """
+    plan = MappingPlan.MappingPlan(TEST_MAPPING)
+    docs = [TEST_DOC, {"_id" : "empty"}, {"_id" : "list", "grades" : [], "address" : [1, 2]}]
+
+    for add_index in (False, True):
+        trie_packages = plan.build_packages()
+        map_packages = plan.build_packages()
+        for doc in docs:
+            assert plan.flatten(doc, trie_packages, add_index) is True
+            for map_plan, pkg in zip(plan.maps, map_packages):
+                map_plan.flatten(doc, pkg, add_index)
+
+        for trie_pkg, map_pkg in zip(trie_packages, map_packages):
+            assert trie_pkg.data == map_pkg.data
+
+@pytest.mark.unittest
+def test_mapping_trie_shares_prefixes():
+    """ verify columns with the same path prefix share trie nodes """
+    plan = MappingPlan.MappingPlan(TEST_MAPPING)
+
+    # _id, address and grades are the only roots across both maps
+    assert len(plan.root.children) == 3
+    grades = [node for step, node in plan.root.children if step == (MappingPlan.KEY_STEP, "grades")][0]
+    assert len(grades.children) == 1
+
+@pytest.mark.unittest
+def test_build_projection():
+    """ verify the projection covers every mapped field without path collisions """
+    plan = MappingPlan.MappingPlan(TEST_MAPPING)
+
+    # coord[0] and grades[all] index a list so the whole list is kept
+    assert plan.build_projection() == {
+        "_id" : 1,
+        "address.building" : 1,
+        "address.coord" : 1,
+        "address.zipcode" : 1,
+        "grades" : 1
+        }
+
+    mapping = [{
+        "sql_dest" : {"schema" : "dbo", "db" : "test", "table" : "address"},
+        "sql_cols" : {
+            "building" : {"mongo_path" : "address.building"},
+            "street" : {"mongo_path" : "address.street"},
+            "source" : {"static_val" : "beetle"}
+        }
+    }]
+    assert MappingPlan.MappingPlan(mapping).build_projection() == {
+        "_id" : 1,
+        "address.building" : 1,
+        "address.street" : 1
+        }
+
+@pytest.mark.unittest
+def test_mapping_flatten_raw_bson():
+    """ verify raw bson documents flatten into the same rows as decoded documents """
+    import bson
+    from bson.codec_options import CodecOptions
+    from bson.raw_bson import RawBSONDocument
+
+    mapping = [dict(TEST_MAPPING[1]), {
+        "sql_dest" : {"schema" : "dbo", "db" : "test", "table" : "raw"},
+        "sql_cols" : {
+            "_id" : {"mongo_path" : "_id"},
+            "address" : {"mongo_path" : "address", "valid_types" : ["dict"], "target_type" : "str"},
+            "grades" : {"mongo_path" : "grades", "valid_types" : ["list"], "target_type" : "str"}
+        }
+    }]
+    plan = MappingPlan.MappingPlan(mapping)
+    raw_doc = RawBSONDocument(bson.encode(TEST_DOC),
+        codec_options=CodecOptions(document_class=RawBSONDocument))
+
+    dict_packages = plan.build_packages()
+    raw_packages = plan.build_packages()
+    assert plan.flatten(TEST_DOC, dict_packages) is True
+    assert plan.flatten(raw_doc, raw_packages) is True
+
+    for dict_pkg, raw_pkg in zip(dict_packages, raw_packages):
+        assert dict_pkg.data == raw_pkg.data
+    assert raw_packages[1].data[0][2] == str(TEST_DOC["grades"])
+
+    # the columnar engine decodes lists of documents the same way
+    columnar_mapping = [{
+        "sql_dest" : {"schema" : "dbo", "db" : "test", "table" : "raw"},
+        "sql_cols" : {"address" : {"mongo_path" : "address"}, "grades" : {"mongo_path" : "grades"}}
+    }]
+    columnar_plan = ColumnarEngine.setup_columnar(MappingPlan.MappingPlan(columnar_mapping))
+    columnar_packages = columnar_plan.build_packages()
+    assert ColumnarEngine.flatten_batch(columnar_plan, [raw_doc], columnar_packages) is True
+    assert columnar_packages[0].data == [[str(TEST_DOC["address"]), str(TEST_DOC["grades"])]]
+
+def unwind(doc, field, preserve_empty=True):
+    """ mimics a mongo $unwind stage with includeArrayIndex for tests """
+    values = doc.get(field)
+    if not isinstance(values, list) or len(values) == 0:
+        if not preserve_empty:
+            return []
+        flat = {k : v for k, v in doc.items() if k != field}
+        flat[MappingPlan.UNWIND_INDEX_FIELD] = None
+        return [flat]
+
+    out = []
+    for i in range(len(values)):
+        flat = dict(doc)
+        flat[field] = values[i]
+        flat[MappingPlan.UNWIND_INDEX_FIELD] = i
+        out.append(flat)
+    return out
+
+@pytest.mark.unittest
+def test_pushdown_matches_client_rows():
+    """ verify unwound documents flatten into the same rows as client side fan-out """
+    client_map = MappingPlan.MapPlan(TEST_MAPPING[1])
+    pushdown_config = dict(TEST_MAPPING[1])
+    pushdown_config["array_mode"] = "pushdown"
+    pushdown_map = MappingPlan.MapPlan(pushdown_config)
+
+    assert pushdown_map.pushdown is True
+    assert pushdown_map.unwind_path == "grades"
+    assert pushdown_map.build_pipeline({"borough" : "Bronx"})[-1]["$unwind"]["path"] == "$grades"
+
+    docs = [TEST_DOC, {"_id" : "empty", "grades" : []}, {"_id" : "missing"}]
+    for add_index in (False, True):
+        client_pkg = client_map.build_package()
+        pushdown_pkg = pushdown_map.build_package()
+        for doc in docs:
+            client_map.flatten(doc, client_pkg, add_index)
+            for flat_doc in unwind(doc, "grades", pushdown_map.preserve_empty):
+                pushdown_map.flatten_unwound(flat_doc, pushdown_pkg, add_index)
+        assert client_pkg.data == pushdown_pkg.data
+
+@pytest.mark.unittest
+def test_pushdown_falls_back_to_client():
+    """ verify maps fanning out more than one list stay client side """
+    map_config = {
+        "sql_dest" : {"schema" : "dbo", "db" : "test", "table" : "grades"},
+        "array_mode" : "pushdown",
+        "sql_cols" : {
+            "_id" : {"mongo_path" : "_id"},
+            "score" : {"mongo_path" : "grades[all].score"},
+            "coord" : {"mongo_path" : "address.coord[all]"}
+        }
+    }
+    plan = MappingPlan.MappingPlan([map_config])
+
+    assert plan.maps[0].pushdown is False
+    assert plan.slots[0] is not None
+
+@pytest.mark.unittest
+def test_summary_pipeline():
+    """ verify aggregate columns group the map by its other columns on the server """
+    map_config = {
+        "sql_dest" : {"schema" : "dbo", "db" : "test", "table" : "borough_scores"},
+        "sql_cols" : {
+            "borough" : {"mongo_path" : "borough"},
+            "day" : {"mongo_path" : "grades[all].date", "date_unit" : "day"},
+            "restaurants" : {"aggregate" : "count", "target_type" : "int"},
+            "avg_score" : {"mongo_path" : "grades[all].score", "aggregate" : "avg", "target_type" : "int"},
+            "source" : {"static_val" : "beetle"}
+        }
+    }
+    plan = MappingPlan.MappingPlan([map_config, TEST_MAPPING[0]])
+    summary = plan.maps[0]
+
+    assert summary.summary is True
+    assert plan.slots[0] is None
+    assert plan.needs_documents() is True
+    assert summary.build_summary_pipeline({"borough" : "Bronx"}) == [
+        {"$match" : {"borough" : "Bronx"}},
+        {"$unwind" : {"path" : "$grades", "preserveNullAndEmptyArrays" : False}},
+        {"$group" : {
+            "_id" : {"c0" : "$borough", "c1" : {"$dateTrunc" : {"date" : "$grades.date", "unit" : "day"}}},
+            "c2" : {"$sum" : 1},
+            "c3" : {"$avg" : "$grades.score"}
+            }},
+        {"$project" : {"_id" : 0, "c0" : "$_id.c0", "c1" : "$_id.c1", "c2" : 1, "c3" : 1}},
+        {"$sort" : {"c0" : 1, "c1" : 1}}
+        ]
+
+    pkg = summary.build_package()
+    assert summary.flatten_summary({"c0" : "Bronx", "c1" : "2014-03-03", "c2" : 2, "c3" : 4.0}, pkg) is True
+    assert pkg.data == [["Bronx", "2014-03-03", 2, 4.0, "beetle"]]
+
+@pytest.mark.unittest
+def test_summary_rejects_unsupported_columns():
+    """ verify summary maps only accept known aggregates and a single [all] list """
+    def summary_map(sql_cols):
+        return {"sql_dest" : {"schema" : "dbo", "db" : "test", "table" : "s"}, "sql_cols" : sql_cols}
+
+    invalid = [
+        {"n" : {"mongo_path" : "score", "aggregate" : "median"}},
+        {"n" : {"aggregate" : "avg"}},
+        {"x" : {"mongo_path" : "address.coord[0]"}, "n" : {"aggregate" : "count"}},
+        {"x" : {"mongo_path" : "grades[all].date"}, "n" : {"mongo_path" : "address.coord[all]", "aggregate" : "sum"}}
+    ]
+    for sql_cols in invalid:
+        with pytest.raises(ValueError):
+            MappingPlan.MapPlan(summary_map(sql_cols))
@@ -221,3 +221,752 @@ def test_pull_required_value_missing(config_path, config_name):
 
     # close connection
     MongoObj.close_connection()
+
+
+@pytest.mark.unittest
+def test_and_filters():
+    """ verify filters are combined with $and and empty filters are dropped """
+    id_query = {"_id" : {"$gt" : 1}}
+
+    assert MongoHandler.and_filters({}, None) == {}
+    assert MongoHandler.and_filters({}, id_query) == id_query
+    assert MongoHandler.and_filters({"borough" : "Bronx"}, id_query) == {
+        "$and" : [{"borough" : "Bronx"}, id_query]
+        }
+
+@pytest.mark.unittest
+def test_parse_object_id():
+    """ verify only valid ObjectId strings are converted """
+    assert isinstance(MongoHandler.parse_object_id("5b1f1a2b3c4d5e6f7a8b9c0d"), MongoHandler.ObjectId)
+    assert MongoHandler.parse_object_id("restaurant-1") == "restaurant-1"
+    assert MongoHandler.parse_object_id(12) == 12
+
+@pytest.mark.unittest
+def test_get_partition_bounds(fake_collection):
+    """ verify ObjectId ranges are split into contiguous _id partitions """
+    import datetime
+
+    start = datetime.datetime(2018, 1, 1, tzinfo=datetime.timezone.utc)
+    first_id = MongoHandler.ObjectId.from_datetime(start)
+    last_id = MongoHandler.ObjectId.from_datetime(start + datetime.timedelta(days=4))
+
+    bounds = MongoHandler.get_partition_bounds(fake_collection([{"_id" : first_id}, {"_id" : last_id}]), {}, 4)
+    assert len(bounds) == 4
+    assert "$gte" not in bounds[0]["_id"] and "$lt" not in bounds[-1]["_id"]
+    for prev, nxt in zip(bounds, bounds[1:]):
+        assert prev["_id"]["$lt"] == nxt["_id"]["$gte"]
+    assert bounds[1]["_id"]["$gte"].generation_time == start + datetime.timedelta(days=1)
+
+    # ids which are not ObjectIds can not be split
+    assert MongoHandler.get_partition_bounds(fake_collection([{"_id" : 1}, {"_id" : 100}]), {}, 4) == [{}]
+
+@pytest.mark.unittest
+def test_merge_partitions():
+    """ verify partitions are merged in _id order, the last _id comes from the last
+        non empty partition and one failed partition fails the pull
+    """
+    from BeetleETL.Handlers import MappingPlan
+
+    plan = MappingPlan.MappingPlan([{
+        "sql_dest" : {"schema" : "dbo", "db" : "test", "table" : "docs"},
+        "sql_cols" : {"_id" : {"mongo_path" : "_id"}}
+    }])
+
+    def partition(ids):
+        packages = plan.build_packages()
+        for _id in ids:
+            plan.flatten({"_id" : _id}, packages)
+        return packages, len(ids), ids[-1] if ids else None, 0.1
+
+    results = [partition([1, 2]), partition([]), partition([5]), partition([])]
+    package_list = plan.build_packages()
+    assert MongoHandler.merge_partitions(results, package_list) == (3, 5)
+    assert package_list[0].data == [["1"], ["2"], ["5"]]
+
+    package_list = plan.build_packages()
+    results[2] = (None, 0, None, 0.1)
+    assert MongoHandler.merge_partitions(results, package_list) is None
+    assert package_list[0].data == []
+
+@pytest.mark.unittest
+def test_pull_partitions(fake_collection, monkeypatch):
+    """ verify a parallel pull flattens every _id range with pull_partition and
+        fails when one range fails
+    """
+    import datetime
+    import types
+
+    class InlinePool():
+        """ runs the partitions in this process so they read the fake collection """
+        def __init__(self, processes):
+            self.processes = processes
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *args):
+            pass
+
+        def map(self, func, tasks):
+            return [func(task) for task in tasks]
+
+    start = datetime.datetime(2018, 1, 1, tzinfo=datetime.timezone.utc)
+    ids = [MongoHandler.ObjectId.from_datetime(start + datetime.timedelta(days=day)) for day in (0, 1, 5, 6, 8)]
+    config = {
+        "connectionInfo" : {"mongoDatabase" : "db", "mongoCollection" : "coll"},
+        "data" : {},
+        "parallelWorkers" : 4,
+        "mapping" : [{
+            "sql_dest" : {"schema" : "dbo", "db" : "test", "table" : "docs"},
+            "sql_cols" : {"_id" : {"mongo_path" : "_id"}, "name" : {"mongo_path" : "name", "required" : True}}
+        }]
+    }
+    collection = fake_collection([{"_id" : _id, "name" : str(i)} for i, _id in reversed(list(enumerate(ids)))])
+    monkeypatch.setattr(MongoHandler.MongoHandler, "get_client", lambda self: {"db" : {"coll" : collection}})
+    monkeypatch.setattr(MongoHandler.MongoHandler, "release_client", lambda self, client: None)
+    monkeypatch.setattr(MongoHandler.multiprocessing, "get_context", lambda method: types.SimpleNamespace(Pool=InlinePool))
+
+    result = MongoHandler.MongoHandler(config).pull({})
+    # the first and last _id are read for the bounds then each range is read once
+    assert len([f for f in collection.finds if "_id" in f]) == 4
+    assert result.docs_pulled == 5
+    assert [row[1] for row in result.packages[0].data] == ["0", "1", "2", "3", "4"]
+    assert result.watermarks == {"lastMongoIdPulled" : MongoHandler.to_config_value(ids[-1])}
+
+    # a document missing required data fails its range and the whole pull
+    del collection.docs[1]["name"]
+    assert MongoHandler.MongoHandler(config).pull({}) is None
+
+@pytest.mark.unittest
+def test_limit_filter(fake_collection):
+    """ verify a capped pull is bounded at the _id of its last document """
+    collection = fake_collection([{"_id" : i, "borough" : "Bronx"} for i in [5, 3, 1, 4, 2]])
+
+    assert MongoHandler.limit_filter(collection, {"borough" : "Bronx"}, 3) == {
+        "$and" : [{"borough" : "Bronx"}, {"_id" : {"$lte" : 3}}]
+        }
+
+    # fewer documents than the limit leaves the filter unbounded
+    assert MongoHandler.limit_filter(collection, {}, 10) == {}
+
+@pytest.mark.unittest
+def test_pull_query_resumes_after_cursor_error(fake_collection):
+    """ verify a failed cursor is reopened after the last processed _id """
+    from BeetleETL.Handlers import MappingPlan
+
+    docs = [{"_id" : i, "name" : "doc{}".format(i)} for i in range(1, 7)]
+    mapping_plan = MappingPlan.MappingPlan([{
+        "sql_dest" : {"schema" : "dbo", "db" : "test", "table" : "docs"},
+        "sql_cols" : {"_id" : {"mongo_path" : "_id"}, "name" : {"mongo_path" : "name"}}
+    }])
+    package_list = mapping_plan.build_packages()
+    collection = fake_collection(docs, fail_once_at=4)
+    result = MongoHandler.pull_query(collection, {}, None, mapping_plan, package_list,
+        config={"cursorRetryBackoffSec" : 0})
+
+    assert result == (6, (6,))
+    assert collection.finds == [{}, {"_id" : {"$gt" : 3}}]
+    assert [row[0] for row in package_list[0].data] == ["1", "2", "3", "4", "5", "6"]
+
+@pytest.mark.unittest
+def test_pull_is_reentrant(fake_collection):
+    """ verify concurrent pulls on one handler return their own packages and
+        leave the handler config unchanged
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    config = {
+        "connectionInfo" : {"mongoDatabase" : "db", "mongoCollection" : "coll"},
+        "data" : {"pullOnlyNew" : True, "lastMongoIdPulled" : ""},
+        "mapping" : [{
+            "sql_dest" : {"schema" : "dbo", "db" : "test", "table" : "docs"},
+            "sql_cols" : {"_id" : {"mongo_path" : "_id"}, "name" : {"mongo_path" : "name"}}
+        }]
+    }
+    collection = fake_collection([{"_id" : i, "name" : "doc{}".format(i)} for i in range(1, 51)])
+    handler = collection.attach(MongoHandler.MongoHandler(config))
+
+    def pull(last_pulled):
+        return handler.pull({}, data={"pullOnlyNew" : True, "lastMongoIdPulled" : last_pulled})
+
+    with ThreadPoolExecutor(8) as pool:
+        results = list(pool.map(pull, [i % 10 for i in range(40)]))
+
+    for i, result in enumerate(results):
+        low = i % 10
+        assert result.docs_pulled == 50 - low
+        assert [row[0] for row in result.packages[0].data] == [str(j) for j in range(low + 1, 51)]
+        assert result.watermarks == {"lastMongoIdPulled" : 50}
+    assert config["data"] == {"pullOnlyNew" : True, "lastMongoIdPulled" : ""}
+
+@pytest.mark.unittest
+def test_pull_only_new_keeps_id_type(fake_collection):
+    """ verify the lastMongoIdPulled watermark keeps the bson type of the _id so
+        later pulls continue after it for int, string and ObjectId _ids
+    """
+    from bson.objectid import ObjectId
+
+    ids = sorted(ObjectId() for i in range(8))
+    for new_ids in ([1, 2, 3, 4, 5, 6, 7, 8], ["a", "b", "c", "d", "e", "f", "g", "h"], ids):
+        config = {
+            "connectionInfo" : {"mongoDatabase" : "db", "mongoCollection" : "coll"},
+            "data" : {"pullOnlyNew" : True, "lastMongoIdPulled" : ""},
+            "mapping" : [{
+                "sql_dest" : {"schema" : "dbo", "db" : "test", "table" : "docs"},
+                "sql_cols" : {"_id" : {"mongo_path" : "_id"}}
+            }]
+        }
+        collection = fake_collection([{"_id" : i} for i in new_ids[:5]])
+        handler = collection.attach(MongoHandler.MongoHandler(config))
+
+        assert len(handler.pull_collection({})[0].data) == 5
+        collection.docs.extend({"_id" : i} for i in new_ids[5:])
+        assert [row[0] for row in handler.pull_collection({})[0].data] == [str(i) for i in new_ids[5:]]
+
+    # configs saved before the watermark kept its type hold ObjectIds as strings
+    config["data"]["lastMongoIdPulled"] = str(ids[6])
+    assert [row[0] for row in handler.pull_collection({})[0].data] == [str(ids[7])]
+
+@pytest.mark.unittest
+def test_pull_num_docs_limit(fake_collection):
+    """ verify numDocsToPull caps incremental runs, which continue after the chunk,
+        and is ignored by full refreshes
+    """
+    config = {
+        "connectionInfo" : {"mongoDatabase" : "db", "mongoCollection" : "coll"},
+        "data" : {"pullOnlyNew" : False, "lastMongoIdPulled" : ""},
+        "numDocsToPull" : 2,
+        "mapping" : [{
+            "sql_dest" : {"schema" : "dbo", "db" : "test", "table" : "docs"},
+            "sql_cols" : {"_id" : {"mongo_path" : "_id"}}
+        }]
+    }
+    collection = fake_collection([{"_id" : i} for i in range(1, 6)])
+    handler = collection.attach(MongoHandler.MongoHandler(config))
+
+    for run in range(2):
+        result = handler.pull({})
+        assert result.docs_pulled == 5
+        assert result.backlog_remaining is False
+
+    chunks = []
+    data = {"pullOnlyNew" : True, "lastMongoIdPulled" : ""}
+    while True:
+        result = handler.pull({}, data=data)
+        chunks.append([row[0] for row in result.packages[0].data])
+        data.update(result.watermarks)
+        if not result.backlog_remaining:
+            break
+    assert chunks == [["1", "2"], ["3", "4"], ["5"]]
+
+@pytest.mark.unittest
+def test_pull_modified_field(fake_collection, caplog):
+    """ verify modifiedField pulls read in (modifiedField, _id) order, resume after
+        the saved watermarks and keep them when the last document has no modifiedField
+    """
+    import datetime
+    import logging
+
+    def updated(day):
+        return datetime.datetime(2018, 1, day)
+
+    config = {
+        "connectionInfo" : {"mongoDatabase" : "db", "mongoCollection" : "coll"},
+        "data" : {},
+        "mapping" : [{
+            "sql_dest" : {"schema" : "dbo", "db" : "test", "table" : "docs"},
+            "sql_cols" : {"_id" : {"mongo_path" : "_id"}}
+        }]
+    }
+    collection = fake_collection([
+        {"_id" : 4, "updated" : updated(3)},
+        {"_id" : 1, "updated" : updated(1)},
+        {"_id" : 3, "updated" : updated(2)},
+        {"_id" : 5, "updated" : updated(3)},
+        {"_id" : 2, "updated" : updated(2)},
+        {"_id" : 6}
+        ])
+    handler = collection.attach(MongoHandler.MongoHandler(config))
+
+    data = {"modifiedField" : "updated"}
+    result = handler.pull({"updated" : {"$exists" : True}}, data=data)
+    assert collection.sorts[-1] == [("updated", 1), ("_id", 1)]
+    assert collection.projections[-1]["updated"] == 1
+    assert [row[0] for row in result.packages[0].data] == ["1", "2", "3", "4", "5"]
+    assert result.watermarks == {
+        "lastModifiedPulled" : MongoHandler.to_config_value(updated(3)),
+        "lastModifiedIdPulled" : 5
+        }
+
+    # ties on the modified field continue after the saved _id
+    data.update(MongoHandler.get_modified_watermarks("updated", (updated(2), 2)))
+    result = handler.pull({}, data=data)
+    assert collection.finds[-1] == {"$or" : [
+        {"updated" : {"$gt" : updated(2)}},
+        {"updated" : updated(2), "_id" : {"$gt" : 2}}
+        ]}
+    assert [row[0] for row in result.packages[0].data] == ["3", "4", "5"]
+    assert result.watermarks["lastModifiedIdPulled"] == 5
+
+    # a last document without the field has no watermark to save
+    with caplog.at_level(logging.WARNING):
+        result = handler.pull({"_id" : 6}, data={"modifiedField" : "updated"})
+    assert result.docs_pulled == 1
+    assert result.watermarks == {}
+    assert "last document pulled has no updated" in caplog.text
+
+@pytest.mark.unittest
+def test_pull_summary_only(fake_collection):
+    """ verify a mapping of summary maps only reads the count, last _id and summary rows """
+
+    def aggregate_result(pipeline):
+        if "$group" in pipeline[-1]:
+            return [{"_id" : None, "docs" : 3, "last" : {"k0" : 7}}]
+        return [{"c0" : "Bronx", "c1" : 2}, {"c0" : "Queens", "c1" : 1}]
+
+    config = {
+        "connectionInfo" : {"mongoDatabase" : "db", "mongoCollection" : "coll"},
+        "data" : {"pullOnlyNew" : False, "lastMongoIdPulled" : ""},
+        "mapping" : [{
+            "sql_dest" : {"schema" : "dbo", "db" : "test", "table" : "boroughs"},
+            "sql_cols" : {"borough" : {"mongo_path" : "borough"}, "restaurants" : {"aggregate" : "count"}}
+        }]
+    }
+    collection = fake_collection(aggregate_result=aggregate_result)
+    handler = collection.attach(MongoHandler.MongoHandler(config))
+    result = handler.pull({"borough" : {"$ne" : None}})
+
+    assert collection.finds == []
+    assert result.docs_pulled == 3
+    assert result.watermarks == {"lastMongoIdPulled" : 7}
+    assert result.packages[0].data == [["Bronx", "2"], ["Queens", "1"]]
+    # the summary covers the documents up to the last _id counted
+    assert collection.pipelines[1][0] == {"$match" : {"$and" : [{"borough" : {"$ne" : None}}, {"_id" : {"$lte" : 7}}]}}
+
+    # only grouping the new documents would replace the totals with partial ones
+    for data in ({"pullOnlyNew" : True, "lastMongoIdPulled" : 7}, {"modifiedField" : "updated"}):
+        assert handler.pull({}, data=data) is None
+    assert len(collection.pipelines) == 2
+
+@pytest.mark.unittest
+def test_pull_result_cache(fake_collection):
+    """ verify repeated pulls with the same filter are served from the result cache as copies """
+    import copy
+    import threading
+
+    config = {
+        "connectionInfo" : {"mongoDatabase" : "db", "mongoCollection" : "cached", "customMongoURI" : "mongodb://server1"},
+        "data" : {},
+        "resultCacheTTLSec" : 60,
+        "mapping" : [{
+            "sql_dest" : {"schema" : "dbo", "db" : "test", "table" : "docs"},
+            "sql_cols" : {"_id" : {"mongo_path" : "_id"}, "name" : {"mongo_path" : "name"}}
+        }]
+    }
+    cache_key = ("mongodb://server1", "db.cached")
+    MongoHandler.result_caches.pop(cache_key, None)
+    collection = fake_collection([{"_id" : 1, "name" : "a"}, {"_id" : 2, "name" : "b"}])
+    handler = collection.attach(MongoHandler.MongoHandler(config))
+
+    first = handler.pull({"name" : "a"})
+    first.packages[0].data.append(["changed", "rows"])
+    second = handler.pull({"name" : "a"})
+    other = handler.pull({"name" : "b"})
+
+    assert len(collection.finds) == 2
+    assert second.packages[0].data == [["1", "a"]]
+    assert other.packages[0].data == [["2", "b"]]
+    assert handler.result_cache_stats() == {"size" : 2, "hits" : 1, "misses" : 2, "evictions" : 0, "expirations" : 0, "invalidations" : 0}
+
+    # a change stream event drops every entry of the collection
+    MongoHandler.result_caches[cache_key].invalidate()
+    handler.pull({"name" : "a"})
+    assert len(collection.finds) == 3
+
+    # the same database and collection on another server has its own cache
+    other_config = copy.deepcopy(config)
+    other_config["connectionInfo"]["customMongoURI"] = "mongodb://server2"
+    other_handler = collection.attach(MongoHandler.MongoHandler(other_config))
+    MongoHandler.result_caches.pop(("mongodb://server2", "db.cached"), None)
+    other_handler.pull({"name" : "a"})
+    assert len(collection.finds) == 4
+
+    # a watcher which stops drops the entries and is started again by the next pull
+    collection.changes = []
+    MongoHandler.result_cache_watchers.add(cache_key)
+    handler.invalidate_on_change(cache_key, MongoHandler.result_caches[cache_key])
+    assert handler.result_cache_stats()["size"] == 0
+    assert cache_key not in MongoHandler.result_cache_watchers
+    assert cache_key not in MongoHandler.result_cache_retry_after
+
+    # a collection which can not be watched keeps its entries and is not watched on every pull
+    collection.changes = None
+    config["resultCacheWatch"] = True
+    for run in range(2):
+        handler.pull({"name" : "b"})
+        for thread in threading.enumerate():
+            if thread.name == "result-cache-db.cached":
+                thread.join()
+    assert len(collection.watches) == 2
+    assert len(collection.finds) == 5
+    assert cache_key in MongoHandler.result_cache_retry_after
+    MongoHandler.result_cache_retry_after.pop(cache_key)
+
+@pytest.mark.unittest
+def test_pull_page_tokens(fake_collection):
+    """ verify pages follow each other through their tokens and plan_pages tokens start the same pages """
+    config = {
+        "connectionInfo" : {"mongoDatabase" : "db", "mongoCollection" : "coll"},
+        "data" : {"pullOnlyNew" : True, "lastMongoIdPulled" : ""},
+        "pageSize" : 3,
+        "mapping" : [{
+            "sql_dest" : {"schema" : "dbo", "db" : "test", "table" : "docs"},
+            "sql_cols" : {"_id" : {"mongo_path" : "_id"}, "name" : {"mongo_path" : "name"}}
+        }]
+    }
+    collection = fake_collection([{"_id" : i, "name" : "doc{}".format(i)} for i in range(1, 8)])
+    handler = collection.attach(MongoHandler.MongoHandler(config))
+
+    pages = []
+    token = None
+    while True:
+        result = handler.pull_page({}, token)
+        pages.append([row[0] for row in result.packages[0].data])
+        token = result.next_token
+        if token is None:
+            break
+
+    assert pages == [["1", "2", "3"], ["4", "5", "6"], ["7"]]
+    tokens = handler.plan_pages({})
+    assert [[row[0] for row in handler.pull_page({}, t).packages[0].data] for t in tokens] == pages
+    assert handler.pull_page({}, "not a token") is None
+    assert config["data"] == {"pullOnlyNew" : True, "lastMongoIdPulled" : ""}
+
+@pytest.mark.unittest
+def test_preview_samples_without_watermarks(fake_collection):
+    """ verify a preview flattens $sample documents, reports column stats and leaves the config data alone """
+    config = {
+        "connectionInfo" : {"mongoDatabase" : "db", "mongoCollection" : "coll"},
+        "data" : {"pullOnlyNew" : True, "lastMongoIdPulled" : "0"},
+        "mapping" : [{
+            "sql_dest" : {"schema" : "dbo", "db" : "test", "table" : "things"},
+            "sql_cols" : {"_id" : {"mongo_path" : "_id"}, "name" : {"mongo_path" : "name"}}
+        }]
+    }
+    collection = fake_collection([{"_id" : 1, "name" : "a", "tags" : ["x", "y"]}, {"_id" : 2, "tags" : []}])
+    handler = collection.attach(MongoHandler.MongoHandler(config))
+    result = handler.preview({}, size=2)
+
+    # $sample has to be the first stage to use the random cursor
+    assert collection.pipelines[0][0] == {"$sample" : {"size" : 2}}
+    assert result.docs_sampled == 2
+    assert result.packages[0].data == [["1", "a"], ["2", None]]
+    assert result.stats[0]["name"] == {"count" : 1, "nulls" : 1, "distinct" : 1, "types" : ["str"]}
+    assert result.to_dataframes()[0]["_id"].tolist() == ["1", "2"]
+    assert config["data"] == {"pullOnlyNew" : True, "lastMongoIdPulled" : "0"}
+
+    # a filtered preview reads the first matching documents instead of sorting them all
+    result = handler.preview({"name" : {"$exists" : True}}, size=1)
+    assert collection.finds == [{"name" : {"$exists" : True}}]
+    assert collection.limits == [1]
+    assert collection.sorts == []
+    assert len(collection.pipelines) == 1
+    assert result.packages[0].data == [["1", "a"]]
+
+    # a bad mapping is logged instead of raised
+    config["mapping"][0]["sql_cols"]["name"]["mongo_path"] = "name[bad"
+    handler.mapping_plan = None
+    assert handler.preview({}, size=2) is None
+
+@pytest.mark.unittest
+def test_lookup_resolver(fake_collection):
+    """ verify lookup columns are filled with one $in query per lookup and reuse the cache """
+    from BeetleETL.Handlers import MappingPlan
+
+    owners = fake_collection([{"_id" : 1, "name" : "Ann"}, {"_id" : 2, "name" : "Bob"}])
+    restaurants = fake_collection()
+    restaurants.database = {"owners" : owners}
+
+    mapping = [{
+        "sql_dest" : {"schema" : "dbo", "db" : "test", "table" : "restaurants"},
+        "sql_cols" : {
+            "_id" : {"mongo_path" : "_id"},
+            "owner" : {"mongo_path" : "owner_id", "lookup" : {"collection" : "owners", "value_path" : "name"}}
+        }
+    }]
+    config = {"mapping" : mapping}
+    plan = MappingPlan.MappingPlan(mapping)
+    handler = MongoHandler.MongoHandler(config)
+
+    for run in range(2):
+        packages = plan.build_packages()
+        for doc in [{"_id" : "a", "owner_id" : 1}, {"_id" : "b", "owner_id" : 2}, {"_id" : "c", "owner_id" : 3}, {"_id" : "d"}]:
+            plan.flatten(doc, packages)
+        lookups = handler.get_lookup_resolver(restaurants, plan)
+        assert lookups.enrich(packages, [0]) is True
+        assert packages[0].data == [["a", "Ann"], ["b", "Bob"], ["c", None], ["d", None]]
+
+    # the second run is served by the cache kept on the handler
+    assert len(owners.finds) == 1
+    assert sorted(owners.finds[0]["_id"]["$in"]) == [1, 2, 3]
+    assert lookups.stats == {("owners", "_id", "name") : [3, 0, 0]}
+
+@pytest.mark.unittest
+def test_save_batch(fake_collection):
+    """ verify saves skip unchanged documents and report each bulk write result """
+    from bson.objectid import ObjectId
+
+    ids = [ObjectId() for i in range(4)]
+    collection = fake_collection([
+        {"_id" : ids[0], "name" : "same", "grades" : [{"score" : 1}]},
+        {"_id" : ids[1], "name" : "old", "grades" : [{"score" : 1}]},
+        {"_id" : ids[2], "name" : "fails"}
+        ])
+    collection.bulk_write_error = MongoHandler.errors.BulkWriteError({"writeErrors" : [{"index" : 1, "errmsg" : "bad value"}]})
+
+    def update(_id, values):
+        return {"query" : {"_id" : _id}, "data" : {"$set" : values}, "options" : {"arrayFilters" : []}}
+
+    updates = [
+        update(ids[0], {"name" : "same", "grades.0.score" : 1}),
+        update(ids[1], {"name" : "new", "grades.0.score" : 1}),
+        update(ids[2], {"name" : 5}),
+        update(ids[3], {"name" : "inserted"})
+    ]
+    messages = MongoHandler.save_batch(collection, updates)
+
+    assert collection.projections == [{"name" : 1, "grades" : 1}]
+    assert len(collection.operations) == 3
+    assert collection.ordered == [False]
+    assert messages == ["no change", "document updated", "could not update: bad value", "document updated"]
+
+@pytest.mark.unittest
+def test_watch_collection(fake_collection):
+    """ verify changed documents are yielded in batches by size and by time with
+        the resume token of the last change, skipping documents missing required data
+    """
+    config = {
+        "connectionInfo" : {"mongoDatabase" : "db", "mongoCollection" : "coll"},
+        "mongoFilter" : {"bronx" : {"borough" : "Bronx"}},
+        "mapping" : [{
+            "sql_dest" : {"schema" : "dbo", "db" : "test", "table" : "docs"},
+            "sql_cols" : {"_id" : {"mongo_path" : "_id"}, "name" : {"mongo_path" : "name", "required" : True}}
+        }]
+    }
+
+    def change(_id, **fields):
+        return {"_id" : {"token" : _id}, "operationType" : "update", "fullDocument" : dict(fields, _id=_id)}
+
+    changes = [
+        change(1, name="a"), change(2),             # full batch, 2 has no name
+        change(3, name="c"), change(4, name="d"),   # full batch
+        None,                                       # nothing waiting
+        change(5, name="e"), None                   # partial batch sent after max_wait_sec
+    ]
+    collection = fake_collection(changes=changes, poll_sec=0.3)
+    handler = collection.attach(MongoHandler.MongoHandler(config))
+    batches = [([row[0] for row in packages[0].data], token)
+        for packages, token in handler.watch_collection({"token" : 0}, batch_size=2, max_wait_sec=0.2)]
+
+    assert batches == [(["1"], {"token" : 2}), (["3", "4"], {"token" : 4}), (["5"], {"token" : 5})]
+    pipeline, options = collection.watches[0]
+    assert options["resume_after"] == {"token" : 0}
+    assert options["full_document"] == "updateLookup"
+    assert pipeline[0]["$match"]["$and"][1] == {"fullDocument.borough" : "Bronx"}
+
+@pytest.mark.unittest
+def test_watch_collection_columnar(fake_collection):
+    """ verify stream batches flatten their columnar maps and skip only the
+        documents missing required data
+    """
+    from BeetleETL.Handlers import MappingPlan
+
+    mapping = [{
+        "sql_dest" : {"schema" : "dbo", "db" : "test", "table" : "tags"},
+        "sql_cols" : {
+            "_id" : {"mongo_path" : "_id"},
+            "name" : {"mongo_path" : "name", "required" : True},
+            "tag" : {"mongo_path" : "tags[all]"}
+        }
+    }, {
+        "sql_dest" : {"schema" : "dbo", "db" : "test", "table" : "names"},
+        "sql_cols" : {"_id" : {"mongo_path" : "_id"}, "name" : {"mongo_path" : "name", "valid_types" : ["str"]}}
+    }]
+    config = {
+        "connectionInfo" : {"mongoDatabase" : "db", "mongoCollection" : "coll"},
+        "flattenEngine" : "columnar",
+        "mapping" : mapping
+    }
+    docs = [{"_id" : 1, "name" : "a", "tags" : ["x", "y"]}, {"_id" : 2, "tags" : ["z"]}, {"_id" : 3, "name" : "c", "tags" : []}]
+    changes = [{"_id" : {"token" : doc["_id"]}, "operationType" : "insert", "fullDocument" : doc} for doc in docs]
+    handler = fake_collection(changes=changes).attach(MongoHandler.MongoHandler(config))
+    assert handler.get_mapping_plan().maps[0].columnar is not None
+
+    batches = list(handler.watch_collection(batch_size=3))
+
+    row_plan = MappingPlan.MappingPlan(mapping)
+    row_packages = row_plan.build_packages()
+    for doc in (docs[0], docs[2]):
+        assert row_plan.flatten(doc, row_packages) is True
+    assert len(batches) == 1
+    package_list, token = batches[0]
+    assert token == {"token" : 3}
+    assert package_list[0].data == row_packages[0].data
+    assert package_list[0].data[:2] == [["1", "a", "x"], ["1", "a", "y"]]
+    assert package_list[1].data == [["1", "a"], ["3", "c"]]
+
+    # documents are not unwound on the server in stream mode
+    mapping[0]["array_mode"] = "pushdown"
+    collection = fake_collection(changes=changes)
+    handler = collection.attach(MongoHandler.MongoHandler(dict(config, flattenEngine="row")))
+    assert list(handler.watch_collection(batch_size=3)) == []
+    assert collection.watches == []
+
+    # summaries of a batch of changed documents would replace the totals
+    mapping[0]["array_mode"] = "client"
+    mapping[1]["sql_cols"]["name"] = {"aggregate" : "count"}
+    handler = collection.attach(MongoHandler.MongoHandler(dict(config, flattenEngine="row")))
+    assert handler.get_mapping_plan().maps[1].summary
+    assert list(handler.watch_collection(batch_size=3)) == []
+    assert collection.watches == []
+
+@pytest.mark.unittest
+def test_remove_from_mongo(fake_collection):
+    """ verify deletes are sent in batches of deleteBatchSize and a failed batch
+        does not stop the batches after it
+    """
+    from bson.objectid import ObjectId
+
+    ids = [ObjectId() for i in range(6)]
+    config = {
+        "connectionInfo" : {"mongoDatabase" : "db", "mongoCollection" : "coll"},
+        "deleteBatchSize" : 2
+    }
+    collection = fake_collection([{"_id" : _id} for _id in ids])
+    collection.fail_deletes = {2}
+    handler = collection.attach(MongoHandler.MongoHandler(config))
+
+    # ids which are not ObjectIds are dropped and unknown ones delete nothing
+    missing = ObjectId()
+    deleted = handler.remove_from_mongo([str(_id) for _id in ids[:5]] + ["not-an-id", missing])
+
+    assert [f["_id"]["$in"] for f in collection.deletes] == [ids[0:2], ids[2:4], [ids[4], missing]]
+    assert deleted == 3
+    assert [doc["_id"] for doc in collection.docs] == ids[2:4] + ids[5:]
+
+@pytest.mark.unittest
+def test_to_object_ids():
+    """ verify ids are converted to ObjectIds and invalid ids are dropped """
+    _id = MongoHandler.ObjectId()
+    assert MongoHandler.to_object_ids([str(_id), "not an id", _id]) == [_id, _id]
+
+@pytest.mark.unittest
+def test_xml_to_dataframe_sources():
+    """ verify interject xml parses the same from a string, bytes and a file """
+    import io
+
+    xml = (
+        '<root>'
+        '<c Column="Row"/><c Column="_id"/><c Column="name"/>'
+        '<r><c>1</c><c>5b1f1a2b3c4d5e6f7a8b9c0d</c><c>first</c></r>'
+        '<r><c>2</c><c>5b1f1a2b3c4d5e6f7a8b9c0e</c><c/></r>'
+        '<r><c>3</c><c>5b1f1a2b3c4d5e6f7a8b9c0f</c></r>'
+        '</root>'
+        )
+    sources = [xml, xml.encode(), io.BytesIO(xml.encode()), io.StringIO(xml)]
+
+    for source in sources:
+        df_data, df_save = MongoHandler.MongoHandler.xml_to_dataframe(source)
+        assert df_data.columns.tolist() == ["_id", "name"]
+        assert df_data.fillna("").values.tolist() == [
+            ["5b1f1a2b3c4d5e6f7a8b9c0d", "first"],
+            ["5b1f1a2b3c4d5e6f7a8b9c0e", ""],
+            ["5b1f1a2b3c4d5e6f7a8b9c0f", ""]
+            ]
+        assert df_save.values.tolist() == [["1", ""], ["2", ""], ["3", ""]]
+
+    # small chunks split elements across feeds
+    chunks = list(MongoHandler.iter_xml_chunks(xml, chunk_size=7))
+    assert "".join(chunks) == xml
+
+@pytest.mark.unittest
+def test_dataframe_to_dict():
+    """ verify saved rows are routed to their mongo paths, cast and merged per document """
+    import pandas as pd
+    from bson.objectid import ObjectId
+
+    config = {"mapping" : [{
+        "sql_dest" : {"schema" : "dbo", "db" : "test", "table" : "grades"},
+        "sql_cols" : {
+            "_id" : {"mongo_path" : "_id"},
+            "name" : {"mongo_path" : "name", "allowMongoUpdate" : True},
+            "score" : {"mongo_path" : "grades[all].score", "allowMongoUpdate" : True, "mongoUpdateType" : "int"},
+            "grade" : {"mongo_path" : "grades[all].grade"}
+        }
+    }]}
+    ids = ["5b1f1a2b3c4d5e6f7a8b9c0d", "5b1f1a2b3c4d5e6f7a8b9c0e"]
+    dataframe = pd.DataFrame([
+        [ids[0] + "|score::0", "first", "1", "A"],
+        [ids[0] + "|score::1", "changed", "x", "B"],
+        ["", "skipped", "3", "C"],
+        [ids[1] + "|score::0", "second", "4", "D"]
+        ], columns=["_id", "name", "score", "grade"])
+
+    result = MongoHandler.MongoHandler(config).dataframe_to_dict(dataframe)
+
+    assert list(result.keys()) == ids
+    assert result[ids[0]]["query"] == {"_id" : ObjectId(ids[0])}
+    # a score which can not be cast is left out of the update and the first
+    # row's name is kept when later rows of the document save a different one
+    assert result[ids[0]]["data"] == {"$set" : {"name" : "first", "grades.0.score" : 1}}
+    assert result[ids[1]]["data"] == {"$set" : {"name" : "second", "grades.0.score" : 4}}
+    assert result[ids[1]]["options"] == {"arrayFilters" : []}
+
+@pytest.mark.unittest
+def test_keyset_filter():
+    """ verify keyset filters break ties on the fields after the first """
+    assert MongoHandler.keyset_filter(("_id",), (5,)) == {"_id" : {"$gt" : 5}}
+    assert MongoHandler.keyset_filter(("lastModified", "_id"), (10, 5)) == {"$or" : [
+        {"lastModified" : {"$gt" : 10}},
+        {"lastModified" : 10, "_id" : {"$gt" : 5}}
+        ]}
+    assert MongoHandler.keyset_filter(("lastModified", "_id"), (10, 5), "$lte") == {"$or" : [
+        {"lastModified" : {"$lt" : 10}},
+        {"lastModified" : 10, "_id" : {"$lte" : 5}}
+        ]}
+
+@pytest.mark.unittest
+def test_add_projection_field():
+    """ verify fields added to a projection do not collide with its paths """
+    assert MongoHandler.add_projection_field({"_id" : 1, "meta" : 1}, "meta.updated") == {"_id" : 1, "meta" : 1}
+    assert MongoHandler.add_projection_field({"_id" : 1, "meta.a" : 1}, "meta") == {"_id" : 1, "meta" : 1}
+    assert MongoHandler.add_projection_field({"_id" : 1}, "updated") == {"_id" : 1, "updated" : 1}
+    assert MongoHandler.add_projection_field(None, "updated") is None
+
+@pytest.mark.unittest
+def test_prefix_filter():
+    """ verify field names are prefixed while operators are kept """
+    query = {"borough" : "Bronx", "$or" : [{"cuisine" : "Bakery"}, {"grades.score" : {"$gt" : 5}}]}
+
+    assert MongoHandler.prefix_filter(query, "fullDocument.") == {
+        "fullDocument.borough" : "Bronx",
+        "$or" : [{"fullDocument.cuisine" : "Bakery"}, {"fullDocument.grades.score" : {"$gt" : 5}}]
+        }
+
+@pytest.mark.unittest
+def test_config_value_round_trip():
+    """ verify bson values survive being saved in the json config """
+    import datetime
+    import json
+
+    values = [
+        MongoHandler.ObjectId(),
+        datetime.datetime(2018, 9, 11, 8, 30),
+        {"_data" : "8262A1B2C3000000012B022C0100296E5A1004"}
+        ]
+    for value in values:
+        saved = json.loads(json.dumps(MongoHandler.to_config_value(value)))
+        loaded = MongoHandler.from_config_value(saved)
+        if isinstance(value, datetime.datetime):
+            loaded = loaded.replace(tzinfo=None)
+        assert loaded == value
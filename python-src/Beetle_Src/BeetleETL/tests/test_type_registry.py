@@ -0,0 +1,118 @@
+"""
+Contains all tests related to the TypeRegistry
+
+NOTE: all tests must be functions with names defined using
+    the following format:
+
+    def test_XXXXX():
+
+"""
+
+from BeetleETL.Handlers import TypeRegistry
+from BeetleETL.Handlers import MappingPlan
+from BeetleETL.Handlers import ColumnarEngine
+from bson.decimal128 import Decimal128
+import datetime
+import uuid
+import pytest
+
+
+def shout(value):
+    """ module level caster so it can be pickled for worker processes """
+    return str(value).upper()
+
+@pytest.mark.unittest
+def test_default_casters():
+    """ verify the shipped casters keep the cast_to_target_type rules """
+    date = datetime.datetime(2020, 1, 2)
+    assert TypeRegistry.get_caster("str")(5) == "5"
+    assert TypeRegistry.get_caster("int")("5") == 5.0
+    assert TypeRegistry.get_caster("int")("five") is None
+    assert TypeRegistry.get_caster("int")({"key" : "val"}) is None
+    assert TypeRegistry.get_caster("date")(date) == date.isoformat()
+    assert TypeRegistry.get_caster("")(None) == "None"
+    assert TypeRegistry.get_caster("unknown")(5) is None
+
+@pytest.mark.unittest
+def test_register_caster():
+    """ verify registered casters are used by columns on both flatten engines """
+    TypeRegistry.register_caster("decimal", lambda v: str(v.to_decimal()))
+    TypeRegistry.register_caster("str", lambda v: "<{}>".format(v))
+    try:
+        mapping = [{
+            "sql_dest" : {"schema" : "dbo", "db" : "test", "table" : "prices"},
+            "sql_cols" : {
+                "_id" : {"mongo_path" : "_id"},
+                "price" : {"mongo_path" : "price", "target_type" : "decimal"},
+                "name" : {"mongo_path" : "name", "target_type" : "str"}
+            }
+        }]
+        docs = [{"_id" : "a", "price" : Decimal128("1.50"), "name" : "x"}, {"_id" : "b", "price" : "bad"}]
+
+        plan = MappingPlan.MappingPlan(mapping)
+        row_pkg = plan.build_packages()
+        for doc in docs:
+            plan.flatten(doc, row_pkg)
+
+        ColumnarEngine.setup_columnar(plan)
+        columnar_pkg = plan.build_packages()
+        ColumnarEngine.flatten_batch(plan, docs, columnar_pkg)
+
+        # a caster raising inserts None
+        assert row_pkg[0].data == [["a", "1.50", "<x>"], ["b", None, None]]
+        assert columnar_pkg[0].data == row_pkg[0].data
+    finally:
+        TypeRegistry.CASTERS.pop("decimal")
+        TypeRegistry.CASTERS["str"] = TypeRegistry.DEFAULT_CASTERS["str"]
+
+@pytest.mark.unittest
+def test_valid_types_resolve_to_type_sets():
+    """ verify valid_types resolve to registered types and fall back to type names """
+    col = MappingPlan.ColumnPlan("col", {"mongo_path" : "a", "valid_types" : ["UUID", "Decimal128", "Timestamp"]})
+
+    assert col.valid_types == frozenset([uuid.UUID, Decimal128])
+    assert col.valid_names == frozenset(["Timestamp"])
+    assert col.is_valid(uuid.uuid4()) is True
+    assert col.is_valid("text") is False
+
+@pytest.mark.unittest
+def test_registry_reaches_worker_processes(fake_collection, monkeypatch):
+    """ verify partitions pulled by worker processes use the registered casters
+        and parallel pulls fall back to one process when they can not be pickled
+    """
+    import pickle
+    from BeetleETL.Handlers import MongoHandler
+
+    config = {
+        "connectionInfo" : {"mongoDatabase" : "db", "mongoCollection" : "coll"},
+        "data" : {},
+        "parallelWorkers" : 2,
+        "mapping" : [{
+            "sql_dest" : {"schema" : "dbo", "db" : "test", "table" : "docs"},
+            "sql_cols" : {"_id" : {"mongo_path" : "_id"}, "name" : {"mongo_path" : "name", "target_type" : "shout"}}
+        }]
+    }
+    collection = fake_collection([{"_id" : 1, "name" : "a"}, {"_id" : 2, "name" : "b"}])
+    monkeypatch.setattr(MongoHandler.MongoHandler, "get_client", lambda self: {"db" : {"coll" : collection}})
+    monkeypatch.setattr(MongoHandler.MongoHandler, "release_client", lambda self, client: None)
+    defaults = (dict(TypeRegistry.DEFAULT_CASTERS), dict(TypeRegistry.VALID_TYPES))
+
+    TypeRegistry.register_caster("shout", shout)
+    try:
+        assert TypeRegistry.is_picklable()
+        registry = pickle.loads(pickle.dumps(TypeRegistry.snapshot()))
+
+        # a spawned worker starts with the default casters only
+        TypeRegistry.restore(defaults)
+        packages, docs, last_id, runtime = MongoHandler.pull_partition((config, {}, None, False, registry))
+        assert (docs, last_id) == (2, 2)
+        assert packages[0].data == [["1", "A"], ["2", "B"]]
+        assert TypeRegistry.get_caster("shout") is registry[0]["shout"]
+
+        TypeRegistry.register_caster("shout", lambda value: str(value).upper())
+        assert not TypeRegistry.is_picklable()
+        result = MongoHandler.MongoHandler(config).pull({})
+        assert result.packages[0].data == [["1", "A"], ["2", "B"]]
+        assert collection.finds == [{}, {}]
+    finally:
+        TypeRegistry.restore(defaults)
@@ -10,7 +10,10 @@ TO RUN:
     <suite> -- functest
 """
 
+import time
 import pytest
+from pymongo import errors
+from pymongo.results import DeleteResult
 
 
 def pytest_addoption(parser):
@@ -32,4 +35,211 @@ def pytest_generate_tests(metafunc):
         metafunc.parametrize(
             "config_name", 
             metafunc.config.getoption('config_name')
-            )
\ No newline at end of file
+            )
+
+class FakeCursor():
+    """ cursor over the documents a FakeCollection matched, supporting the
+        sort, skip and limit calls made by the mongo handler
+    """
+    def __init__(self, collection, docs):
+        self.collection = collection
+        self.docs = docs
+
+    def sort(self, keys, direction=1):
+        if isinstance(keys, str):
+            keys = [(keys, direction)]
+        self.collection.sorts.append(list(keys))
+        for field, direction in reversed(list(keys)):
+            self.docs = sorted(self.docs, key=lambda doc: sort_key(get_field(doc, field)), reverse=direction < 0)
+        return self
+
+    def skip(self, count):
+        self.docs = self.docs[count:]
+        return self
+
+    def limit(self, count):
+        self.collection.limits.append(count)
+        if count > 0:
+            self.docs = self.docs[:count]
+        return self
+
+    def batch_size(self, size):
+        return self
+
+    def close(self):
+        pass
+
+    def __iter__(self):
+        for doc in self.docs:
+            # fail once when reaching the document with this _id
+            if self.collection.fail_once_at is not None and doc["_id"] == self.collection.fail_once_at:
+                self.collection.fail_once_at = None
+                raise errors.AutoReconnect("network blip")
+            yield doc
+
+
+class FakeChangeStream():
+    """ change stream yielding a list of change events, None entries are polls
+        which find no change after waiting poll_sec
+    """
+    def __init__(self, changes, poll_sec=0):
+        self.changes = list(changes)
+        self.poll_sec = poll_sec
+        self.resume_token = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    @property
+    def alive(self):
+        return len(self.changes) > 0
+
+    def try_next(self):
+        change = self.changes.pop(0)
+        if change is None:
+            time.sleep(self.poll_sec)
+        else:
+            self.resume_token = change["_id"]
+        return change
+
+    def __iter__(self):
+        while self.alive:
+            change = self.try_next()
+            if change is not None:
+                yield change
+
+
+class FakeCollection():
+    """ in-memory collection recording the queries the mongo handler sends
+
+        Arguments:
+            docs {list} -- documents in the collection
+            aggregate_result {function} -- returns the documents for a pipeline, by default
+                                           a leading $match and $sample or $limit are applied
+            changes {list} -- change events for watch, watch fails when None
+            poll_sec {float} -- time a poll of the change stream which finds no change takes
+            fail_once_at -- _id a find cursor fails at the first time it is reached
+    """
+    def __init__(self, docs=(), aggregate_result=None, changes=None, fail_once_at=None, poll_sec=0):
+        self.docs = list(docs)
+        self.aggregate_result = aggregate_result
+        self.changes = changes
+        self.poll_sec = poll_sec
+        self.fail_once_at = fail_once_at
+        self.database = {}
+        self.finds = []         # filters of every find
+        self.projections = []   # projections of every find
+        self.sorts = []         # sort keys of every find
+        self.limits = []        # limits of every find
+        self.pipelines = []     # pipelines of every aggregate
+        self.deletes = []       # filters of every delete_many
+        self.fail_deletes = set()   # delete_many calls (by number) which raise
+        self.operations = []    # operations of every bulk_write
+        self.ordered = []       # ordered flag of every bulk_write
+        self.watches = []       # pipeline and options of every watch
+        self.bulk_write_error = None    # raised by bulk_write when set
+
+    def attach(self, handler):
+        """ makes handler pull from this collection """
+        info = handler.config["connectionInfo"]
+        handler.get_client = lambda: {info["mongoDatabase"] : {info["mongoCollection"] : self}}
+        handler.release_client = lambda client: None
+        return handler
+
+    def find(self, query_filter=None, projection=None):
+        self.finds.append(query_filter)
+        self.projections.append(projection)
+        return FakeCursor(self, [doc for doc in self.docs if matches(doc, query_filter or {})])
+
+    def find_one(self, query_filter=None, projection=None, sort=None):
+        cur = self.find(query_filter, projection)
+        if sort is not None:
+            cur = cur.sort(sort)
+        return next(iter(cur.docs), None)
+
+    def aggregate(self, pipeline, allowDiskUse=False):
+        self.pipelines.append(pipeline)
+        if self.aggregate_result is not None:
+            return self.aggregate_result(pipeline)
+        docs = self.docs
+        for stage in pipeline:
+            if "$match" in stage:
+                docs = [doc for doc in docs if matches(doc, stage["$match"])]
+            elif "$sample" in stage:
+                docs = docs[:stage["$sample"]["size"]]
+            elif "$limit" in stage:
+                docs = docs[:stage["$limit"]]
+        return list(docs)
+
+    def delete_many(self, query_filter):
+        self.deletes.append(query_filter)
+        if len(self.deletes) in self.fail_deletes:
+            raise errors.AutoReconnect("delete failed")
+        deleted = [doc for doc in self.docs if matches(doc, query_filter)]
+        self.docs = [doc for doc in self.docs if doc not in deleted]
+        return DeleteResult({"n" : len(deleted)}, True)
+
+    def bulk_write(self, operations, ordered=True):
+        self.operations.extend(operations)
+        self.ordered.append(ordered)
+        if self.bulk_write_error is not None:
+            raise self.bulk_write_error
+
+    def watch(self, pipeline=None, **kwargs):
+        self.watches.append((pipeline, kwargs))
+        if self.changes is None:
+            raise errors.OperationFailure("change streams need a replica set")
+        return FakeChangeStream(self.changes, self.poll_sec)
+
+
+def get_field(doc, field):
+    for key in field.split("."):
+        if not isinstance(doc, dict):
+            return None
+        doc = doc.get(key)
+    return doc
+
+def sort_key(value):
+    return (value is not None, value)
+
+def compare(value, op, arg):
+    """ compares like mongo, values of different types never match """
+    numbers = (int, float)
+    if type(value) != type(arg) and not (isinstance(value, numbers) and isinstance(arg, numbers)):
+        return False
+    return {"$gt" : value > arg, "$gte" : value >= arg, "$lt" : value < arg, "$lte" : value <= arg}[op]
+
+def matches(doc, query_filter):
+    """ returns true if doc matches the subset of the mongo query language the handler uses """
+    for key, cond in query_filter.items():
+        if key == "$and":
+            if not all(matches(doc, f) for f in cond):
+                return False
+        elif key == "$or":
+            if not any(matches(doc, f) for f in cond):
+                return False
+        elif isinstance(cond, dict) and len(cond) > 0 and all(k.startswith("$") for k in cond):
+            value = get_field(doc, key)
+            for op, arg in cond.items():
+                if op == "$in":
+                    ok = value in arg
+                elif op == "$ne":
+                    ok = value != arg
+                elif op == "$exists":
+                    ok = (value is not None) == arg
+                else:
+                    ok = compare(value, op, arg)
+                if not ok:
+                    return False
+        elif get_field(doc, key) != cond:
+            return False
+    return True
+
+
+@pytest.fixture
+def fake_collection():
+    """ returns the FakeCollection class so tests can build in-memory collections """
+    return FakeCollection
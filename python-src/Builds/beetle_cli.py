@@ -39,10 +39,11 @@ def main():
         
         ETL.send_email_update()
     
-    elif options["config"]['process'] == "daemon" and 'TriggerFrequencyHrs' in ETL.config_handler.config:
+    elif options["config"]['process'] == "daemon" and 'TriggerFrequencyHrs' in ETL.config_handler.config or \
+        options["config"]['process'] == "stream":
 
-        # setup daemon handler
-        DaemonHandler = Daemon(ETL, options['config']['TriggerFrequencyHrs'])
+        # setup daemon handler (stream mode uses the interval to restart a stopped change stream)
+        DaemonHandler = Daemon(ETL, options['config'].get('TriggerFrequencyHrs', 0.1))
         print("daemon setup properly")
 
         # depending on command connect with daemon and run command